@@ -0,0 +1,7 @@
+"""
+Helpers shared by the game plugins of this repository.
+
+MO2 adds plugins/data to the python path, so the plugins import this package as "gamesupport".
+Nothing in here requires mobase so the modules can be used and tested outside of MO2. The few plugin
+classes shared by the game plugins (thumbnails.GamePreview) are only defined when mobase is available.
+"""
@@ -0,0 +1,385 @@
+"""
+Inspection of mod archives without extracting them.
+
+Only the file list (the central directory for zip, the headers for 7z and rar) is read up front.
+Single members, like a manifest.json, can then be read into memory on demand. ListingTree exposes
+the file list with the subset of the mobase.IFileTree interface used by the mod data checkers,
+so the same checks run on an archive before MO2 extracts anything.
+"""
+
+import abc
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import zipfile
+
+try:
+    import py7zr
+except ImportError:
+    py7zr = None
+
+try:
+    import rarfile
+except ImportError:
+    rarfile = None
+
+
+# members larger than this are never read into memory
+MAX_READ_SIZE = 1024 * 1024
+
+
+def _backendErrors():
+    """
+    @return tuple of the exceptions raised by the available backends for corrupt archives.
+    """
+    errors = [zipfile.BadZipFile]
+    if py7zr is not None:
+        errors.append(py7zr.Bad7zFile)
+    if rarfile is not None:
+        errors.append(rarfile.Error)
+    return tuple(errors)
+
+
+# values of mobase.IFileTree.DIRECTORY and FILE, FILE_OR_DIRECTORY being both bits
+DIRECTORY = 0x01
+FILE = 0x02
+
+
+def normalize(name):
+    return name.replace("\\", "/").strip("/")
+
+
+class ArchiveListing(abc.ABC):
+    """
+    Base class of the archive listings. Subclasses fill self._sizes (member -> uncompressed size)
+    and implement _read().
+    """
+    def __init__(self, path):
+        self.path = path
+        self._sizes = {}
+        self._lowerNames = None
+
+    @staticmethod
+    def open(path):
+        """
+        @brief open the listing of an archive, or of a folder standing in for an extracted archive.
+        @return an ArchiveListing.
+        @raise ValueError if the format is not supported by any available backend or the archive is corrupt.
+        """
+        if os.path.isdir(path):
+            return DirectoryListing(path)
+        extension = os.path.splitext(path)[1].lower()
+        try:
+            if zipfile.is_zipfile(path):
+                return ZipListing(path)
+            if extension == ".7z" and py7zr is not None:
+                return SevenZipListing(path)
+            if extension == ".rar" and rarfile is not None:
+                return RarListing(path)
+        except _backendErrors() as e:
+            raise ValueError("Corrupt archive {}: {}".format(path, e))
+        if CommandLineListing.executable() is not None:
+            return CommandLineListing(path)
+        raise ValueError("Unsupported archive {}".format(path))
+
+    def names(self):
+        """
+        @return list of the files in the archive, '/' separated.
+        """
+        return list(self._sizes)
+
+    def size(self, name):
+        return self._sizes.get(normalize(name))
+
+    def find(self, name):
+        """
+        @return actual name of the member matching name case insensitively, or None.
+        """
+        if self._lowerNames is None:
+            self._lowerNames = {}
+            for member in self._sizes:
+                self._lowerNames.setdefault(member.lower(), member)
+        return self._lowerNames.get(normalize(name).lower())
+
+    def read(self, name, maxSize=MAX_READ_SIZE):
+        """
+        @brief read a single member into memory.
+        @return bytes, or None if the member does not exist or is larger than maxSize.
+        """
+        member = self.find(name)
+        if member is None or self._sizes[member] > maxSize:
+            return None
+        return self._read(member, maxSize)
+
+    def readMany(self, names, maxSize=MAX_READ_SIZE):
+        """
+        @brief read several members, backends that decompress solid blocks do it in one pass.
+        @return dict name -> bytes for the members that could be read.
+        """
+        result = {}
+        for name in names:
+            data = self.read(name, maxSize)
+            if data is not None:
+                result[name] = data
+        return result
+
+    def tree(self):
+        return ListingTree.fromNames(self.names())
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @abc.abstractmethod
+    def _read(self, member, maxSize):
+        """
+        @return at most maxSize bytes of member, an actual member name (see find()).
+        """
+
+
+class ZipListing(ArchiveListing):
+    def __init__(self, path):
+        super(ZipListing, self).__init__(path)
+        self.__zip = zipfile.ZipFile(path)
+        self.__members = {}
+        for info in self.__zip.infolist():
+            if not info.is_dir():
+                name = normalize(info.filename)
+                self._sizes[name] = info.file_size
+                self.__members[name] = info
+
+    def _read(self, member, maxSize):
+        with self.__zip.open(self.__members[member]) as memberFile:
+            return memberFile.read(maxSize + 1)[:maxSize]
+
+    def close(self):
+        self.__zip.close()
+
+
+class SevenZipListing(ArchiveListing):
+    def __init__(self, path):
+        super(SevenZipListing, self).__init__(path)
+        self.__members = {}
+        with py7zr.SevenZipFile(path, "r") as archive:
+            for info in archive.list():
+                if not info.is_directory:
+                    name = normalize(info.filename)
+                    self._sizes[name] = info.uncompressed or 0
+                    self.__members[name] = info.filename
+
+    def _read(self, member, maxSize):
+        return self.readMany([member], maxSize).get(member)
+
+    def readMany(self, names, maxSize=MAX_READ_SIZE):
+        members = {}
+        for name in names:
+            member = self.find(name)
+            if member is not None and self._sizes[member] <= maxSize:
+                members[member] = name
+        if not members:
+            return {}
+        result = {}
+        # py7zr has no in-memory read since 1.0, the members are extracted to a temporary folder in a single
+        # call as the whole solid block has to be decoded anyway
+        with tempfile.TemporaryDirectory() as directory:
+            try:
+                with py7zr.SevenZipFile(self.path, "r") as archive:
+                    archive.extract(path=directory, targets=[self.__members[member] for member in members])
+            except _backendErrors() as e:
+                raise ValueError("Corrupt archive {}: {}".format(self.path, e))
+            for member, name in members.items():
+                try:
+                    with open(os.path.join(directory, *member.split("/")), "rb") as memberFile:
+                        result[name] = memberFile.read(maxSize)
+                except OSError:
+                    pass
+        return result
+
+
+class RarListing(ArchiveListing):
+    def __init__(self, path):
+        super(RarListing, self).__init__(path)
+        self.__rar = rarfile.RarFile(path)
+        for info in self.__rar.infolist():
+            if not info.isdir():
+                self._sizes[normalize(info.filename)] = info.file_size
+        self.__members = {normalize(info.filename): info.filename for info in self.__rar.infolist()}
+
+    def _read(self, member, maxSize):
+        return self.__rar.read(self.__members[member])
+
+    def close(self):
+        self.__rar.close()
+
+
+class CommandLineListing(ArchiveListing):
+    """
+    Fallback using the 7-Zip command line, it reads every format 7-Zip supports.
+    """
+    @staticmethod
+    def executable():
+        for name in ("7z", "7za", "7zz"):
+            path = shutil.which(name)
+            if path is not None:
+                return path
+        return None
+
+    def __init__(self, path):
+        """
+        @raise ValueError if 7-Zip can not list the archive.
+        """
+        super(CommandLineListing, self).__init__(path)
+        try:
+            output = subprocess.run([self.executable(), "l", "-slt", "-ba", "-sccUTF-8", path],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode("utf-8", "replace")
+        except subprocess.CalledProcessError as e:
+            raise ValueError("7-Zip could not list {} (exit code {})".format(path, e.returncode))
+        entry = {}
+        for line in output.splitlines() + [""]:
+            key, sep, value = line.partition(" = ")
+            if sep:
+                entry[key] = value
+            elif entry:
+                if "Path" in entry and "D" not in entry.get("Attributes", ""):
+                    self._sizes[normalize(entry["Path"])] = int(entry.get("Size") or 0)
+                entry = {}
+
+    def _read(self, member, maxSize):
+        process = subprocess.Popen([self.executable(), "e", "-so", self.path, member],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            return process.stdout.read(maxSize)
+        finally:
+            process.stdout.close()
+            process.kill()
+            process.wait()
+
+
+class DirectoryListing(ArchiveListing):
+    """
+    Local stand-in for an archive, used for mods that are already extracted.
+    """
+    def __init__(self, path):
+        super(DirectoryListing, self).__init__(path)
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                fullPath = os.path.join(root, name)
+                self._sizes[normalize(os.path.relpath(fullPath, path))] = os.path.getsize(fullPath)
+
+    def _read(self, member, maxSize):
+        with open(os.path.join(self.path, member), "rb") as memberFile:
+            return memberFile.read(maxSize)
+
+
+class InspectionCache(object):
+    """
+    Results of the inspection of archives, kept as long as the archive file does not change, so that the
+    check of a download and the one of its installation list the archive once.
+    """
+    def __init__(self, inspect):
+        """
+        @param inspect function archive path -> result, may raise OSError or ValueError which are not cached.
+        """
+        self.__inspect = inspect
+        self.__results = {}
+        self.__lock = threading.Lock()
+
+    def get(self, path):
+        stat = os.stat(path)
+        key = os.path.normcase(os.path.abspath(path))
+        signature = (stat.st_size, stat.st_mtime_ns)
+        with self.__lock:
+            cached = self.__results.get(key)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        result = self.__inspect(path)
+        with self.__lock:
+            self.__results[key] = (signature, result)
+        return result
+
+
+class ListingTree(object):
+    """
+    Read-only tree built from a list of paths, implementing the part of mobase.IFileTree
+    and mobase.FileTreeEntry used by the mod data checkers (iteration, find, exists, name, suffix, isDir, isFile).
+    Children are indexed by lower case name so lookups do not walk the tree.
+    """
+    def __init__(self, name="", parent=None, isDirectory=True):
+        self.__name = name
+        self.__parent = parent
+        self.__isDirectory = isDirectory
+        self.__children = {}
+
+    @staticmethod
+    def fromNames(names):
+        root = ListingTree()
+        for name in names:
+            parts = normalize(name).split("/")
+            node = root
+            for index, part in enumerate(parts):
+                isDirectory = index < len(parts) - 1
+                child = node.__children.get(part.lower())
+                if child is None:
+                    child = ListingTree(part, node, isDirectory)
+                    node.__children[part.lower()] = child
+                node = child
+        return root
+
+    def name(self):
+        return self.__name
+
+    def suffix(self):
+        base, dot, extension = self.__name.rpartition(".")
+        return extension if dot and base else ""
+
+    def parent(self):
+        return self.__parent
+
+    def path(self, separator="/"):
+        parts = []
+        node = self
+        while node.__parent is not None:
+            parts.append(node.__name)
+            node = node.__parent
+        return separator.join(reversed(parts))
+
+    def isDir(self):
+        return self.__isDirectory
+
+    def isFile(self):
+        return not self.__isDirectory
+
+    def find(self, path, fileType=None):
+        """
+        @param fileType mobase.IFileTree.FILE, DIRECTORY or FILE_OR_DIRECTORY, None for any entry.
+        @return the entry at path if it has the requested type, or None.
+        """
+        node = self
+        for part in normalize(path).split("/"):
+            if not part:
+                continue
+            node = node.__children.get(part.lower()) if node.__isDirectory else None
+            if node is None:
+                return None
+        if fileType is not None and not int(fileType) & (DIRECTORY if node.__isDirectory else FILE):
+            return None
+        return node
+
+    def exists(self, path, fileType=None):
+        """
+        @param fileType mobase.IFileTree.FILE, DIRECTORY or FILE_OR_DIRECTORY, None for any entry.
+        """
+        return self.find(path, fileType) is not None
+
+    def __iter__(self):
+        return iter(list(self.__children.values()))
+
+    def __len__(self):
+        return len(self.__children)
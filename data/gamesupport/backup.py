@@ -0,0 +1,437 @@
+"""
+Deduplicated, compressed backups of save folders.
+
+Save files are cut in chunks at content defined boundaries, so a change in a save only produces new
+chunks around the change, and each chunk is stored once, compressed, under the digest of its content.
+A snapshot is a small manifest listing the chunks of every file. Files whose size and modification time
+did not change since the previous snapshot are not read at all.
+
+Chunks are compressed with zstandard when it is installed and with zlib otherwise. The codec is recorded
+in every chunk, so a store written with either can be read back as long as the codec is available.
+Restoring only needs this module and the store folder, see the __main__ block at the end.
+"""
+
+import gzip
+import json
+import os
+import random
+import threading
+import time
+import zlib
+
+from .hashing import hashBytes
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MIN_CHUNK = 2 * 1024
+MAX_CHUNK = 64 * 1024
+
+# Content defined chunking: every byte is mapped to b"0" or b"1" by a fixed table, and a chunk ends after
+# a run of ones. Where boundaries fall only depends on the bytes right before them, so inserting or
+# removing bytes in a save only changes the chunks around the edit. Shorter runs are accepted further
+# into a chunk when it has no long run, text with a small alphabet would otherwise be cut at MAX_CHUNK
+# offsets, which all move after an insertion. translate() and find() run in C, which keeps chunking at memory speed in Python.
+_MARKS = bytearray(b"0" * 256)
+for _value in random.Random(0x5A5E).sample(range(256), 128):
+    _MARKS[_value] = ord("1")
+_MARKS = bytes(_MARKS)
+# (run, minimum chunk size for that run)
+BOUNDARY_RUNS = ((b"1" * 13, MIN_CHUNK), (b"1" * 9, 8 * 1024), (b"1" * 5, 16 * 1024))
+
+RAW = b"r"
+ZLIB = b"z"
+ZSTD = b"s"
+
+SNAPSHOT_EXTENSION = ".json.gz"
+MANIFEST_VERSION = 1
+
+
+def chunkBoundaries(data):
+    """
+    @param data bytes like object supporting translate(), e.g. bytes.
+    @return list of the end offsets of the chunks of data, the last one being len(data).
+    """
+    marks = data.translate(_MARKS)
+    size = len(data)
+    boundaries = []
+    # next occurrence of each run, searched again only once the chunks went past it, so that long runs
+    # missing from a whole stretch of data are not looked for again in every chunk
+    occurrences = [-1] * len(BOUNDARY_RUNS)
+    start = 0
+    while start < size:
+        limit = min(start + MAX_CHUNK, size)
+        end = limit
+        for level, (run, minimum) in enumerate(BOUNDARY_RUNS):
+            found = occurrences[level]
+            if found < start + minimum:
+                found = marks.find(run, start + minimum)
+                occurrences[level] = found = size if found < 0 else found
+            if found + len(run) <= limit:
+                end = found + len(run)
+                break
+        boundaries.append(end)
+        start = end
+    return boundaries
+
+
+def compressChunk(data):
+    """
+    @return data prefixed by its codec, stored raw when compressing does not make it smaller.
+    """
+    if zstandard is not None:
+        packed = ZSTD + zstandard.ZstdCompressor(level=3).compress(data)
+    else:
+        packed = ZLIB + zlib.compress(data, 6)
+    return packed if len(packed) <= len(data) else RAW + data
+
+
+def decompressChunk(packed):
+    codec, payload = packed[:1], packed[1:]
+    if codec == RAW:
+        return payload
+    if codec == ZLIB:
+        return zlib.decompress(payload)
+    if codec == ZSTD:
+        if zstandard is None:
+            raise ValueError("the chunk is compressed with zstandard, which is not installed")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    raise ValueError("unknown chunk codec {!r}".format(codec))
+
+
+def _writeAtomically(path, data):
+    temporary = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    with open(temporary, "wb") as temporaryFile:
+        temporaryFile.write(data)
+    os.replace(temporary, path)
+
+
+class SaveBackupStore(object):
+    """
+    Snapshots of a folder in a content addressed store made of chunks/<2 hex>/<digest> and
+    snapshots/<snapshot id>.json.gz. Snapshot ids sort chronologically.
+    """
+    def __init__(self, root):
+        self.__root = root
+        self.__chunksPath = os.path.join(root, "chunks")
+        self.__snapshotsPath = os.path.join(root, "snapshots")
+        self.__lock = threading.Lock()
+        self.__latest = None
+
+    def root(self):
+        return self.__root
+
+    def snapshots(self):
+        """
+        @return list of the snapshot ids, oldest first.
+        """
+        try:
+            names = os.listdir(self.__snapshotsPath)
+        except OSError:
+            return []
+        return sorted(name[:-len(SNAPSHOT_EXTENSION)] for name in names if name.endswith(SNAPSHOT_EXTENSION))
+
+    def manifest(self, snapshotId):
+        """
+        @return dict with the "id", "created", "source", "label" and "files" of a snapshot, files being a
+            dict relative path -> [size, mtime_ns, [chunk digests]].
+        @raise ValueError if the snapshot does not exist or can not be read.
+        """
+        path = os.path.join(self.__snapshotsPath, snapshotId + SNAPSHOT_EXTENSION)
+        try:
+            with open(path, "rb") as manifestFile:
+                manifest = json.loads(gzip.decompress(manifestFile.read()).decode("utf-8"))
+        except (OSError, EOFError, ValueError) as e:
+            raise ValueError("snapshot {} can not be read: {}".format(snapshotId, e))
+        if manifest.get("version") != MANIFEST_VERSION:
+            raise ValueError("snapshot {} has an unsupported version".format(snapshotId))
+        return manifest
+
+    def backup(self, source, label=""):
+        """
+        @brief snapshot the files under source. Only new or modified files are read and only their new
+            chunks are compressed and written.
+        @return id of the new snapshot, None if nothing changed since the latest snapshot of source or if
+            source does not exist.
+        """
+        with self.__lock:
+            if not os.path.isdir(source):
+                return None
+            previous = self.__latestManifest(source)
+            previousFiles = previous["files"] if previous is not None else {}
+            knownChunks = set(digest for entry in previousFiles.values() for digest in entry[2])
+            files = {}
+            changed = False
+            for directory, dirs, names in os.walk(source):
+                dirs.sort()
+                for name in sorted(names):
+                    path = os.path.join(directory, name)
+                    relativePath = os.path.relpath(path, source).replace(os.sep, "/")
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    entry = previousFiles.get(relativePath)
+                    if entry is None or entry[0] != stat.st_size or entry[1] != stat.st_mtime_ns:
+                        try:
+                            entry = [stat.st_size, stat.st_mtime_ns, self.__storeFile(path, knownChunks)]
+                        except OSError:
+                            continue
+                        changed = True
+                    files[relativePath] = entry
+            if not changed and previous is not None and files.keys() == previousFiles.keys():
+                return None
+            manifest = {
+                "version": MANIFEST_VERSION,
+                "id": self.__newSnapshotId(),
+                "created": time.time(),
+                "source": os.path.abspath(source),
+                "label": label,
+                "files": files,
+                }
+            os.makedirs(self.__snapshotsPath, exist_ok=True)
+            _writeAtomically(os.path.join(self.__snapshotsPath, manifest["id"] + SNAPSHOT_EXTENSION),
+                gzip.compress(json.dumps(manifest, separators=(",", ":")).encode("utf-8"), 6))
+            self.__latest = manifest
+            return manifest["id"]
+
+    def restore(self, snapshotId, target, removeExtra=False):
+        """
+        @brief write the files of a snapshot under target. Files that already have the size and
+            modification time recorded in the snapshot are left alone, restored files get that
+            modification time back.
+        @param removeExtra also delete the files under target that are not in the snapshot.
+        @return number of files written.
+        @raise ValueError if the snapshot or one of its chunks is missing or corrupted.
+        """
+        with self.__lock:
+            manifest = self.manifest(snapshotId)
+            targetPath = os.path.abspath(target)
+            written = 0
+            for relativePath, (size, mtime, chunks) in sorted(manifest["files"].items()):
+                path = os.path.normpath(os.path.join(targetPath, *relativePath.split("/")))
+                if os.path.commonpath([targetPath, path]) != targetPath or path == targetPath:
+                    raise ValueError("snapshot {} contains an invalid path: {}".format(snapshotId, relativePath))
+                try:
+                    stat = os.stat(path)
+                    if stat.st_size == size and stat.st_mtime_ns == mtime:
+                        continue
+                except OSError:
+                    pass
+                data = b"".join(self.__readChunk(digest) for digest in chunks)
+                if len(data) != size:
+                    raise ValueError("{} of snapshot {} has a wrong size".format(relativePath, snapshotId))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                _writeAtomically(path, data)
+                os.utime(path, ns=(mtime, mtime))
+                written += 1
+            if removeExtra:
+                for directory, dirs, names in os.walk(targetPath):
+                    for name in names:
+                        path = os.path.join(directory, name)
+                        if os.path.relpath(path, targetPath).replace(os.sep, "/") not in manifest["files"]:
+                            os.remove(path)
+            return written
+
+    def prune(self, keep):
+        """
+        @brief delete all but the keep newest snapshots, then the chunks no remaining snapshot uses.
+        @return (number of snapshots deleted, number of chunks deleted)
+        """
+        with self.__lock:
+            snapshots = self.snapshots()
+            removed = snapshots[:max(len(snapshots) - keep, 0)]
+            if not removed:
+                return 0, 0
+            for snapshotId in removed:
+                os.remove(os.path.join(self.__snapshotsPath, snapshotId + SNAPSHOT_EXTENSION))
+            self.__latest = None
+            used = set()
+            for snapshotId in snapshots[len(removed):]:
+                for size, mtime, chunks in self.manifest(snapshotId)["files"].values():
+                    used.update(chunks)
+            deleted = 0
+            for digest, path in self.__listChunks():
+                if digest not in used:
+                    os.remove(path)
+                    deleted += 1
+            return len(removed), deleted
+
+    def statistics(self):
+        """
+        @return (number of snapshots, number of chunks, bytes used by the chunks)
+        """
+        chunks = 0
+        size = 0
+        for digest, path in self.__listChunks():
+            chunks += 1
+            size += os.path.getsize(path)
+        return len(self.snapshots()), chunks, size
+
+    def __latestManifest(self, source):
+        source = os.path.abspath(source)
+        if self.__latest is None or self.__latest["source"] != source:
+            self.__latest = None
+            for snapshotId in reversed(self.snapshots()):
+                try:
+                    manifest = self.manifest(snapshotId)
+                except ValueError:
+                    continue
+                if manifest["source"] == source:
+                    self.__latest = manifest
+                    break
+        return self.__latest
+
+    def __newSnapshotId(self):
+        now = time.time()
+        snapshotId = time.strftime("%Y%m%d-%H%M%S", time.localtime(now)) + "-{:06d}".format(int(now % 1 * 1000000))
+        existing = self.snapshots()
+        if existing and snapshotId <= existing[-1]:
+            # clock changes and snapshots taken within the same microsecond
+            snapshotId = existing[-1] + "-1"
+        return snapshotId
+
+    def __chunkPath(self, digest):
+        return os.path.join(self.__chunksPath, digest[:2], digest)
+
+    def __storeFile(self, path, knownChunks):
+        with open(path, "rb") as savedFile:
+            data = savedFile.read()
+        digests = []
+        start = 0
+        for end in chunkBoundaries(data):
+            chunk = data[start:end]
+            start = end
+            digest = hashBytes(chunk)
+            digests.append(digest)
+            if digest in knownChunks:
+                continue
+            chunkPath = self.__chunkPath(digest)
+            if not os.path.exists(chunkPath):
+                os.makedirs(os.path.dirname(chunkPath), exist_ok=True)
+                _writeAtomically(chunkPath, compressChunk(chunk))
+            knownChunks.add(digest)
+        return digests
+
+    def __readChunk(self, digest):
+        try:
+            with open(self.__chunkPath(digest), "rb") as chunkFile:
+                data = decompressChunk(chunkFile.read())
+        except (OSError, zlib.error) as e:
+            raise ValueError("chunk {} can not be read: {}".format(digest, e))
+        if hashBytes(data) != digest:
+            raise ValueError("chunk {} is corrupted".format(digest))
+        return data
+
+    def __listChunks(self):
+        try:
+            prefixes = os.listdir(self.__chunksPath)
+        except OSError:
+            return
+        for prefix in prefixes:
+            directory = os.path.join(self.__chunksPath, prefix)
+            for name in os.listdir(directory):
+                if not name.endswith(".tmp"):
+                    yield name, os.path.join(directory, name)
+
+
+class SaveBackup(object):
+    """
+    Opt-in snapshots of the saves folder of a game plugin before and after running a program.
+    Snapshots share the chunks that did not change, so keeping all of them costs little more than the parts
+    of the saves that changed. The store is the savebackups/<game short name> folder of the instance and can
+    be restored without MO2 with python -m gamesupport.backup.
+    The plugin settings are backup_saves (enabled) and backup_keep (number of snapshots, 0 for all of them).
+    organizer and game are the mobase.IOrganizer and mobase.IPluginGame of the plugin, only their methods are
+    used so this module does not import mobase.
+    """
+    def __init__(self, organizer, game, info=None, warning=None):
+        """
+        @param info, warning callables logging a message, e.g. qInfo and qWarning.
+        """
+        self.__organizer = organizer
+        self.__game = game
+        self.__info = info or (lambda message: None)
+        self.__warning = warning or (lambda message: None)
+        self.__store = None
+        self.__thread = None
+
+    def isEnabled(self):
+        return bool(self.__organizer.pluginSetting(self.__game.name(), "backup_saves"))
+
+    def store(self):
+        path = os.path.join(self.__organizer.basePath(), "savebackups", self.__game.gameShortName())
+        if self.__store is None or self.__store.root() != path:
+            self.__store = SaveBackupStore(path)
+        return self.__store
+
+    def backup(self, label=""):
+        """
+        @brief snapshot the saves folder, then delete the snapshots beyond the backup_keep newest ones.
+        @return id of the new snapshot, None if the saves did not change since the latest snapshot.
+        """
+        store = self.store()
+        snapshotId = store.backup(self.__game.savesDirectory().absolutePath(), label)
+        keep = int(self.__organizer.pluginSetting(self.__game.name(), "backup_keep") or 0)
+        if snapshotId is not None and keep > 0:
+            store.prune(keep)
+        return snapshotId
+
+    def start(self, label=""):
+        """
+        @brief run backup() on a background thread, unless one is already running.
+        """
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+        self.__thread = threading.Thread(target=self.run, args=(label,),
+            name="save backup: {}".format(self.__game.gameShortName()), daemon=True)
+        self.__thread.start()
+
+    def run(self, label=""):
+        try:
+            snapshotId = self.backup(label)
+        except (OSError, ValueError) as e:
+            self.__warning("Could not back up the saves: {}".format(e))
+            return None
+        if snapshotId is not None:
+            self.__info("Saves backed up as snapshot {}".format(snapshotId))
+        return snapshotId
+
+    def snapshots(self):
+        return self.store().snapshots()
+
+    def restore(self, snapshotId):
+        """
+        @brief bring the saves folder back to a snapshot, saves made since then are kept.
+        @return number of files written.
+        """
+        return self.store().restore(snapshotId, self.__game.savesDirectory().absolutePath())
+
+
+if __name__ == "__main__":
+    # python -m gamesupport.backup <store> list
+    # python -m gamesupport.backup <store> backup <saves folder>
+    # python -m gamesupport.backup <store> restore <snapshot id> <saves folder> [--clean]
+    # python -m gamesupport.backup <store> prune <number of snapshots to keep>
+    import sys
+
+    arguments = [argument for argument in sys.argv[1:] if argument != "--clean"]
+    usage = "usage: python -m gamesupport.backup <store> list | backup <folder> | restore <snapshot> <folder> [--clean] | prune <keep>"
+    if len(arguments) < 2:
+        sys.exit(usage)
+    store = SaveBackupStore(arguments[0])
+    command = arguments[1]
+    if command == "list" and len(arguments) == 2:
+        for snapshotId in store.snapshots():
+            manifest = store.manifest(snapshotId)
+            print("{} {} files {}".format(snapshotId, len(manifest["files"]), manifest["label"]))
+    elif command == "backup" and len(arguments) == 3:
+        print(store.backup(arguments[2]) or "nothing changed")
+    elif command == "restore" and len(arguments) == 4:
+        print("{} files restored".format(store.restore(arguments[2], arguments[3], "--clean" in sys.argv)))
+    elif command == "prune" and len(arguments) == 3:
+        print("{} snapshots and {} chunks deleted".format(*store.prune(int(arguments[2]))))
+    else:
+        sys.exit(usage)
@@ -0,0 +1,29 @@
+"""
+Location of the files cached by the gamesupport helpers.
+"""
+
+import hashlib
+import os
+import sys
+
+
+def cacheDirectory(*parts):
+    """
+    @brief get (and create) a folder of the gamesupport cache, under the local app data folder
+        on Windows and the XDG cache folder elsewhere.
+    """
+    if sys.platform == "win32":
+        base = os.getenv("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base = os.getenv("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    path = os.path.join(base, "ModOrganizer", "gamesupport", *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def cacheFile(category, key, extension=".cache"):
+    """
+    @brief path of a cache file specific to key, e.g. the mods folder of an instance.
+    """
+    digest = hashlib.sha1(os.path.normcase(os.path.abspath(key)).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cacheDirectory(category), digest + extension)
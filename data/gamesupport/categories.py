@@ -0,0 +1,194 @@
+"""
+MO2 categories.dat tables and their synchronization with the Nexus categories of a game.
+
+A categories.dat line is "id|name|nexus ids|parent id", nexus ids being comma separated. The Nexus
+categories are read from a locally saved dump, either the answer of the games/<domain>.json API call or
+its "categories" list, so the tables can be rebuilt offline. Ids of existing categories never change.
+CategoryIndex.load() indexes a categories.dat by Nexus id once, categorizing a download is then a dict lookup.
+"""
+
+import collections
+import json
+import os
+import threading
+
+Category = collections.namedtuple("Category", ["id", "name", "nexusIds", "parentId"])
+
+
+def parseCategories(text):
+    """
+    @return list of Category, lines that are not valid are skipped.
+    """
+    categories = []
+    for line in text.splitlines():
+        fields = line.strip().split("|")
+        if len(fields) != 4:
+            continue
+        try:
+            categoryId = int(fields[0])
+            parentId = int(fields[3] or 0)
+            nexusIds = tuple(int(value) for value in fields[2].split(",") if value.strip())
+        except ValueError:
+            continue
+        categories.append(Category(categoryId, fields[1], nexusIds, parentId))
+    return categories
+
+
+def formatCategories(categories):
+    return "".join("{}|{}|{}|{}\n".format(
+        category.id, category.name, ",".join(str(nexusId) for nexusId in category.nexusIds), category.parentId)
+        for category in categories)
+
+
+def loadCategories(path):
+    """
+    @return list of Category of a categories.dat, empty if it can not be read.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as categoriesFile:
+            return parseCategories(categoriesFile.read())
+    except OSError:
+        return []
+
+
+def saveCategories(path, categories):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8", newline="\n") as categoriesFile:
+        categoriesFile.write(formatCategories(categories))
+
+
+class CategoryIndex(object):
+    """
+    Categories of a categories.dat in a single dict keyed by Nexus id, built once per file and version
+    of the file by load().
+    """
+    _loaded = {}
+    _loadedLock = threading.Lock()
+
+    def __init__(self, categories):
+        self.categories = list(categories)
+        self.__byNexusId = {}
+        for category in self.categories:
+            for nexusId in category.nexusIds:
+                # the first category listing a Nexus id wins, as in MO2
+                self.__byNexusId.setdefault(nexusId, category)
+
+    @classmethod
+    def load(cls, path):
+        """
+        @return the CategoryIndex of a categories.dat, shared until the file changes.
+        """
+        try:
+            stat = os.stat(path)
+            signature = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            signature = None
+        key = os.path.normcase(os.path.abspath(path))
+        with cls._loadedLock:
+            loaded = cls._loaded.get(key)
+            if loaded is None or loaded[0] != signature:
+                loaded = (signature, cls(loadCategories(path) if signature is not None else []))
+                cls._loaded[key] = loaded
+        return loaded[1]
+
+    def byNexusId(self, nexusId):
+        """
+        @return the Category of a Nexus category id, or None.
+        """
+        return self.__byNexusId.get(nexusId)
+
+    def categorize(self, nexusIds):
+        """
+        @param nexusIds Nexus category ids of many downloads.
+        @return list of the matching MO2 category ids, 0 for the downloads without a match.
+        """
+        byNexusId = self.__byNexusId
+        return [byNexusId[nexusId].id if nexusId in byNexusId else 0 for nexusId in nexusIds]
+
+
+def readNexusDump(path):
+    """
+    @return list of (nexus id, name, parent nexus id or 0) of a saved games/<domain>.json answer,
+        without the root category named after the game itself.
+    """
+    with open(path, "r", encoding="utf-8-sig") as dumpFile:
+        dump = json.load(dumpFile)
+    gameName = ""
+    if isinstance(dump, dict):
+        gameName = str(dump.get("name", "")).strip().lower()
+        dump = dump.get("categories", [])
+    categories = []
+    for entry in dump:
+        try:
+            nexusId = int(entry["category_id"])
+            parent = int(entry.get("parent_category") or 0)
+        except (KeyError, TypeError, ValueError):
+            continue
+        categories.append((nexusId, str(entry.get("name", "")).strip(), parent))
+    roots = {nexusId for nexusId, name, parent in categories if not parent and gameName and name.lower() == gameName}
+    return [(nexusId, name, 0 if parent in roots else parent)
+            for nexusId, name, parent in categories if nexusId not in roots]
+
+
+def syncNexusCategories(categories, nexusCategories):
+    """
+    @brief merge Nexus categories into a categories.dat table.
+    Existing categories are matched by Nexus id, then by name, and keep their id. New categories get new ids.
+    @param categories list of Category, in the order of the file.
+    @return (list of Category in the order of the file, dict with the "added", "updated" and "unmatched"
+        Category lists), unmatched being the categories that are not in the dump. They are kept as users
+        may have assigned them.
+    """
+    byId = collections.OrderedDict((category.id, category) for category in categories)
+    byNexusId = {}
+    byName = {}
+    for category in categories:
+        for nexusId in category.nexusIds:
+            byNexusId.setdefault(nexusId, category.id)
+        byName.setdefault(category.name.strip().lower(), category.id)
+    added = []
+    updated = []
+    idOfNexus = {}
+    for nexusId, name, parent in nexusCategories:
+        categoryId = byNexusId.get(nexusId, byName.get(name.strip().lower()))
+        if categoryId is None:
+            categoryId = max(byId, default=0) + 1
+            byId[categoryId] = Category(categoryId, name, (nexusId,), 0)
+            byName.setdefault(name.strip().lower(), categoryId)
+            added.append(categoryId)
+        elif nexusId not in byId[categoryId].nexusIds:
+            byId[categoryId] = byId[categoryId]._replace(nexusIds=byId[categoryId].nexusIds + (nexusId,))
+            updated.append(categoryId)
+        byNexusId.setdefault(nexusId, categoryId)
+        idOfNexus[nexusId] = categoryId
+    for nexusId, name, parent in nexusCategories:
+        categoryId = idOfNexus[nexusId]
+        parentId = idOfNexus.get(parent, 0)
+        if parent and byId[categoryId].parentId != parentId:
+            byId[categoryId] = byId[categoryId]._replace(parentId=parentId)
+            if categoryId not in added and categoryId not in updated:
+                updated.append(categoryId)
+    merged = list(byId.values())
+    if len(categories) > 1 and categories[0].id > categories[-1].id:
+        merged.sort(key=lambda category: category.id, reverse=True)
+    matched = set(idOfNexus.values())
+    return merged, {
+        "added": [byId[categoryId] for categoryId in added],
+        "updated": [byId[categoryId] for categoryId in updated],
+        "unmatched": [category for category in merged if category.id not in matched],
+        }
+
+
+if __name__ == "__main__":
+    # python -m gamesupport.categories <categories.dat> <nexus dump.json> [--dry-run]
+    import sys
+
+    arguments = [argument for argument in sys.argv[1:] if argument != "--dry-run"]
+    if len(arguments) != 2:
+        sys.exit("usage: python -m gamesupport.categories <categories.dat> <nexus dump.json> [--dry-run]")
+    categories, changes = syncNexusCategories(loadCategories(arguments[0]), readNexusDump(arguments[1]))
+    for label, sign in (("added", "+"), ("updated", "~"), ("unmatched", "?")):
+        for category in changes[label]:
+            print("{} {}".format(sign, formatCategories([category]).strip()))
+    if "--dry-run" not in sys.argv and (changes["added"] or changes["updated"]):
+        saveCategories(arguments[0], categories)
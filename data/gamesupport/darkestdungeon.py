@@ -0,0 +1,467 @@
+"""
+Darkest Dungeon helpers shared by the Darkest Dungeon plugin: mod catalog and save profiles.
+"""
+
+import collections
+import json
+import os
+import pickle
+import struct
+import xml.etree.ElementTree as ElementTree
+
+APP_ID = "262060"
+PROJECT = "project.xml"
+
+ModEntry = collections.namedtuple("ModEntry", ["source", "path", "title", "publishedFileId"])
+
+
+def parseProject(data):
+    """
+    @brief parse the content of a project.xml.
+    @return dict of its top level elements (Title, PublishedFileId, ...) or None if it is not valid xml.
+    """
+    try:
+        return {element.tag: (element.text or "").strip() for element in ElementTree.fromstring(data)}
+    except ElementTree.ParseError:
+        return None
+
+
+def workshopPath(gamePath):
+    """
+    @return the Steam Workshop content folder of the game, from the game folder inside a Steam library.
+    """
+    common = os.path.dirname(os.path.normpath(gamePath))
+    return os.path.join(os.path.dirname(common), "workshop", "content", APP_ID)
+
+
+class ModCatalog(object):
+    """
+    Mods of several sources (Steam Workshop, the game mods/ folder, MO2 mods) keyed by PublishedFileId,
+    or by folder name for mods that were never uploaded. project.xml files are only parsed again when they change.
+    """
+    CACHE_VERSION = 1
+
+    def __init__(self, cachePath=None):
+        self.__cachePath = cachePath
+        self.__projects = {}
+        self.__entries = {}
+        if cachePath is not None:
+            try:
+                with open(cachePath, "rb") as cacheFile:
+                    version, projects = pickle.load(cacheFile)
+                if version == self.CACHE_VERSION:
+                    self.__projects = projects
+            except Exception:
+                pass
+
+    @staticmethod
+    def key(project, folderName):
+        publishedFileId = project.get("PublishedFileId", "")
+        if publishedFileId and publishedFileId != "0":
+            return publishedFileId
+        return "folder:" + folderName.lower()
+
+    def index(self, sources):
+        """
+        @param sources list of (source name, folder containing mod folders).
+        @return dict key -> list of ModEntry.
+        """
+        entries = {}
+        projects = {}
+        for source, root in sources:
+            try:
+                folders = [entry for entry in os.scandir(root) if entry.is_dir()]
+            except OSError:
+                continue
+            for folder in folders:
+                project = self.__project(os.path.join(folder.path, PROJECT), projects)
+                if project is None:
+                    continue
+                entry = ModEntry(source, folder.path, project.get("Title", folder.name), project.get("PublishedFileId", ""))
+                entries.setdefault(self.key(project, folder.name), []).append(entry)
+        self.__projects = projects
+        self.__entries = entries
+        self.__save()
+        return entries
+
+    def entries(self):
+        return self.__entries
+
+    def duplicates(self):
+        """
+        @return dict key -> list of ModEntry for the mods present more than once.
+        """
+        return {key: entries for key, entries in self.__entries.items() if len(entries) > 1}
+
+    def __project(self, path, projects):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        cached = self.__projects.get(path)
+        if cached is not None and cached[0] == (stat.st_size, stat.st_mtime_ns):
+            projects[path] = cached
+            return cached[1]
+        try:
+            with open(path, "rb") as projectFile:
+                project = parseProject(projectFile.read())
+        except OSError:
+            return None
+        if project is not None:
+            projects[path] = ((stat.st_size, stat.st_mtime_ns), project)
+        return project
+
+    def __save(self):
+        if self.__cachePath is None:
+            return
+        try:
+            with open(self.__cachePath, "wb") as cacheFile:
+                pickle.dump((self.CACHE_VERSION, self.__projects), cacheFile, pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            pass
+
+
+BDHD_MAGIC = b"\x01\xb1\x00\x00"
+BDHD_HEADER = struct.Struct("<4s6I16x5I")
+BDHD_META1 = struct.Struct("<4i")
+BDHD_META2 = struct.Struct("<iII")
+INT = struct.Struct("<i")
+FLOAT = struct.Struct("<f")
+
+
+class PersistFile(object):
+    """
+    Decoder of the binary "BDHD" format of the persist.*.json saves, over a memoryview of the file content.
+    Nothing is decoded up front: fields are located from the meta tables and their names and values are only
+    read when asked for. Embedded files (e.g. the raw_data of heroes) are decoded from a slice of the same buffer.
+    """
+    def __init__(self, data):
+        """
+        @param data bytes like object with the content of a save file.
+        @raise ValueError if data is not a BDHD file.
+        """
+        self.view = memoryview(data)
+        if len(self.view) < BDHD_HEADER.size or bytes(self.view[:4]) != BDHD_MAGIC:
+            raise ValueError("not a BDHD file")
+        (magic, revision, headerLength, zeroes, meta1Size, self.meta1Count, self.meta1Offset,
+            self.meta2Count, self.meta2Offset, zeroes3, self.dataLength, self.dataOffset) = BDHD_HEADER.unpack_from(self.view)
+        if self.meta2Offset + self.meta2Count * BDHD_META2.size > len(self.view) \
+                or self.dataOffset + self.dataLength > len(self.view):
+            raise ValueError("truncated BDHD file")
+        self.__children = {}
+
+    @classmethod
+    def open(cls, path):
+        """
+        @return PersistFile of a BDHD file, or a JsonPersistFile for the saves that are plain json.
+        """
+        with open(path, "rb") as persistFile:
+            data = persistFile.read()
+        if data.lstrip()[:1] == b"{":
+            return JsonPersistFile(data)
+        return cls(data)
+
+    def root(self):
+        return PersistField(self, -1)
+
+    def fieldInfo(self, index):
+        """
+        @return (data offset, is object, name length, meta1 index) of a meta2 entry.
+        """
+        nameHash, offset, info = BDHD_META2.unpack_from(self.view, self.meta2Offset + index * BDHD_META2.size)
+        return offset, bool(info & 1), (info >> 2) & 0x1FF, (info >> 11) & 0xFFFFF
+
+    def children(self, index):
+        """
+        @return dict name -> meta2 index of the direct children of the field at index, -1 for the top level fields.
+        """
+        children = self.__children.get(index)
+        if children is None:
+            children = {}
+            if index < 0:
+                child, count, end = 0, None, self.meta2Count
+            else:
+                offset, isObject, nameLength, meta1Index = self.fieldInfo(index)
+                if not isObject:
+                    return {}
+                count = BDHD_META1.unpack_from(self.view, self.meta1Offset + meta1Index * BDHD_META1.size)[2]
+                child, end = index + 1, self.meta2Count
+            while child < end and (count is None or len(children) < count):
+                children.setdefault(self.name(child), child)
+                offset, isObject, nameLength, meta1Index = self.fieldInfo(child)
+                descendants = 0
+                if isObject:
+                    descendants = BDHD_META1.unpack_from(self.view, self.meta1Offset + meta1Index * BDHD_META1.size)[3]
+                child += 1 + descendants
+            self.__children[index] = children
+        return children
+
+    def name(self, index):
+        offset, isObject, nameLength, meta1Index = self.fieldInfo(index)
+        start = self.dataOffset + offset
+        return bytes(self.view[start:start + max(nameLength - 1, 0)]).decode("utf-8", "replace")
+
+    def value(self, index):
+        """
+        @return (start, aligned start, end) of the value of a field in view.
+        """
+        offset, isObject, nameLength, meta1Index = self.fieldInfo(index)
+        start = self.dataOffset + offset + nameLength
+        if index + 1 < self.meta2Count:
+            end = self.dataOffset + self.fieldInfo(index + 1)[0]
+        else:
+            end = self.dataOffset + self.dataLength
+        aligned = self.dataOffset + ((start - self.dataOffset + 3) & ~3)
+        return start, aligned, max(end, start)
+
+
+class PersistField(object):
+    """
+    Field of a PersistFile, values are decoded when one of the as*() methods is called.
+    The format does not store value types, the caller picks the one the field is known to have.
+    """
+    __slots__ = ("file", "index")
+
+    def __init__(self, persistFile, index):
+        self.file = persistFile
+        self.index = index
+
+    def name(self):
+        return self.file.name(self.index) if self.index >= 0 else ""
+
+    def isObject(self):
+        return self.index < 0 or self.file.fieldInfo(self.index)[1]
+
+    def children(self):
+        """
+        @return list of (name, PersistField).
+        """
+        return [(name, PersistField(self.file, index)) for name, index in self.file.children(self.index).items()]
+
+    def child(self, name):
+        index = self.file.children(self.index).get(name)
+        return PersistField(self.file, index) if index is not None else None
+
+    def find(self, path):
+        """
+        @return the field at a "/" separated path below this one, or None.
+        """
+        field = self
+        for name in path.split("/"):
+            field = field.child(name) if field is not None else None
+        return field
+
+    def raw(self):
+        start, aligned, end = self.file.value(self.index)
+        return self.file.view[start:end]
+
+    def asBool(self):
+        start, aligned, end = self.file.value(self.index)
+        return end > start and self.file.view[start] != 0
+
+    def asInt(self):
+        start, aligned, end = self.file.value(self.index)
+        return INT.unpack_from(self.file.view, aligned)[0] if aligned + 4 <= end else None
+
+    def asFloat(self):
+        start, aligned, end = self.file.value(self.index)
+        return FLOAT.unpack_from(self.file.view, aligned)[0] if aligned + 4 <= end else None
+
+    def asString(self):
+        start, aligned, end = self.file.value(self.index)
+        if aligned + 4 > end:
+            return None
+        length = INT.unpack_from(self.file.view, aligned)[0]
+        if length <= 0 or aligned + 4 + length > end:
+            return None
+        return bytes(self.file.view[aligned + 4:aligned + 3 + length]).decode("utf-8", "replace")
+
+    def asFile(self):
+        """
+        @return the PersistFile embedded in this field, sharing the buffer of this file, or None.
+        """
+        start, aligned, end = self.file.value(self.index)
+        if aligned + 4 > end:
+            return None
+        length = INT.unpack_from(self.file.view, aligned)[0]
+        try:
+            return PersistFile(self.file.view[aligned + 4:aligned + 4 + length]) if 0 < length <= end - aligned - 4 else None
+        except ValueError:
+            return None
+
+
+class JsonPersistFile(object):
+    """
+    Saves written as plain json (by older versions of the game or by save editors), with the PersistFile interface.
+    """
+    def __init__(self, data):
+        self.content = json.loads(bytes(data).decode("utf-8-sig", "replace"))
+
+    def root(self):
+        return JsonPersistField("", self.content)
+
+
+class JsonPersistField(object):
+    __slots__ = ("fieldName", "value")
+
+    def __init__(self, name, value):
+        self.fieldName = name
+        self.value = value
+
+    def name(self):
+        return self.fieldName
+
+    def isObject(self):
+        return isinstance(self.value, dict)
+
+    def children(self):
+        return [(name, JsonPersistField(name, value)) for name, value in self.value.items()] if self.isObject() else []
+
+    def child(self, name):
+        return JsonPersistField(name, self.value[name]) if self.isObject() and name in self.value else None
+
+    def find(self, path):
+        field = self
+        for name in path.split("/"):
+            field = field.child(name) if field is not None else None
+        return field
+
+    def asBool(self):
+        return bool(self.value)
+
+    def asInt(self):
+        return self.value if isinstance(self.value, int) else None
+
+    def asFloat(self):
+        return float(self.value) if isinstance(self.value, (int, float)) else None
+
+    def asString(self):
+        return self.value if isinstance(self.value, str) else None
+
+    def asFile(self):
+        return JsonPersistFile(json.dumps(self.value).encode("utf-8")) if self.isObject() else None
+
+
+class Profile(object):
+    """
+    Save profile folder (profile_0 ... profile_8). Each persist file is decoded on first access only.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.__files = {}
+
+    def persist(self, name):
+        """
+        @return root field of persist.<name>.json, or None if the file is missing or not valid.
+        """
+        if name not in self.__files:
+            try:
+                self.__files[name] = PersistFile.open(os.path.join(self.path, "persist.{}.json".format(name))).root()
+            except (OSError, ValueError):
+                self.__files[name] = None
+        return self.__files[name]
+
+    def estateName(self):
+        field = self.__find("game", "base_root/estatename")
+        return field.asString() if field is not None else None
+
+    def appliedMods(self):
+        """
+        @return list of (source, id) of the mods (user generated content) the profile was saved with.
+        """
+        mods = []
+        field = self.__find("game", "base_root/applied_ugcs_1_0")
+        for name, entry in field.children() if field is not None else []:
+            modId = entry.child("name")
+            source = entry.child("source")
+            if modId is not None:
+                mods.append((source.asString() if source is not None else "", modId.asString()))
+        return mods
+
+    def dependencies(self):
+        """
+        @return set of the keys (see ModCatalog.key()) of the mods the profile was saved with, entries whose
+            name or source is not a string are skipped.
+        """
+        return set(modId if source.lower() == "steam" else "folder:" + modId.lower()
+                   for source, modId in self.appliedMods()
+                   if isinstance(source, str) and isinstance(modId, str) and modId)
+
+    def estate(self):
+        """
+        @return dict currency -> amount of the estate wallet.
+        """
+        wallet = {}
+        field = self.__find("estate", "base_root/wallet")
+        for name, entry in field.children() if field is not None else []:
+            if entry.isObject():
+                currency, amount = entry.child("type"), entry.child("amount")
+                if currency is not None and amount is not None:
+                    wallet[currency.asString()] = amount.asInt()
+            else:
+                wallet[name] = entry.asInt()
+        return wallet
+
+    def roster(self):
+        """
+        @return list of (hero id, name, class) of the roster, name and class are None when they can not be read.
+        """
+        heroes = []
+        field = self.__find("roster", "base_root/heroes")
+        for heroId, hero in field.children() if field is not None else []:
+            rawData = hero.find("hero_file_data/raw_data")
+            heroFile = rawData.asFile() if rawData is not None else None
+            heroRoot = heroFile.root() if heroFile is not None else hero.find("hero_file_data/raw_data")
+            name = heroRoot.find("base_root/actor/name") if heroRoot is not None else None
+            heroClass = heroRoot.find("base_root/heroClass") if heroRoot is not None else None
+            heroes.append((heroId, name.asString() if name is not None else None,
+                           heroClass.asString() if heroClass is not None else None))
+        return heroes
+
+    def __find(self, persistName, path):
+        root = self.persist(persistName)
+        return root.find(path) if root is not None else None
+
+
+def listProfiles(savesPath):
+    """
+    @return list of Profile of the profile_* folders of a saves folder, nothing is read from them yet.
+    """
+    try:
+        folders = [entry for entry in os.scandir(savesPath) if entry.is_dir() and entry.name.lower().startswith("profile_")]
+    except OSError:
+        return []
+    folders.sort(key=lambda entry: (len(entry.name), entry.name))
+    return [Profile(entry.path) for entry in folders]
+
+
+def lastPlayedProfile(profiles):
+    """
+    @return the Profile whose persist.game.json was written last, or None.
+    """
+    candidates = []
+    for index, profile in enumerate(profiles):
+        try:
+            candidates.append((os.stat(os.path.join(profile.path, "persist.game.json")).st_mtime_ns, index))
+        except OSError:
+            pass
+    return profiles[max(candidates)[1]] if candidates else None
+
+
+def steamSavesPath(steamRoots):
+    """
+    @return the remote folder of the most recently used Steam account having Darkest Dungeon saves, or None.
+    """
+    candidates = []
+    for root in steamRoots:
+        try:
+            users = list(os.scandir(os.path.join(root, "userdata")))
+        except OSError:
+            continue
+        for user in users:
+            remote = os.path.join(user.path, APP_ID, "remote")
+            try:
+                candidates.append((os.stat(remote).st_mtime, remote))
+            except OSError:
+                pass
+    return max(candidates)[1] if candidates else None
@@ -0,0 +1,178 @@
+"""
+Content addressed deduplication of identical mod files.
+
+Files are hashed with gamesupport.hashing, whose cache only lets files with a new size or
+modification time be hashed again. Files with the same content are then replaced by hardlinks
+(or reflinks where the filesystem supports them) to a single copy.
+"""
+
+import os
+import sys
+import threading
+
+from .cache import cacheFile
+from .hashing import FileHasher, HashCache
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# FICLONE from linux/fs.h
+FICLONE = 0x40049409
+
+HARDLINK = "hardlink"
+REFLINK = "reflink"
+
+
+def reflink(source, destination):
+    """
+    @brief create destination as a copy-on-write clone of source.
+    @return False if the platform or the filesystem does not support it.
+    """
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+    try:
+        with open(source, "rb") as sourceFile, open(destination, "wb") as destinationFile:
+            fcntl.ioctl(destinationFile.fileno(), FICLONE, sourceFile.fileno())
+        return True
+    except OSError:
+        if os.path.exists(destination):
+            os.remove(destination)
+        return False
+
+
+class DeduplicatingStore(object):
+    """
+    Index of the files under a set of folders by content.
+    @note hardlinked files share their content, a mod editing one of them edits all of them.
+    """
+    def __init__(self, indexPath, minimumSize=4096, workers=None):
+        """
+        @param indexPath file in which the hashes are persisted between runs.
+        @param minimumSize smaller files are ignored, linking them saves next to nothing.
+        @param workers number of hashing threads.
+        """
+        self.__cache = HashCache(indexPath)
+        self.__hasher = FileHasher(self.__cache, workers)
+        self.__minimumSize = minimumSize
+        self.__files = {}
+
+    def scan(self, roots):
+        """
+        @brief index the files under roots, hashing only new or modified files.
+        @return number of files that were hashed.
+        """
+        files = []
+        for root in roots:
+            for directory, dirs, names in os.walk(root):
+                for name in names:
+                    path = os.path.join(directory, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    if stat.st_size >= self.__minimumSize:
+                        files.append((path, stat))
+        cached = sum(1 for path, stat in files if self.__cache.get(path, stat) is not None)
+        digests = self.__hasher.hashFiles(files)
+        self.__files = {path: (stat.st_size, digests[path]) for path, stat in files if path in digests}
+        self.__cache.prune(self.__files)
+        self.__cache.save()
+        return len(files) - cached
+
+    def duplicates(self):
+        """
+        @return dict of (size, hash) -> list of paths, for every content present more than once.
+        """
+        groups = {}
+        for path, key in self.__files.items():
+            groups.setdefault(key, []).append(path)
+        return {key: sorted(paths) for key, paths in groups.items() if len(paths) > 1}
+
+    def deduplicate(self, mode=HARDLINK):
+        """
+        @brief replace every duplicate by a link to the first file with the same content.
+        @param mode HARDLINK or REFLINK, reflinks fall back to hardlinks when not supported.
+        @return (number of files replaced, bytes saved)
+        """
+        replaced = 0
+        saved = 0
+        for (size, digest), paths in self.duplicates().items():
+            source = paths[0]
+            for path in paths[1:]:
+                try:
+                    if os.path.samefile(source, path):
+                        continue
+                    self.__link(source, path, mode)
+                    self.__cache.set(path, os.stat(path), digest)
+                except OSError:
+                    continue
+                replaced += 1
+                saved += size
+        self.__cache.save()
+        return replaced, saved
+
+    def __link(self, source, path, mode):
+        temporary = path + ".dedup"
+        if mode == REFLINK and reflink(source, temporary):
+            os.replace(temporary, path)
+            return
+        os.link(source, temporary)
+        try:
+            os.replace(temporary, path)
+        except OSError:
+            os.remove(temporary)
+            raise
+
+
+def isManaged(organizer, game):
+    """
+    @return true if game is the game managed by the current instance. Callbacks like onAboutToRun fire for
+        every game plugin, the plugins check this before doing anything.
+    """
+    managedGame = organizer.managedGame()
+    return managedGame is not None and managedGame.name() == game.name()
+
+
+class ModDeduplicator(object):
+    """
+    Opt-in feature of a game plugin replacing identical files of the installed mods (and overwrite) by links
+    to a single copy, enabled by its deduplicate_mods setting, deduplicate_mode being the link type.
+    Modlists ship the same textures and sounds in many mods, this reclaims that space.
+    organizer and game are the mobase.IOrganizer and mobase.IPluginGame of the plugin.
+    """
+    def __init__(self, organizer, game, info=None):
+        """
+        @param info callable logging a message, e.g. qInfo.
+        """
+        self.__organizer = organizer
+        self.__game = game
+        self.__info = info or (lambda message: None)
+        self.__thread = None
+
+    def isEnabled(self):
+        return isManaged(self.__organizer, self.__game) and \
+            bool(self.__organizer.pluginSetting(self.__game.name(), "deduplicate_mods"))
+
+    def start(self):
+        """
+        @brief run the deduplication on a background thread, unless one is already running.
+        """
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+        self.__thread = threading.Thread(target=self.run,
+            name="mod deduplication: {}".format(self.__game.gameShortName()), daemon=True)
+        self.__thread.start()
+
+    def run(self):
+        """
+        @return (number of files replaced by links, bytes saved)
+        """
+        modsPath = self.__organizer.modsPath()
+        store = DeduplicatingStore(cacheFile("dedup", modsPath))
+        hashed = store.scan([modsPath, self.__organizer.overwritePath()])
+        replaced, saved = store.deduplicate(self.__organizer.pluginSetting(self.__game.name(), "deduplicate_mode") or HARDLINK)
+        self.__info("Deduplication hashed {} files and replaced {} duplicates, saving {:.1f} MiB".format(
+            hashed, replaced, saved / (1024 * 1024)))
+        return replaced, saved
@@ -0,0 +1,383 @@
+"""
+Incremental deployment of mod files into a game folder.
+
+A deployment is described by the files it wants in the target folder (relative target path -> source file).
+The manifest of the previous deployment records what was deployed from where, so a new deployment only
+adds, removes or replaces the files whose source changed instead of recreating every file.
+Files are placed with hardlinks, symlinks, reflinks or copies, in batches on a thread pool since creating
+links is mostly waiting for the filesystem.
+InstanceDeployment keeps the manifests of a game in the instance folder, one per target folder, so every
+profile of the instance shares them.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from .dedup import reflink
+
+HARDLINK = "hardlink"
+SYMLINK = "symlink"
+REFLINK = "reflink"
+COPY = "copy"
+METHODS = (HARDLINK, SYMLINK, REFLINK, COPY)
+
+# results of the placement of a single target
+_PLACED = "placed"
+_BACKED_UP = "backed up"
+_KEPT = "kept"
+_SKIPPED = "skipped"
+_FAILED = "failed"
+
+
+class DeploymentPlan(object):
+    """
+    Difference between the previous deployment and the desired one.
+    add and replace are lists of (target, source), remove is a list of targets.
+    """
+    def __init__(self, add=None, remove=None, replace=None, desired=None):
+        self.add = add or []
+        self.remove = remove or []
+        self.replace = replace or []
+        self.desired = desired or {}
+
+    def isEmpty(self):
+        return not (self.add or self.remove or self.replace)
+
+    def __repr__(self):
+        return "DeploymentPlan(add={}, remove={}, replace={})".format(len(self.add), len(self.remove), len(self.replace))
+
+
+class DeploymentManifest(object):
+    """
+    Files of the last deployment, target -> (source, source size, source mtime_ns), persisted as json.
+    Also records the target folder, the method the files were placed with, the targets whose original file
+    was moved to the backup folder and the directories created by the deployment.
+    """
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.target = None
+        self.method = None
+        self.backups = set()
+        self.directories = set()
+        try:
+            with open(path, "r", encoding="utf-8") as manifestFile:
+                data = json.load(manifestFile)
+            if data.get("version") == self.VERSION:
+                self.entries = {target: tuple(entry) for target, entry in data["files"].items()}
+                self.target = data.get("target")
+                self.method = data.get("method")
+                self.backups = set(data.get("backups", []))
+                self.directories = set(data.get("directories", []))
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temporary = self.path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as manifestFile:
+            json.dump({"version": self.VERSION, "target": self.target, "method": self.method, "files": self.entries,
+                "backups": sorted(self.backups), "directories": sorted(self.directories)}, manifestFile)
+        os.replace(temporary, self.path)
+
+
+def planDeployment(manifest, desired, method=None):
+    """
+    @param manifest DeploymentManifest of the previous deployment.
+    @param desired dict target -> source of the files that should be deployed.
+    @param method placement method of the new deployment, files placed with another method are all replaced.
+    @return DeploymentPlan, desired is completed with the (size, mtime_ns) of each source.
+    """
+    plan = DeploymentPlan()
+    methodChanged = method is not None and manifest.method is not None and manifest.method != method
+    for target, source in desired.items():
+        try:
+            stat = os.stat(source)
+        except OSError:
+            continue
+        entry = (source, stat.st_size, stat.st_mtime_ns)
+        plan.desired[target] = entry
+        previous = manifest.entries.get(target)
+        if previous is None:
+            plan.add.append((target, source))
+        elif methodChanged or tuple(previous) != entry:
+            plan.replace.append((target, source))
+    plan.remove = [target for target in manifest.entries if target not in plan.desired]
+    return plan
+
+
+class Deployer(object):
+    """
+    Applies DeploymentPlans to a target folder. Links fall back to copies, e.g. across filesystems, and
+    symlinks and reflinks fall back to hardlinks first.
+    Files in the target folder that were not deployed by the Deployer are never overwritten, unless a backup
+    folder is given: they are then moved there and put back when their target is removed, so undeploy()
+    leaves the target folder as it was before the first deployment.
+    """
+    BATCH_SIZE = 256
+
+    def __init__(self, targetRoot, manifestPath, method=HARDLINK, backupRoot=None, workers=None):
+        """
+        @param backupRoot folder the replaced files of the target folder are moved to, None to skip them.
+        @param workers number of threads placing and removing files.
+        """
+        self.targetRoot = targetRoot
+        self.manifest = DeploymentManifest(manifestPath)
+        self.method = method
+        self.backupRoot = backupRoot
+        self.__workers = workers or min(16, (os.cpu_count() or 2) + 4)
+
+    def plan(self, desired):
+        return planDeployment(self.manifest, desired, self.method)
+
+    def apply(self, plan):
+        """
+        @return list of targets that were skipped because a file not deployed by us is in the way,
+            or that could not be placed.
+        """
+        manifest = self.manifest
+        skipped = []
+        for target, removed in self.__run(self.__removeTarget, plan.remove):
+            if removed:
+                del manifest.entries[target]
+        placements = plan.replace + plan.add
+        self.__createDirectories(target for target, source in placements)
+        for (target, source), status in self.__run(self.__placeTarget, placements):
+            if status in (_PLACED, _BACKED_UP):
+                manifest.entries[target] = plan.desired[target]
+                if status == _BACKED_UP:
+                    manifest.backups.add(target)
+            elif status != _KEPT:
+                skipped.append(target)
+                manifest.entries.pop(target, None)
+        if self.backupRoot is not None:
+            manifest.backups = set(target for target in manifest.backups if os.path.lexists(self.backupPath(target)))
+        if plan.remove or skipped:
+            self.__removeDirectories()
+        manifest.target = self.targetRoot
+        manifest.method = self.method
+        manifest.save()
+        return skipped
+
+    def deploy(self, desired):
+        plan = self.plan(desired)
+        if plan.isEmpty():
+            return plan, []
+        return plan, self.apply(plan)
+
+    def undeploy(self):
+        """
+        @brief remove every deployed file, put back the files they replaced and remove the directories
+            created by the deployment.
+        @return (DeploymentPlan, list of targets that could not be removed)
+        """
+        plan = self.plan({})
+        self.apply(plan)
+        return plan, [target for target in plan.remove if target in self.manifest.entries]
+
+    def targetPath(self, target):
+        return os.path.join(self.targetRoot, *target.split("/"))
+
+    def backupPath(self, target):
+        if self.backupRoot is None:
+            return None
+        return os.path.join(self.backupRoot, *target.split("/"))
+
+    def __run(self, function, items):
+        """
+        @return list of (item, function(item)), items being processed in batches on the thread pool.
+        """
+        if len(items) <= self.BATCH_SIZE:
+            return [(item, function(item)) for item in items]
+        batches = [items[start:start + self.BATCH_SIZE] for start in range(0, len(items), self.BATCH_SIZE)]
+        with ThreadPoolExecutor(max_workers=self.__workers) as executor:
+            results = executor.map(lambda batch: [(item, function(item)) for item in batch], batches)
+            return [result for batch in results for result in batch]
+
+    def __removeTarget(self, target):
+        """
+        @return True if the deployed file is gone, its backup being restored if there is one.
+        """
+        try:
+            path = self.targetPath(target)
+            if os.path.lexists(path):
+                os.remove(path)
+            if target in self.manifest.backups:
+                self.__restore(target)
+        except OSError:
+            return False
+        return True
+
+    def __placeTarget(self, placement):
+        target, source = placement
+        path = self.targetPath(target)
+        backedUp = False
+        if target in self.manifest.entries:
+            try:
+                if os.path.lexists(path):
+                    os.remove(path)
+            except OSError:
+                return _KEPT
+        elif os.path.lexists(path):
+            if self.backupRoot is None:
+                return _SKIPPED
+            try:
+                self.__backup(target)
+            except OSError:
+                return _SKIPPED
+            backedUp = True
+        try:
+            self.__place(source, path)
+        except OSError:
+            if backedUp or target in self.manifest.backups:
+                try:
+                    self.__restore(target)
+                except OSError:
+                    pass
+            return _FAILED
+        return _BACKED_UP if backedUp else _PLACED
+
+    def __place(self, source, path):
+        if self.method == SYMLINK:
+            try:
+                os.symlink(source, path)
+                return
+            except OSError:
+                pass
+        elif self.method == REFLINK and reflink(source, path):
+            return
+        if self.method != COPY:
+            try:
+                os.link(source, path)
+                return
+            except OSError:
+                pass
+        shutil.copy2(source, path)
+
+    def __backup(self, target):
+        backupPath = self.backupPath(target)
+        os.makedirs(os.path.dirname(backupPath), exist_ok=True)
+        shutil.move(self.targetPath(target), backupPath)
+
+    def __restore(self, target):
+        backupPath = self.backupPath(target)
+        if backupPath is not None and os.path.lexists(backupPath):
+            shutil.move(backupPath, self.targetPath(target))
+
+    def __createDirectories(self, targets):
+        """
+        @brief create the parent folders of targets, recording the ones that did not exist.
+        """
+        parents = set(target.rpartition("/")[0] for target in targets)
+        for parent in sorted(parents):
+            missing = []
+            directory = parent
+            while not os.path.isdir(self.targetPath(directory)):
+                missing.append(directory)
+                if not directory:
+                    break
+                directory = directory.rpartition("/")[0]
+            for directory in reversed(missing):
+                try:
+                    if directory:
+                        os.mkdir(self.targetPath(directory))
+                    else:
+                        # the target folder itself may be missing too, e.g. a configuration folder
+                        os.makedirs(self.targetPath(directory))
+                except FileExistsError:
+                    continue
+                except OSError:
+                    break
+                self.manifest.directories.add(directory)
+
+    def __removeDirectories(self):
+        """
+        @brief remove the created folders that are now empty, deepest first.
+        """
+        depth = lambda directory: directory.count("/") + bool(directory)
+        for directory in sorted(self.manifest.directories, key=depth, reverse=True):
+            path = self.targetPath(directory)
+            try:
+                os.rmdir(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+            self.manifest.directories.discard(directory)
+
+
+class InstanceDeployment(object):
+    """
+    Deployments of a game to one or more target folders. The manifest and the backup folder of each target
+    folder are in <instance>/deployment/<game>/<hash of the target folder>, shared by all the profiles:
+    switching profiles only applies the difference, and files deployed for another profile are removed
+    instead of being left behind.
+    """
+    MANIFEST_NAME = "manifest.json"
+    BACKUP_NAME = "backup"
+
+    def __init__(self, instancePath, gameShortName):
+        self.__path = os.path.join(instancePath, "deployment", gameShortName)
+
+    def path(self):
+        return self.__path
+
+    def deployer(self, folder, method=HARDLINK):
+        path = os.path.join(self.__path, self.__key(folder))
+        return Deployer(folder, os.path.join(path, self.MANIFEST_NAME), method, os.path.join(path, self.BACKUP_NAME))
+
+    def deployers(self, method=HARDLINK):
+        """
+        @return dict target folder -> Deployer, for the folders deployed to before.
+        """
+        folders = set()
+        try:
+            for name in os.listdir(self.__path):
+                target = DeploymentManifest(os.path.join(self.__path, name, self.MANIFEST_NAME)).target
+                if target:
+                    folders.add(target)
+        except OSError:
+            pass
+        return {folder: self.deployer(folder, method) for folder in folders}
+
+    def plan(self, desired, method=HARDLINK):
+        """
+        @param desired dict target folder -> dict target path -> source file.
+        @return dict target folder -> DeploymentPlan, against the previous deployment of each folder.
+        """
+        return {folder: deployer.plan(desired.get(folder, {})) for folder, deployer in self.__deployers(desired, method).items()}
+
+    def deploy(self, desired, method=HARDLINK):
+        """
+        @param desired dict target folder -> dict target path -> source file.
+        @return dict target folder -> (DeploymentPlan, list of targets skipped because they could not be placed),
+            the folders deployed to before that are not in desired are emptied.
+        """
+        return {folder: deployer.deploy(desired.get(folder, {})) for folder, deployer in self.__deployers(desired, method).items()}
+
+    def undeploy(self):
+        """
+        @brief remove the deployed files of every target folder and put back the files they replaced.
+        @return dict target folder -> (DeploymentPlan, list of targets that could not be removed)
+        """
+        return {folder: deployer.undeploy() for folder, deployer in self.deployers().items()}
+
+    def __deployers(self, desired, method):
+        """
+        @return dict target folder -> Deployer for the folders of desired and the folders deployed to before,
+            a folder spelled differently than in its manifest getting a single Deployer.
+        """
+        deployers = dict((self.__key(folder), (folder, deployer)) for folder, deployer in self.deployers(method).items())
+        for folder in desired:
+            if folder:
+                deployers[self.__key(folder)] = (folder, self.deployer(folder, method))
+        return dict(deployers.values())
+
+    @staticmethod
+    def __key(folder):
+        return hashlib.sha1(os.path.normcase(os.path.abspath(folder)).encode("utf-8")).hexdigest()[:16]
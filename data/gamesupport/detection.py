@@ -0,0 +1,361 @@
+"""
+Detection of installed games from a single scan of the Steam libraries.
+
+Every game plugin used to open its own registry key to find the game. With many games this means
+as many lookups, so the detector takes all the games at once, reads the library folders and the
+app manifests once and answers for every game in a single pass.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+from . import registry
+from .cache import cacheDirectory
+
+
+def parseVdf(text):
+    """
+    @brief parse the Valve KeyValues text format used by libraryfolders.vdf and appmanifest_*.acf.
+    @return nested dicts, keys are lower case as Steam itself is not consistent about casing.
+    """
+    root = {}
+    stack = [root]
+    key = None
+    i = 0
+    length = len(text)
+    while i < length:
+        c = text[i]
+        if c.isspace():
+            i += 1
+        elif c == "/" and text.startswith("//", i):
+            newline = text.find("\n", i)
+            i = length if newline < 0 else newline + 1
+        elif c == "{":
+            child = {}
+            if key is not None:
+                stack[-1][key] = child
+                key = None
+            stack.append(child)
+            i += 1
+        elif c == "}":
+            if len(stack) > 1:
+                stack.pop()
+            i += 1
+        else:
+            if c == '"':
+                i += 1
+                token = []
+                while i < length and text[i] != '"':
+                    if text[i] == "\\" and i + 1 < length:
+                        i += 1
+                        token.append({"n": "\n", "t": "\t"}.get(text[i], text[i]))
+                    else:
+                        token.append(text[i])
+                    i += 1
+                i += 1
+                token = "".join(token)
+            else:
+                start = i
+                while i < length and not text[i].isspace() and text[i] not in '{}"':
+                    i += 1
+                token = text[start:i]
+            if key is None:
+                key = token.lower()
+            else:
+                stack[-1][key] = token
+                key = None
+    return root
+
+
+def readVdf(path):
+    try:
+        with open(path, "r", encoding="utf-8", errors="replace") as vdfFile:
+            return parseVdf(vdfFile.read())
+    except OSError:
+        return {}
+
+
+def defaultSteamRoots():
+    """
+    @return list of existing Steam installation folders for the current platform.
+    """
+    candidates = []
+    if sys.platform == "win32":
+        values = registry.queryValues([
+            (registry.HKEY_CURRENT_USER, "Software\\Valve\\Steam", "SteamPath"),
+            (registry.HKEY_LOCAL_MACHINE, "SOFTWARE\\WOW6432Node\\Valve\\Steam", "InstallPath"),
+            (registry.HKEY_LOCAL_MACHINE, "SOFTWARE\\Valve\\Steam", "InstallPath")])
+        candidates += [value for value in values.values() if isinstance(value, str)]
+    home = os.path.expanduser("~")
+    if sys.platform == "darwin":
+        candidates.append(os.path.join(home, "Library", "Application Support", "Steam"))
+    elif sys.platform != "win32":
+        candidates += [
+            os.path.join(home, ".steam", "steam"),
+            os.path.join(home, ".local", "share", "Steam"),
+            os.path.join(home, ".var", "app", "com.valvesoftware.Steam", ".local", "share", "Steam"),
+            ]
+    roots = []
+    seen = set()
+    for candidate in candidates:
+        if not candidate or not os.path.isdir(os.path.join(candidate, "steamapps")):
+            continue
+        real = os.path.normcase(os.path.realpath(candidate))
+        if real not in seen:
+            seen.add(real)
+            roots.append(candidate)
+    return roots
+
+
+def steamLibraries(steamRoots):
+    """
+    @brief list the library folders of the given Steam installations, the installations included.
+    Handles both the old ("1" "path") and new ("1" { "path" "..." }) libraryfolders.vdf layouts.
+    """
+    libraries = []
+    seen = set()
+
+    def add(path):
+        real = os.path.normcase(os.path.realpath(path))
+        if real not in seen and os.path.isdir(os.path.join(path, "steamapps")):
+            seen.add(real)
+            libraries.append(path)
+
+    for root in steamRoots:
+        add(root)
+        folders = readVdf(os.path.join(root, "steamapps", "libraryfolders.vdf")).get("libraryfolders", {})
+        for key, value in folders.items():
+            if not key.isdigit():
+                continue
+            if isinstance(value, dict):
+                value = value.get("path", "")
+            if value:
+                add(value)
+    return libraries
+
+
+class GameDetector(object):
+    """
+    Resolves many games against one scan of the Steam libraries and of additional search folders.
+    Games are given as (key, steamAppId, binaryName) tuples, key being anything hashable identifying the game.
+    The library listing is done once per detector, so detect() may be called again for other games cheaply.
+    """
+    def __init__(self, steamRoots=None, searchPaths=None, useRegistry=True):
+        """
+        @param steamRoots Steam installation folders, detected from the system if None.
+        @param searchPaths folders whose subfolders are checked for the binary of games not found on Steam,
+            e.g. a GOG games folder.
+        @param useRegistry whether the Windows uninstall keys are used for games not found in the libraries.
+        """
+        self.__steamRoots = steamRoots
+        self.__searchPaths = searchPaths or []
+        self.__useRegistry = useRegistry
+        self.__manifests = None
+        self.__searchFolders = None
+
+    def detect(self, games):
+        """
+        @return dict of key -> game folder for every game that was found.
+        """
+        manifests = self.__libraryManifests()
+        result = {}
+        remaining = []
+        for key, appId, binary in games:
+            path = None
+            appId = str(appId or "")
+            if appId in manifests:
+                path = self.__installPath(*manifests[appId])
+            if path is None and appId and self.__useRegistry:
+                path = self.__registryPath(appId)
+            if path is not None and self.__hasBinary(path, binary):
+                result[key] = path
+            elif binary:
+                remaining.append((key, binary))
+        if remaining:
+            for folder in self.__folders():
+                for key, binary in list(remaining):
+                    if self.__hasBinary(folder, binary):
+                        result[key] = folder
+                        remaining.remove((key, binary))
+                if not remaining:
+                    break
+        return result
+
+    def steamLibraries(self):
+        if self.__steamRoots is None:
+            self.__steamRoots = defaultSteamRoots()
+        return steamLibraries(self.__steamRoots)
+
+    def __libraryManifests(self):
+        """
+        @return dict appId -> (library, manifest path), built from one listing of every steamapps folder.
+        """
+        if self.__manifests is None:
+            self.__manifests = {}
+            for library in self.steamLibraries():
+                steamapps = os.path.join(library, "steamapps")
+                try:
+                    entries = list(os.scandir(steamapps))
+                except OSError:
+                    continue
+                for entry in entries:
+                    name = entry.name.lower()
+                    if name.startswith("appmanifest_") and name.endswith(".acf"):
+                        self.__manifests.setdefault(name[len("appmanifest_"):-len(".acf")], (library, entry.path))
+        return self.__manifests
+
+    def __installPath(self, library, manifestPath):
+        installDir = readVdf(manifestPath).get("appstate", {}).get("installdir")
+        if not installDir:
+            return None
+        path = os.path.join(library, "steamapps", "common", installDir)
+        return path if os.path.isdir(path) else None
+
+    def __registryPath(self, appId):
+        path = registry.queryValue(registry.HKEY_LOCAL_MACHINE,
+            "SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Uninstall\\Steam App {}".format(appId), "InstallLocation",
+            appId=appId)
+        if not isinstance(path, str) or not path:
+            return None
+        path = registry.nativePath(path)
+        return path if os.path.isdir(path) else None
+
+    def __folders(self):
+        if self.__searchFolders is None:
+            self.__searchFolders = []
+            for searchPath in self.__searchPaths:
+                try:
+                    self.__searchFolders += [entry.path for entry in os.scandir(searchPath) if entry.is_dir()]
+                except OSError:
+                    pass
+        return self.__searchFolders
+
+    @staticmethod
+    def __hasBinary(path, binary):
+        return not binary or os.path.isfile(os.path.join(path, binary))
+
+
+_cachedAnswersLock = threading.Lock()
+
+
+def cachedAnswersPath():
+    return os.path.join(cacheDirectory("detection"), "answers.json")
+
+
+def _readCachedAnswers(path):
+    try:
+        with open(path, "r", encoding="utf-8") as answersFile:
+            answers = json.load(answersFile)
+    except (OSError, ValueError):
+        return {}
+    return answers if isinstance(answers, dict) else {}
+
+
+def existingPaths(answer):
+    """
+    @return true if answer is an existing path, or a dict whose values are all existing paths.
+    """
+    if isinstance(answer, dict):
+        return all(isinstance(path, str) and os.path.exists(path) for path in answer.values())
+    return isinstance(answer, str) and bool(answer) and os.path.exists(answer)
+
+
+class BackgroundDetection(object):
+    """
+    Runs a detection function on a daemon thread, so that isInstalled() does not block MO2's UI thread
+    on slow network drives or sleeping disks. The last answer is kept on disk between sessions: while
+    it is still valid it is returned right away and the detection only refreshes it for the next calls,
+    otherwise isInstalled() waits on the detection for a short time only. The cached answer is validated
+    on the detection thread too, since checking that its folders exist can block as long as the detection.
+    """
+    TIMEOUT = 1.0
+
+    def __init__(self, key, function, cachePath=None, isValid=existingPaths):
+        """
+        @param key name of the answer in the cache, usually the plugin name.
+        @param function callable returning a json serializable answer, None when nothing was found.
+        @param cachePath file of the cached answers, shared by every detection by default.
+        @param isValid callable telling whether a cached answer can still be used, e.g. its folder exists.
+        """
+        self.__key = key
+        self.__function = function
+        self.__cachePath = cachePath
+        self.__isValid = isValid
+        self.__future = None
+        self.__lock = threading.Lock()
+        self.__validCached = None
+        self.__cacheChecked = threading.Event()
+
+    def start(self):
+        """
+        @brief start the detection if it was not started yet.
+        @return the future of the answer.
+        """
+        with self.__lock:
+            if self.__future is None:
+                self.__future = Future()
+                thread = threading.Thread(target=self.__run, name="detection: {}".format(self.__key))
+                thread.daemon = True
+                thread.start()
+            return self.__future
+
+    def result(self, timeout=None):
+        """
+        @return the detected answer once the detection is done. Before that, the cached answer if the
+            detection thread found it still valid, else the answer if the detection finishes within timeout
+            (TIMEOUT by default). None if there is neither. Nothing is checked on the calling thread.
+        """
+        future = self.start()
+        timeout = self.TIMEOUT if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        if not future.done() and self.__cacheChecked.wait(timeout) and self.__validCached is not None:
+            return self.__validCached
+        try:
+            return future.result(max(0, deadline - time.monotonic()))
+        except Exception:
+            return self.__validCached
+
+    def cached(self):
+        """
+        @return the answer of the last completed detection, possibly from a previous session.
+        """
+        try:
+            path = self.__answersPath()
+        except OSError:
+            return None
+        with _cachedAnswersLock:
+            return _readCachedAnswers(path).get(self.__key)
+
+    def __answersPath(self):
+        return self.__cachePath or cachedAnswersPath()
+
+    def __run(self):
+        try:
+            cached = self.cached()
+            if cached is not None and self.__isValid(cached):
+                self.__validCached = cached
+        except Exception:
+            pass
+        finally:
+            self.__cacheChecked.set()
+        try:
+            answer = self.__function()
+        except Exception as e:
+            self.__future.set_exception(e)
+            return
+        self.__future.set_result(answer)
+        try:
+            with _cachedAnswersLock:
+                path = self.__answersPath()
+                answers = _readCachedAnswers(path)
+                if answers.get(self.__key) != answer:
+                    answers[self.__key] = answer
+                    with open(path + ".tmp", "w", encoding="utf-8") as answersFile:
+                        json.dump(answers, answersFile)
+                    os.replace(path + ".tmp", path)
+        except OSError:
+            pass
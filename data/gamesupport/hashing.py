@@ -0,0 +1,179 @@
+"""
+Parallel hashing of many files with a persistent cache.
+
+Large files are hashed through mmap, small files are read with a single call and grouped in batches
+so that the thread pool is not flooded with tiny tasks. hashlib releases the GIL while hashing, so
+threads are enough to use every core. Digests are cached by (path, size, mtime_ns) and only computed
+again for files that changed.
+"""
+
+import hashlib
+import mmap
+import os
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_ALGORITHM = "blake2b"
+
+
+def newHash(algorithm=DEFAULT_ALGORITHM):
+    if algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=20)
+    return hashlib.new(algorithm)
+
+
+def hashBytes(data, algorithm=DEFAULT_ALGORITHM):
+    digest = newHash(algorithm)
+    digest.update(data)
+    return digest.hexdigest()
+
+
+def hashFile(path, size=None, algorithm=DEFAULT_ALGORITHM, mmapThreshold=4 * 1024 * 1024):
+    """
+    @brief hash a single file, through mmap when it is at least mmapThreshold bytes.
+    """
+    digest = newHash(algorithm)
+    with open(path, "rb") as hashedFile:
+        if size is None:
+            size = os.fstat(hashedFile.fileno()).st_size
+        if size > 0 and size >= mmapThreshold:
+            with mmap.mmap(hashedFile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                digest.update(mapped)
+        elif size > 0:
+            digest.update(hashedFile.read())
+    return digest.hexdigest()
+
+
+class HashCache(object):
+    """
+    Digests keyed by path, valid as long as the size and mtime_ns of the file are unchanged.
+    """
+    VERSION = 1
+
+    def __init__(self, path=None, algorithm=DEFAULT_ALGORITHM):
+        """
+        @param path file the cache is persisted to, None for an in-memory cache.
+        """
+        self.__path = path
+        self.__algorithm = algorithm
+        self.__entries = {}
+        self.__dirty = False
+        self.__lock = threading.Lock()
+        if path is not None:
+            self.__load()
+
+    def get(self, path, stat):
+        entry = self.__entries.get(path)
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        return None
+
+    def set(self, path, stat, digest):
+        with self.__lock:
+            self.__entries[path] = (stat.st_size, stat.st_mtime_ns, digest)
+            self.__dirty = True
+
+    def prune(self, paths):
+        """
+        @brief forget every file not in paths.
+        """
+        paths = set(paths)
+        with self.__lock:
+            removed = [path for path in self.__entries if path not in paths]
+            for path in removed:
+                del self.__entries[path]
+            self.__dirty = self.__dirty or bool(removed)
+
+    def save(self):
+        if self.__path is None or not self.__dirty:
+            return
+        with self.__lock:
+            temporary = self.__path + ".tmp"
+            with open(temporary, "wb") as cacheFile:
+                pickle.dump((self.VERSION, self.__algorithm, self.__entries), cacheFile, pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary, self.__path)
+            self.__dirty = False
+
+    def __load(self):
+        try:
+            with open(self.__path, "rb") as cacheFile:
+                version, algorithm, entries = pickle.load(cacheFile)
+        except Exception:
+            return
+        if version == self.VERSION and algorithm == self.__algorithm:
+            self.__entries = entries
+
+
+class FileHasher(object):
+    """
+    Hashes lists of files on a thread pool, going through a HashCache.
+    """
+    def __init__(self, cache=None, workers=None, algorithm=DEFAULT_ALGORITHM,
+            mmapThreshold=4 * 1024 * 1024, smallFileSize=256 * 1024, batchBytes=8 * 1024 * 1024):
+        """
+        @param cache HashCache to use, a private in-memory one if None.
+        @param workers number of hashing threads.
+        @param mmapThreshold files of at least this size are hashed through mmap.
+        @param smallFileSize files below this size are grouped in batches of about batchBytes.
+        """
+        self.cache = cache if cache is not None else HashCache(algorithm=algorithm)
+        self.__workers = workers or min(16, (os.cpu_count() or 2) + 4)
+        self.__algorithm = algorithm
+        self.__mmapThreshold = mmapThreshold
+        self.__smallFileSize = smallFileSize
+        self.__batchBytes = batchBytes
+
+    def hashFiles(self, files):
+        """
+        @param files iterable of paths or of (path, os.stat_result) tuples.
+        @return dict path -> hex digest, files that could not be read are left out.
+        """
+        result = {}
+        pending = []
+        for item in files:
+            path, stat = item if isinstance(item, tuple) else (item, None)
+            if stat is None:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+            digest = self.cache.get(path, stat)
+            if digest is None:
+                pending.append((path, stat))
+            else:
+                result[path] = digest
+        if pending:
+            with ThreadPoolExecutor(self.__workers) as executor:
+                for batch in executor.map(self.__hashBatch, self.__batches(pending)):
+                    for path, stat, digest in batch:
+                        self.cache.set(path, stat, digest)
+                        result[path] = digest
+        return result
+
+    def __batches(self, pending):
+        batch = []
+        batchSize = 0
+        for path, stat in pending:
+            if stat.st_size >= self.__smallFileSize:
+                yield [(path, stat)]
+                continue
+            batch.append((path, stat))
+            batchSize += stat.st_size
+            if batchSize >= self.__batchBytes or len(batch) >= 1024:
+                yield batch
+                batch = []
+                batchSize = 0
+        if batch:
+            yield batch
+
+    def __hashBatch(self, batch):
+        result = []
+        for path, stat in batch:
+            try:
+                result.append((path, stat, hashFile(path, stat.st_size, self.__algorithm, self.__mmapThreshold)))
+            except (OSError, ValueError):
+                # ValueError is raised when mmapping a file that was emptied in the meantime
+                pass
+        return result
+
@@ -0,0 +1,151 @@
+"""
+Resolution of the Windows known folders (Documents, AppData...) a game uses, including when the game
+runs through Proton or Wine, where they live inside the prefix instead of the home folder.
+
+Resolving a prefix means looking at a few folders, so the result is computed once for each
+(game path, app id) and reused by every later lookup.
+"""
+
+import functools
+import getpass
+import os
+import sys
+
+DOCUMENTS = "Documents"
+ROAMING_APPDATA = "RoamingAppData"
+LOCAL_APPDATA = "LocalAppData"
+SAVED_GAMES = "SavedGames"
+PROFILE = "Profile"
+
+# known folder ids for SHGetKnownFolderPath
+FOLDER_IDS = {
+    DOCUMENTS: "{FDD39AD0-238F-46AF-ADB4-6C85480369C7}",
+    ROAMING_APPDATA: "{3EB685DB-65F9-4CF6-A03A-E3EF65729F3D}",
+    LOCAL_APPDATA: "{F1B32785-6FBA-4FCF-9D55-7B8E7F157091}",
+    SAVED_GAMES: "{4C5C32FF-BB9D-43B0-B5B4-2D72E54EAAA4}",
+    PROFILE: "{5E6C858F-0E22-4760-9AFE-EA3317B67173}",
+}
+
+# location of the folders relative to the user folder of a prefix, the first existing one is used,
+# older Wine versions create the Windows XP names
+PREFIX_FOLDERS = {
+    DOCUMENTS: ["Documents", "My Documents"],
+    ROAMING_APPDATA: ["AppData/Roaming", "Application Data"],
+    LOCAL_APPDATA: ["AppData/Local", "Local Settings/Application Data"],
+    SAVED_GAMES: ["Saved Games"],
+    PROFILE: [""],
+}
+
+
+def windowsKnownFolder(folder):
+    import ctypes
+    from ctypes import wintypes
+
+    class GUID(ctypes.Structure):
+        _fields_ = [("Data1", wintypes.DWORD), ("Data2", wintypes.WORD), ("Data3", wintypes.WORD), ("Data4", wintypes.BYTE * 8)]
+
+    guid = GUID()
+    ctypes.oledll.ole32.CLSIDFromString(ctypes.c_wchar_p(FOLDER_IDS[folder]), ctypes.byref(guid))
+    path = ctypes.c_wchar_p()
+    try:
+        ctypes.oledll.shell32.SHGetKnownFolderPath(ctypes.byref(guid), 0, None, ctypes.byref(path))
+        return path.value
+    except OSError:
+        return None
+    finally:
+        ctypes.windll.ole32.CoTaskMemFree(path)
+
+
+def findPrefix(gamePath, appId=None):
+    """
+    @brief find the Wine prefix the game runs in.
+    @return (prefix folder, Windows user name) or (None, None) if the game does not run in a prefix.
+    """
+    if gamePath:
+        path = os.path.normpath(os.path.abspath(gamePath))
+        # a game installed inside a prefix, e.g. ~/.wine/drive_c/Games/Game
+        parts = path.split(os.sep)
+        lowerParts = [part.lower() for part in parts]
+        if "drive_c" in lowerParts:
+            prefix = os.sep.join(parts[:lowerParts.index("drive_c")]) or os.sep
+            return prefix, prefixUser(prefix)
+        # a Steam game, Proton uses steamapps/compatdata/<appid>/pfx of the library of the game
+        if appId and "steamapps" in lowerParts:
+            steamapps = os.sep.join(parts[:len(lowerParts) - lowerParts[::-1].index("steamapps")])
+            prefix = os.path.join(steamapps, "compatdata", str(appId), "pfx")
+            if os.path.isdir(prefix):
+                return prefix, "steamuser"
+        # the default prefix, only when the game is inside it (e.g. through a dosdevices link), a native
+        # game must not get the folders of an unrelated prefix
+        prefix = os.getenv("WINEPREFIX") or os.path.join(os.path.expanduser("~"), ".wine")
+        if os.path.isdir(os.path.join(prefix, "drive_c")):
+            realPrefix = os.path.realpath(prefix)
+            if os.path.commonpath([realPrefix, os.path.realpath(path)]) == realPrefix:
+                return prefix, prefixUser(prefix)
+    return None, None
+
+
+def prefixUser(prefix):
+    users = os.path.join(prefix, "drive_c", "users")
+    for name in ("steamuser", getpass.getuser()):
+        if os.path.isdir(os.path.join(users, name)):
+            return name
+    return getpass.getuser()
+
+
+class KnownFolders(object):
+    """
+    Known folders for one game, use KnownFolders.forGame() to share the instances.
+    """
+    def __init__(self, gamePath=None, appId=None):
+        self.prefix = None
+        self.user = None
+        if sys.platform != "win32":
+            self.prefix, self.user = findPrefix(gamePath, appId)
+        self.__paths = {}
+
+    @staticmethod
+    @functools.lru_cache(maxsize=32)
+    def forGame(gamePath, appId=None):
+        return KnownFolders(gamePath, appId)
+
+    def path(self, folder):
+        """
+        @param folder one of DOCUMENTS, ROAMING_APPDATA, LOCAL_APPDATA, SAVED_GAMES or PROFILE.
+        @return absolute path of the folder, it may not exist yet.
+        """
+        if folder not in self.__paths:
+            self.__paths[folder] = self.__resolve(folder)
+        return self.__paths[folder]
+
+    def __resolve(self, folder):
+        if sys.platform == "win32":
+            path = windowsKnownFolder(folder)
+            if path:
+                return path
+        if self.prefix is not None:
+            userPath = os.path.join(self.prefix, "drive_c", "users", self.user)
+            candidates = [os.path.join(userPath, *relative.split("/")) if relative else userPath for relative in PREFIX_FOLDERS[folder]]
+            for candidate in candidates:
+                if os.path.isdir(candidate):
+                    return candidate
+            return candidates[0]
+        home = os.path.expanduser("~")
+        if sys.platform == "win32":
+            fallbacks = {
+                DOCUMENTS: os.path.join(home, "Documents"),
+                ROAMING_APPDATA: os.getenv("APPDATA") or os.path.join(home, "AppData", "Roaming"),
+                LOCAL_APPDATA: os.getenv("LOCALAPPDATA") or os.path.join(home, "AppData", "Local"),
+                SAVED_GAMES: os.path.join(home, "Saved Games"),
+                PROFILE: home,
+            }
+        else:
+            # native builds (Mono/.NET) map the special folders to the XDG folders
+            fallbacks = {
+                DOCUMENTS: os.path.join(home, "Documents"),
+                ROAMING_APPDATA: os.getenv("XDG_CONFIG_HOME") or os.path.join(home, ".config"),
+                LOCAL_APPDATA: os.getenv("XDG_DATA_HOME") or os.path.join(home, ".local", "share"),
+                SAVED_GAMES: os.path.join(home, "Saved Games"),
+                PROFILE: home,
+            }
+        return fallbacks[folder]
@@ -0,0 +1,362 @@
+"""
+KOTOR 2 helpers shared by the KOTOR 2 plugin: index of the resources of the game archives.
+
+The game resources are listed by chitin.key, which gives for every resref and type the BIF archive holding it,
+and by the key tables of the ERF/RIM containers of modules/. The index is built from memory mapped files without
+copying the tables or reading any resource payload, and cached on disk until these files change.
+"""
+
+import collections
+import mmap
+import os
+import pickle
+import struct
+
+RESOURCE_TYPES = {
+    "res": 0, "bmp": 1, "mve": 2, "tga": 3, "wav": 4, "plt": 6, "ini": 7, "mp3": 8, "mpg": 9, "txt": 10,
+    "wma": 11, "wmv": 12, "xmv": 13,
+    "plh": 2000, "tex": 2001, "mdl": 2002, "thg": 2003, "fnt": 2005, "lua": 2007, "slt": 2008, "nss": 2009,
+    "ncs": 2010, "mod": 2011, "are": 2012, "set": 2013, "ifo": 2014, "bic": 2015, "wok": 2016, "2da": 2017,
+    "tlk": 2018, "txi": 2022, "git": 2023, "bti": 2024, "uti": 2025, "btc": 2026, "utc": 2027, "dlg": 2029,
+    "itp": 2030, "btt": 2031, "utt": 2032, "dds": 2033, "bts": 2034, "uts": 2035, "ltr": 2036, "gff": 2037,
+    "fac": 2038, "bte": 2039, "ute": 2040, "btd": 2041, "utd": 2042, "btp": 2043, "utp": 2044, "dft": 2045,
+    "gic": 2046, "gui": 2047, "css": 2048, "ccs": 2049, "btm": 2050, "utm": 2051, "dwk": 2052, "pwk": 2053,
+    "btg": 2054, "utg": 2055, "jrl": 2056, "sav": 2057, "utw": 2058, "4pc": 2059, "ssf": 2060, "hak": 2061,
+    "nwm": 2062, "bik": 2063, "ndb": 2064, "ptm": 2065, "ptt": 2066, "bak": 2067,
+    "lyt": 3000, "vis": 3001, "rim": 3002, "pth": 3003, "lip": 3004, "bwm": 3005, "txb": 3006, "tpc": 3007,
+    "mdx": 3008, "rsv": 3009, "sig": 3010, "xbx": 3011,
+    "erf": 9997, "bif": 9998, "key": 9999,
+    }
+EXTENSIONS = {resourceType: extension for extension, resourceType in RESOURCE_TYPES.items()}
+
+REPLACES_VANILLA = "replaces vanilla"
+NEW = "new"
+
+KEY_HEADER = struct.Struct("<8s4I")
+KEY_FILE_ENTRY = struct.Struct("<IIHH")
+KEY_ENTRY = struct.Struct("<16sHI")
+BIF_HEADER = struct.Struct("<8s3I")
+BIF_ENTRY = struct.Struct("<4I")
+ERF_HEADER = struct.Struct("<8s4x5I")
+ERF_KEY_ENTRY = struct.Struct("<16sIH2x")
+ERF_RESOURCE_ENTRY = struct.Struct("<II")
+ERF_SIGNATURES = (b"ERF V1.0", b"MOD V1.0", b"SAV V1.0", b"HAK V1.0")
+RIM_HEADER = struct.Struct("<8s4xII")
+RIM_KEY_ENTRY = struct.Struct("<16sIIII")
+RIM_DEFAULT_KEY_OFFSET = 120
+MODULE_EXTENSIONS = (".mod", ".rim", ".erf")
+
+
+def splitResourceName(fileName):
+    """
+    @return (lower case resref, resource type) of a file name, or None if it is not a game resource.
+    """
+    stem, dot, extension = os.path.basename(fileName).rpartition(".")
+    resourceType = RESOURCE_TYPES.get(extension.lower())
+    if not dot or resourceType is None or not stem or len(stem) > 16:
+        return None
+    return stem.lower(), resourceType
+
+
+def findPath(root, relativePath):
+    """
+    @brief resolve a path of the game files ignoring case, for installs on case sensitive filesystems.
+    @return the existing path or None.
+    """
+    path = root
+    for part in relativePath.replace("\\", "/").split("/"):
+        if not part:
+            continue
+        candidate = os.path.join(path, part)
+        if not os.path.exists(candidate):
+            try:
+                candidate = next((entry.path for entry in os.scandir(path) if entry.name.lower() == part.lower()), None)
+            except OSError:
+                candidate = None
+            if candidate is None:
+                return None
+        path = candidate
+    return path
+
+
+class _MappedFile(object):
+    """
+    Read only memory map of a file with a memoryview over it, released before the map is closed.
+    """
+    def __init__(self, path):
+        self.__file = open(path, "rb")
+        try:
+            self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            self.__map = None
+        self.view = memoryview(self.__map if self.__map is not None else b"")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.view.release()
+        if self.__map is not None:
+            self.__map.close()
+        self.__file.close()
+
+
+def readKeyFile(path):
+    """
+    @return (list of BIF file names, list of (resref, resource type, resource id)) of a chitin.key.
+    @raise ValueError if the file is not a KEY V1 file.
+    """
+    with _MappedFile(path) as mapped:
+        view = mapped.view
+        if len(view) < KEY_HEADER.size:
+            raise ValueError("{} is not a key file".format(path))
+        signature, bifCount, keyCount, fileTableOffset, keyTableOffset = KEY_HEADER.unpack_from(view)
+        if signature != b"KEY V1  ":
+            raise ValueError("{} is not a key file".format(path))
+        bifs = []
+        fileTableEnd = fileTableOffset + bifCount * KEY_FILE_ENTRY.size
+        for size, nameOffset, nameSize, drives in KEY_FILE_ENTRY.iter_unpack(view[fileTableOffset:fileTableEnd]):
+            name = bytes(view[nameOffset:nameOffset + nameSize]).split(b"\0", 1)[0]
+            bifs.append(name.decode("latin-1"))
+        keys = []
+        keyTableEnd = keyTableOffset + keyCount * KEY_ENTRY.size
+        for resref, resourceType, resourceId in KEY_ENTRY.iter_unpack(view[keyTableOffset:keyTableEnd]):
+            keys.append((resref.split(b"\0", 1)[0].decode("latin-1").lower(), resourceType, resourceId))
+        return bifs, keys
+
+
+def readBifTable(path):
+    """
+    @return dict resource index -> (offset, size) of the variable resources of a BIF file.
+    """
+    with _MappedFile(path) as mapped:
+        view = mapped.view
+        if len(view) < BIF_HEADER.size:
+            return {}
+        signature, variableCount, fixedCount, tableOffset = BIF_HEADER.unpack_from(view)
+        if signature != b"BIFFV1  ":
+            return {}
+        tableEnd = tableOffset + variableCount * BIF_ENTRY.size
+        return {resourceId & 0xFFFFF: (offset, size)
+                for resourceId, offset, size, resourceType in BIF_ENTRY.iter_unpack(view[tableOffset:tableEnd])}
+
+
+def readContainerTable(path):
+    """
+    @brief read the key table of an ERF (.erf, .mod, .sav, .hak) or RIM container, payloads are never read.
+    @return list of (resref, resource type, offset, size).
+    @raise ValueError if the file is not an ERF or RIM V1.0 file.
+    """
+    with _MappedFile(path) as mapped:
+        view = mapped.view
+        signature = bytes(view[:8])
+        entries = []
+        if signature in ERF_SIGNATURES and len(view) >= ERF_HEADER.size:
+            signature, localizedSize, entryCount, localizedOffset, keyOffset, resourceOffset = ERF_HEADER.unpack_from(view)
+            for (resref, resourceId, resourceType), (offset, size) in zip(
+                    ERF_KEY_ENTRY.iter_unpack(view[keyOffset:keyOffset + entryCount * ERF_KEY_ENTRY.size]),
+                    ERF_RESOURCE_ENTRY.iter_unpack(view[resourceOffset:resourceOffset + entryCount * ERF_RESOURCE_ENTRY.size])):
+                entries.append((resref.split(b"\0", 1)[0].decode("latin-1").lower(), resourceType, offset, size))
+        elif signature == b"RIM V1.0" and len(view) >= RIM_HEADER.size:
+            signature, entryCount, keyOffset = RIM_HEADER.unpack_from(view)
+            keyOffset = keyOffset or RIM_DEFAULT_KEY_OFFSET
+            for resref, resourceType, resourceId, offset, size in RIM_KEY_ENTRY.iter_unpack(
+                    view[keyOffset:keyOffset + entryCount * RIM_KEY_ENTRY.size]):
+                entries.append((resref.split(b"\0", 1)[0].decode("latin-1").lower(), resourceType, offset, size))
+        else:
+            raise ValueError("{} is not an ERF or RIM file".format(path))
+        return entries
+
+
+def listModules(modulesPath):
+    """
+    @return sorted list of the module containers of a modules/ folder.
+    """
+    try:
+        return sorted(entry.path for entry in os.scandir(modulesPath)
+                      if entry.is_file() and entry.name.lower().endswith(MODULE_EXTENSIONS))
+    except OSError:
+        return []
+
+
+class ContainerTables(object):
+    """
+    Resource keys of container files, read again only when a file changes, for the conflict analysis of mods.
+    """
+    def __init__(self):
+        self.__tables = {}
+
+    def keys(self, path):
+        """
+        @return frozenset of (resref, resource type) of a container, empty if it can not be read.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return frozenset()
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = self.__tables.get(path)
+        if cached is None or cached[0] != signature:
+            try:
+                keys = frozenset((resref, resourceType) for resref, resourceType, offset, size in readContainerTable(path))
+            except (OSError, ValueError):
+                keys = frozenset()
+            cached = self.__tables[path] = (signature, keys)
+        return cached[1]
+
+
+ModuleConflict = collections.namedtuple("ModuleConflict", ["module", "otherMod", "kind", "resources"])
+SAME_MODULE = "same module"
+SHADOWED_BY_OVERRIDE = "shadowed by override"
+
+
+def moduleConflicts(modName, mods, tables):
+    """
+    @brief find the mods conflicting with the modules/ containers of modName.
+    @param mods list of (mod name, mod folder) of the active mods, modName included.
+    @param tables ContainerTables reused between calls.
+    @return list of ModuleConflict: SAME_MODULE when another mod ships a container of the same name (only one of
+        them is used by the game, resources are the ones of the two containers), SHADOWED_BY_OVERRIDE when the
+        override/ files of another mod replace resources of a container of modName.
+    """
+    folders = dict(mods)
+    modules = {os.path.basename(path).lower(): tables.keys(path)
+               for path in listModules(findPath(folders.get(modName, ""), "modules") or "")}
+    conflicts = []
+    if not modules:
+        return conflicts
+    for otherMod, otherPath in mods:
+        if otherMod == modName:
+            continue
+        for path in listModules(findPath(otherPath, "modules") or ""):
+            name = os.path.basename(path).lower()
+            if name in modules:
+                conflicts.append(ModuleConflict(name, otherMod, SAME_MODULE, sorted(modules[name] | tables.keys(path))))
+        override = findPath(otherPath, "override")
+        if override is None:
+            continue
+        overrideKeys = set()
+        for directory, dirs, files in os.walk(override):
+            overrideKeys.update(key for key in map(splitResourceName, files) if key is not None)
+        for name, keys in modules.items():
+            shadowed = keys & overrideKeys
+            if shadowed:
+                conflicts.append(ModuleConflict(name, otherMod, SHADOWED_BY_OVERRIDE, sorted(shadowed)))
+    return conflicts
+
+
+class ResourceIndex(object):
+    """
+    Index (resref, resource type) -> (container, offset, size) of the game resources, containers being the
+    BIF files listed by chitin.key and the containers of the game modules/ folder. A resource found in several
+    containers is indexed in the first one, BIF files first.
+    The index is cached in cachePath and rebuilt when chitin.key or a module container changes.
+    """
+    CACHE_VERSION = 2
+
+    def __init__(self, gamePath, cachePath=None):
+        self.__gamePath = gamePath
+        self.__cachePath = cachePath
+        self.__containers = []
+        self.__resources = {}
+        self.__loaded = False
+
+    def keyPath(self):
+        return findPath(self.__gamePath, "chitin.key")
+
+    def load(self):
+        """
+        @brief load the index from the cache, or build it from chitin.key and the BIF files.
+        @return self
+        """
+        if self.__loaded:
+            return self
+        self.__loaded = True
+        keyPath = self.keyPath()
+        if keyPath is None:
+            return self
+        modules = listModules(findPath(self.__gamePath, "modules") or "")
+        signature = tuple((os.path.basename(path).lower(), stat.st_mtime_ns, stat.st_size)
+                          for path, stat in ((path, os.stat(path)) for path in [keyPath] + modules))
+        if self.__cachePath is not None:
+            try:
+                with open(self.__cachePath, "rb") as cacheFile:
+                    version, cachedSignature, containers, resources = pickle.load(cacheFile)
+                if version == self.CACHE_VERSION and cachedSignature == signature:
+                    self.__containers, self.__resources = containers, resources
+                    return self
+            except Exception:
+                pass
+        self.__build(keyPath, modules)
+        if self.__cachePath is not None:
+            try:
+                with open(self.__cachePath, "wb") as cacheFile:
+                    pickle.dump((self.CACHE_VERSION, signature, self.__containers, self.__resources), cacheFile, pickle.HIGHEST_PROTOCOL)
+            except OSError:
+                pass
+        return self
+
+    def containers(self):
+        return list(self.load().__containers)
+
+    def lookup(self, resref, resourceType):
+        """
+        @return (container name, offset, size) of a resource, offset and size are None if the BIF could not be read.
+        """
+        entry = self.load().__resources.get((resref.lower(), resourceType))
+        if entry is None:
+            return None
+        container, offset, size = entry
+        return self.__containers[container], offset, size
+
+    def classify(self, fileName):
+        """
+        @return REPLACES_VANILLA if the game has a resource of the same name and type, NEW if not,
+            None for files that are not game resources.
+        """
+        key = splitResourceName(fileName)
+        if key is None:
+            return None
+        return REPLACES_VANILLA if key in self.load().__resources else NEW
+
+    def __len__(self):
+        return len(self.load().__resources)
+
+    def __build(self, keyPath, modules):
+        bifs, keys = readKeyFile(keyPath)
+        tables = []
+        for name in bifs:
+            bifPath = findPath(self.__gamePath, name)
+            try:
+                tables.append(readBifTable(bifPath) if bifPath is not None else {})
+            except (OSError, ValueError):
+                tables.append({})
+        resources = {}
+        for resref, resourceType, resourceId in keys:
+            bif = resourceId >> 20
+            if bif >= len(tables):
+                continue
+            offset, size = tables[bif].get(resourceId & 0xFFFFF, (None, None))
+            resources[(resref, resourceType)] = (bif, offset, size)
+        containers = [name.replace("\\", "/") for name in bifs]
+        for path in modules:
+            try:
+                entries = readContainerTable(path)
+            except (OSError, ValueError):
+                continue
+            containers.append("modules/" + os.path.basename(path))
+            for resref, resourceType, offset, size in entries:
+                resources.setdefault((resref, resourceType), (len(containers) - 1, offset, size))
+        self.__containers = containers
+        self.__resources = resources
+
+
+SAVE_GAME = "savegame.sav"
+
+
+def saveModules(path):
+    """
+    @return set of the module names stored in a SAVEGAME.sav, each visited module is saved as a nested .sav.
+    """
+    return set(resref for resref, resourceType, offset, size in readContainerTable(path) if resourceType == RESOURCE_TYPES["sav"])
@@ -0,0 +1,542 @@
+"""
+Pure python registry reader used in place of winreg where it is not available (Linux, macOS).
+
+Two kinds of hives are supported, both read through mmap:
+    - the text hives of a Wine/Proton prefix (system.reg for HKEY_LOCAL_MACHINE, user.reg for HKEY_CURRENT_USER),
+    - binary "regf" hives (NTUSER.DAT, SOFTWARE...), attached with loadHive().
+Only the keys that are asked for are parsed, and parsed keys are cached.
+
+The module mirrors the part of the winreg interface used by the plugins, so it can be imported as
+    try:
+        import winreg
+    except ImportError:
+        from gamesupport import registry as winreg
+"""
+
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+
+HKEY_CLASSES_ROOT = 0x80000000
+HKEY_CURRENT_USER = 0x80000001
+HKEY_LOCAL_MACHINE = 0x80000002
+HKEY_USERS = 0x80000003
+
+REG_NONE = 0
+REG_SZ = 1
+REG_EXPAND_SZ = 2
+REG_BINARY = 3
+REG_DWORD = 4
+REG_DWORD_BIG_ENDIAN = 5
+REG_LINK = 6
+REG_MULTI_SZ = 7
+REG_QWORD = 11
+
+KEY_READ = 0x20019
+KEY_WOW64_64KEY = 0x0100
+KEY_WOW64_32KEY = 0x0200
+
+error = OSError
+
+
+def decodeData(dataType, data):
+    """
+    @brief convert raw value data to the python type winreg returns for dataType.
+    """
+    if dataType in (REG_SZ, REG_EXPAND_SZ, REG_LINK):
+        return data.decode("utf-16-le", "replace").split("\0", 1)[0]
+    if dataType == REG_MULTI_SZ:
+        strings = data.decode("utf-16-le", "replace").split("\0")
+        while strings and not strings[-1]:
+            strings.pop()
+        return strings
+    if dataType == REG_DWORD and len(data) >= 4:
+        return struct.unpack_from("<I", data)[0]
+    if dataType == REG_DWORD_BIG_ENDIAN and len(data) >= 4:
+        return struct.unpack_from(">I", data)[0]
+    if dataType == REG_QWORD and len(data) >= 8:
+        return struct.unpack_from("<Q", data)[0]
+    return bytes(data)
+
+
+class TextHive(object):
+    """
+    Wine text hive. Only the section headers are located up front (a single scan of the mapped file),
+    the values of a key are parsed the first time the key is opened.
+    """
+    HEADER = re.compile(rb"^\[(.+?)\](?:[ \t]+\d+)?[ \t]*\r?$", re.MULTILINE)
+    ESCAPE = re.compile(r"\\(x[0-9a-fA-F]{1,4}|.)")
+    VALUE_NAME = re.compile(r'^(@|"((?:[^"\\]|\\.)*)")=(.*)$', re.DOTALL)
+
+    def __init__(self, path):
+        self.path = path
+        self.__file = open(path, "rb")
+        self.__data = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.__sections = None
+        self.__keys = {}
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def unescape(cls, text):
+        def replace(match):
+            escaped = match.group(1)
+            if escaped[0] == "x" and len(escaped) > 1:
+                return chr(int(escaped[1:], 16))
+            return {"n": "\n", "r": "\r", "t": "\t", "0": "\0"}.get(escaped, escaped)
+        return cls.ESCAPE.sub(replace, text)
+
+    def values(self, keyPath):
+        """
+        @return dict lower case value name -> (name, value, type), or None if the key does not exist.
+        The default value has the name "".
+        """
+        keyPath = keyPath.strip("\\").lower()
+        with self.__lock:
+            if keyPath in self.__keys:
+                return self.__keys[keyPath]
+            sections = self.__index()
+            section = sections.get(keyPath)
+            if section is not None:
+                values = self.__parseSection(section[1])
+            elif not keyPath or any(name.startswith(keyPath + "\\") for name in sections):
+                # keys without values may only appear as the parent of other keys
+                values = {}
+            else:
+                values = None
+            self.__keys[keyPath] = values
+            return values
+
+    def subkeys(self, keyPath):
+        """
+        @return sorted list of the direct subkey names of keyPath.
+        """
+        prefix = keyPath.strip("\\").lower()
+        prefix = prefix + "\\" if prefix else ""
+        with self.__lock:
+            sections = self.__index()
+        names = {}
+        for lowerName, (name, start) in sections.items():
+            if lowerName.startswith(prefix) and len(lowerName) > len(prefix):
+                child = name[len(prefix):].split("\\", 1)[0]
+                names.setdefault(child.lower(), child)
+        return sorted(names.values())
+
+    def __index(self):
+        """
+        @return dict lower case key path -> (key path, offset of its values), built on first use.
+        """
+        if self.__sections is None:
+            self.__sections = {}
+            for match in self.HEADER.finditer(self.__data):
+                name = self.unescape(match.group(1).decode("utf-8", "replace"))
+                self.__sections.setdefault(name.lower(), (name, match.end()))
+        return self.__sections
+
+    def __parseSection(self, start):
+        end = self.__data.find(b"\n[", start)
+        text = self.__data[start:len(self.__data) if end < 0 else end].decode("utf-8", "replace")
+        # values can continue on the next line after a trailing backslash
+        text = re.sub(r"\\\r?\n[ \t]*", "", text)
+        values = {}
+        for line in text.splitlines():
+            match = self.VALUE_NAME.match(line.strip())
+            if match is None:
+                continue
+            name = "" if match.group(1) == "@" else self.unescape(match.group(2))
+            parsed = self.__parseValue(match.group(3))
+            if parsed is not None:
+                values[name.lower()] = (name, parsed[0], parsed[1])
+        return values
+
+    def __parseValue(self, text):
+        if text.startswith('"') and text.endswith('"'):
+            return self.unescape(text[1:-1]), REG_SZ
+        if text.startswith('str(') and ':"' in text and text.endswith('"'):
+            dataType = int(text[4:text.index(")")], 16)
+            value = self.unescape(text[text.index(':"') + 2:-1])
+            if dataType == REG_MULTI_SZ:
+                return [part for part in value.split("\0") if part], dataType
+            return value, dataType
+        if text.startswith("dword:"):
+            return int(text[6:], 16), REG_DWORD
+        if text.startswith("hex"):
+            dataType = REG_BINARY
+            if text.startswith("hex("):
+                dataType = int(text[4:text.index(")")], 16)
+            hexData = text[text.index(":") + 1:].replace(",", "").replace(" ", "")
+            try:
+                return decodeData(dataType, bytes.fromhex(hexData)), dataType
+            except ValueError:
+                return None
+        return None
+
+    def close(self):
+        self.__data.close()
+        self.__file.close()
+
+
+class BinaryHive(object):
+    """
+    Windows "regf" hive. Cells are read in place from the mapped file, only the nk/vk cells along the
+    requested key path are visited.
+    """
+    BASE = 0x1000
+    KEY_COMP_NAME = 0x0020
+    VALUE_COMP_NAME = 0x0001
+
+    def __init__(self, path):
+        self.path = path
+        self.__file = open(path, "rb")
+        self.__data = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.__view = memoryview(self.__data)
+        if self.__view[0:4] != b"regf":
+            self.close()
+            raise OSError("{} is not a registry hive".format(path))
+        self.__root = struct.unpack_from("<I", self.__view, 0x24)[0]
+        self.__nodes = {"": self.__root}
+        self.__keys = {}
+        self.__lock = threading.Lock()
+
+    def __cell(self, offset):
+        """
+        @return memoryview of the data of the cell at offset (relative to the first hbin).
+        """
+        start = self.BASE + offset
+        size = abs(struct.unpack_from("<i", self.__view, start)[0])
+        return self.__view[start + 4:start + size]
+
+    def __name(self, cell, lengthOffset, nameOffset, compressed):
+        length = struct.unpack_from("<H", cell, lengthOffset)[0]
+        raw = bytes(cell[nameOffset:nameOffset + length])
+        return raw.decode("latin-1") if compressed else raw.decode("utf-16-le", "replace")
+
+    def __keyName(self, nodeOffset):
+        cell = self.__cell(nodeOffset)
+        flags = struct.unpack_from("<H", cell, 0x02)[0]
+        return self.__name(cell, 0x48, 0x4C, flags & self.KEY_COMP_NAME)
+
+    def __subkeyOffsets(self, listOffset):
+        cell = self.__cell(listOffset)
+        signature = bytes(cell[0:2])
+        count = struct.unpack_from("<H", cell, 2)[0]
+        if signature in (b"lf", b"lh"):
+            return [struct.unpack_from("<I", cell, 4 + 8 * i)[0] for i in range(count)]
+        if signature == b"li":
+            return [struct.unpack_from("<I", cell, 4 + 4 * i)[0] for i in range(count)]
+        if signature == b"ri":
+            offsets = []
+            for i in range(count):
+                offsets += self.__subkeyOffsets(struct.unpack_from("<I", cell, 4 + 4 * i)[0])
+            return offsets
+        return []
+
+    def __subkeys(self, nodeOffset):
+        cell = self.__cell(nodeOffset)
+        count, listOffset = struct.unpack_from("<I", cell, 0x14)[0], struct.unpack_from("<I", cell, 0x1C)[0]
+        if not count or listOffset == 0xFFFFFFFF:
+            return []
+        return self.__subkeyOffsets(listOffset)
+
+    def __node(self, keyPath):
+        if keyPath in self.__nodes:
+            return self.__nodes[keyPath]
+        parent, sep, name = keyPath.rpartition("\\")
+        parentNode = self.__node(parent)
+        node = None
+        if parentNode is not None:
+            for offset in self.__subkeys(parentNode):
+                if self.__keyName(offset).lower() == name:
+                    node = offset
+                    break
+        self.__nodes[keyPath] = node
+        return node
+
+    def values(self, keyPath):
+        keyPath = keyPath.strip("\\").lower()
+        with self.__lock:
+            if keyPath in self.__keys:
+                return self.__keys[keyPath]
+            node = self.__node(keyPath)
+            values = None if node is None else self.__values(node)
+            self.__keys[keyPath] = values
+            return values
+
+    def subkeys(self, keyPath):
+        with self.__lock:
+            node = self.__node(keyPath.strip("\\").lower())
+            if node is None:
+                return []
+            return sorted(self.__keyName(offset) for offset in self.__subkeys(node))
+
+    def __values(self, nodeOffset):
+        cell = self.__cell(nodeOffset)
+        count, listOffset = struct.unpack_from("<II", cell, 0x24)
+        values = {}
+        if not count or listOffset == 0xFFFFFFFF:
+            return values
+        offsets = self.__cell(listOffset)
+        for i in range(count):
+            valueCell = self.__cell(struct.unpack_from("<I", offsets, 4 * i)[0])
+            if bytes(valueCell[0:2]) != b"vk":
+                continue
+            size, dataOffset, dataType, flags = struct.unpack_from("<IIIH", valueCell, 0x04)
+            name = self.__name(valueCell, 0x02, 0x14, flags & self.VALUE_COMP_NAME)
+            if size & 0x80000000:
+                data = bytes(valueCell[0x08:0x08 + (size & 0x7FFFFFFF)])
+            else:
+                data = self.__valueData(dataOffset, size)
+            values[name.lower()] = (name, decodeData(dataType, data), dataType)
+        return values
+
+    def __valueData(self, offset, size):
+        cell = self.__cell(offset)
+        if size > 16344 and bytes(cell[0:2]) == b"db":
+            # big data, the value is split in segments
+            count, segmentsOffset = struct.unpack_from("<HI", cell, 2)
+            segments = self.__cell(segmentsOffset)
+            data = b"".join(bytes(self.__cell(struct.unpack_from("<I", segments, 4 * i)[0])[:16344]) for i in range(count))
+            return data[:size]
+        return bytes(cell[:size])
+
+    def close(self):
+        self.__view.release()
+        self.__data.close()
+        self.__file.close()
+
+
+class HKEYType(object):
+    """
+    Open key, returned by OpenKey(). Usable as a context manager like winreg keys.
+    """
+    def __init__(self, hive, path, values):
+        self.hive = hive
+        self.path = path
+        self.values = values
+
+    def Close(self):
+        self.values = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.Close()
+
+
+_hives = {}
+_hivesLock = threading.Lock()
+_prefix = None
+# app ids whose default prefix was looked for, None for the Wine prefixes only
+_searchedAppIds = set()
+
+
+def loadHive(hkey, path):
+    """
+    @brief use the hive file at path for the root key hkey, a text (.reg) or binary (.dat) hive.
+    """
+    with open(path, "rb") as hiveFile:
+        isBinary = hiveFile.read(4) == b"regf"
+    hive = BinaryHive(path) if isBinary else TextHive(path)
+    with _hivesLock:
+        previous = _hives.get(hkey)
+        _hives[hkey] = hive
+    if previous is not None:
+        previous.close()
+    return hive
+
+
+def setPrefix(prefix):
+    """
+    @brief use the hives of the Wine/Proton prefix.
+    """
+    global _prefix
+    _prefix = prefix
+    for hkey, name in ((HKEY_LOCAL_MACHINE, "system.reg"), (HKEY_CURRENT_USER, "user.reg")):
+        path = os.path.join(prefix, name)
+        if os.path.isfile(path):
+            loadHive(hkey, path)
+
+
+def defaultPrefix(appId=None):
+    """
+    @return the Wine prefix read when no hive was loaded: $WINEPREFIX, ~/.wine, then the Proton prefix of
+        the Steam game appId in every Steam library, or None if none of them has a system.reg.
+    """
+    candidates = [os.getenv("WINEPREFIX"), os.path.join(os.path.expanduser("~"), ".wine")]
+    if appId:
+        # detection reads the registry on Windows, it can only be imported once this module is
+        from .detection import defaultSteamRoots, steamLibraries
+        candidates += [os.path.join(library, "steamapps", "compatdata", str(appId), "pfx")
+                       for library in steamLibraries(defaultSteamRoots())]
+    for prefix in candidates:
+        if prefix and os.path.isfile(os.path.join(prefix, "system.reg")):
+            return prefix
+    return None
+
+
+def hive(hkey, appId=None):
+    """
+    @return the hive of the root key, loading the hives of defaultPrefix(appId) while none is loaded.
+        Each app id is only looked for once.
+    """
+    with _hivesLock:
+        search = not _hives and appId not in _searchedAppIds
+        _searchedAppIds.add(appId)
+    if search:
+        prefix = defaultPrefix(appId)
+        if prefix is not None:
+            setPrefix(prefix)
+    return _hives.get(hkey)
+
+
+def nativePath(path):
+    """
+    @brief convert a Windows path read from the registry of a prefix to the matching native path.
+    Paths are returned unchanged on Windows or when they do not start with a drive letter.
+    """
+    if sys.platform == "win32" or not re.match(r"^[A-Za-z]:", path):
+        return path
+    hive(HKEY_LOCAL_MACHINE)
+    if _prefix is None:
+        return path
+    parts = [part for part in re.split(r"[\\/]+", path[2:]) if part]
+    drive = os.path.join(_prefix, "dosdevices", path[0].lower() + ":")
+    if not os.path.isdir(drive):
+        drive = os.path.join(_prefix, "drive_" + path[0].lower())
+    return os.path.join(os.path.realpath(drive), *parts)
+
+
+def wow64Path(path):
+    """
+    @return the key of HKEY_LOCAL_MACHINE seen by 32 bit applications for path: the keys of Software are
+        redirected to Software\\Wow6432Node on 64 bit Windows, except Software\\Classes which is shared.
+    """
+    parts = path.strip("\\").split("\\", 2)
+    if parts[0].lower() != "software" or (len(parts) > 1 and parts[1].lower() in ("wow6432node", "classes")):
+        return path
+    return "\\".join([parts[0], "Wow6432Node"] + parts[1:])
+
+
+def OpenKey(key, subKey, reserved=0, access=KEY_READ):
+    """
+    @param access KEY_WOW64_32KEY opens the 32 bit view of HKEY_LOCAL_MACHINE, as winreg does. Wine hives
+        contain both views, keys that are missing from Wow6432Node are shared by both views.
+    """
+    if isinstance(key, HKEYType):
+        source, path = key.hive, key.path + "\\" + subKey.strip("\\")
+        paths = [path]
+    else:
+        source, path = hive(key), subKey.strip("\\")
+        paths = [path]
+        if key == HKEY_LOCAL_MACHINE and access & KEY_WOW64_32KEY and wow64Path(path) != path:
+            paths.insert(0, wow64Path(path))
+    if source is None:
+        raise FileNotFoundError(2, "No hive for the root key", subKey)
+    for path in paths:
+        values = source.values(path)
+        if values is not None:
+            return HKEYType(source, path, values)
+    raise FileNotFoundError(2, "The system cannot find the file specified", subKey)
+
+
+OpenKeyEx = OpenKey
+
+
+def QueryValueEx(key, valueName):
+    if key.values is None:
+        raise OSError("The key is closed")
+    entry = key.values.get((valueName or "").lower())
+    if entry is None:
+        raise FileNotFoundError(2, "The system cannot find the file specified", valueName)
+    return entry[1], entry[2]
+
+
+def EnumKey(key, index):
+    names = key.hive.subkeys(key.path)
+    if index >= len(names):
+        raise OSError(259, "No more data is available")
+    return names[index]
+
+
+def CloseKey(key):
+    key.Close()
+
+
+try:
+    import winreg as _winreg
+except ImportError:
+    _winreg = sys.modules[__name__]
+
+_rootHandles = {}
+_queryCache = {}
+_queryLock = threading.Lock()
+
+
+def _rootHandle(hkey):
+    """
+    @return the handle of a root key, opened once and shared by every query.
+    """
+    if hkey not in _rootHandles:
+        if _winreg is sys.modules[__name__]:
+            _rootHandles[hkey] = hkey
+        else:
+            _rootHandles[hkey] = _winreg.ConnectRegistry(None, hkey)
+    return _rootHandles[hkey]
+
+
+def queryValues(queries, appId=None):
+    """
+    @brief read many values at once, each key is opened a single time.
+    Uses winreg where available and the hives of this module otherwise. Results, including missing keys
+    and values, are cached for the session so that every plugin probing the same values shares them.
+    @param queries iterable of (root key, key path, value name).
+    @param appId Steam app id of the game asking, without winreg its Proton prefix is read when there is
+        no Wine prefix, see defaultPrefix().
+    @return dict (root key, key path, value name) -> value with its python type (str, int, list, bytes),
+        or None for missing keys and values.
+    """
+    result = {}
+    byKey = {}
+    if _winreg is sys.modules[__name__]:
+        hive(HKEY_LOCAL_MACHINE, appId)
+    with _queryLock:
+        for query in queries:
+            hkey, keyPath, valueName = query
+            cacheKey = (hkey, keyPath.strip("\\").lower(), (valueName or "").lower())
+            if cacheKey in _queryCache:
+                result[query] = _queryCache[cacheKey]
+            else:
+                byKey.setdefault((hkey, keyPath), []).append((query, cacheKey))
+        for (hkey, keyPath), pending in byKey.items():
+            try:
+                key = _winreg.OpenKey(_rootHandle(hkey), keyPath.strip("\\"))
+            except OSError:
+                key = None
+            for query, cacheKey in pending:
+                value = None
+                if key is not None:
+                    try:
+                        value = _winreg.QueryValueEx(key, query[2])[0]
+                    except OSError:
+                        pass
+                _queryCache[cacheKey] = value
+                result[query] = value
+            if key is not None:
+                _winreg.CloseKey(key)
+    return result
+
+
+def queryValue(hkey, keyPath, valueName, default=None, appId=None):
+    """
+    @brief read a single value through queryValues().
+    """
+    value = queryValues([(hkey, keyPath, valueName)], appId)[(hkey, keyPath, valueName)]
+    return default if value is None else value
+
+
+def clearQueryCache():
+    with _queryLock:
+        _queryCache.clear()
@@ -0,0 +1,87 @@
+"""
+Mods a save depends on, compared with the mods enabled in the current profile.
+
+The game specific part is a function listing the dependency ids of a save (mod added types, mod ids,
+modules...). Its result is cached per save file size and modification time, so checking hundreds of saves
+again only reads the saves that changed.
+"""
+
+import os
+import pickle
+import time
+
+
+class SaveDependencyCache(object):
+    """
+    Dependency ids of save files, extracted again only when a save changes.
+    """
+    CACHE_VERSION = 1
+    SAVE_INTERVAL = 2.0
+
+    def __init__(self, cachePath=None):
+        self.__cachePath = cachePath
+        self.__entries = {}
+        self.__dirty = False
+        self.__lastSave = 0.0
+        if cachePath is not None:
+            try:
+                with open(cachePath, "rb") as cacheFile:
+                    version, entries = pickle.load(cacheFile)
+                if version == self.CACHE_VERSION:
+                    self.__entries = entries
+            except Exception:
+                pass
+
+    def dependencies(self, path, extract):
+        """
+        @param path save file.
+        @param extract function path -> iterable of dependency ids, called when the save is not cached.
+        @return frozenset of the dependency ids of the save, empty if it can not be read.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return frozenset()
+        signature = (stat.st_size, stat.st_mtime_ns)
+        cached = self.__entries.get(path)
+        if cached is None or cached[0] != signature:
+            try:
+                dependencies = frozenset(extract(path))
+            except (OSError, ValueError):
+                dependencies = frozenset()
+            cached = self.__entries[path] = (signature, dependencies)
+            self.__dirty = True
+            if time.monotonic() - self.__lastSave > self.SAVE_INTERVAL:
+                self.save()
+        return cached[1]
+
+    def save(self):
+        """
+        @brief write the cache, dropping the saves that no longer exist. Writes are otherwise throttled.
+        """
+        self.__lastSave = time.monotonic()
+        if not self.__dirty or self.__cachePath is None:
+            return
+        self.__dirty = False
+        self.__entries = {path: entry for path, entry in self.__entries.items() if os.path.exists(path)}
+        try:
+            with open(self.__cachePath, "wb") as cacheFile:
+                pickle.dump((self.CACHE_VERSION, self.__entries), cacheFile, pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            pass
+
+
+def missingDependencies(dependencies, providers, enabledMods):
+    """
+    @param dependencies iterable of the dependency ids of a save.
+    @param providers dict dependency id -> list of the mods providing it, enabled or not.
+    @param enabledMods set of the enabled mods, including pseudo mods for content always available.
+    @return dict dependency id -> list of the mods providing it, for the dependencies no enabled mod provides.
+        The list is empty for dependencies that no installed mod provides.
+    """
+    missing = {}
+    for dependency in dependencies:
+        mods = providers.get(dependency, ())
+        if enabledMods.isdisjoint(mods):
+            missing[dependency] = list(mods)
+    return missing
@@ -0,0 +1,408 @@
+"""
+Stardew Valley helpers shared by the Stardew Valley plugin.
+"""
+
+import collections
+import json
+import mmap
+import os
+import pickle
+import re
+
+
+def parseJson(data):
+    """
+    @brief parse json the way SMAPI does, allowing comments and trailing commas.
+    @param data bytes or str, a utf-8 BOM is ignored.
+    @raise ValueError if the content is not valid json.
+    """
+    if isinstance(data, bytes):
+        data = data.decode("utf-8-sig", "replace")
+    elif data.startswith("\ufeff"):
+        data = data[1:]
+    result = []
+    i = 0
+    length = len(data)
+    start = 0
+    while i < length:
+        c = data[i]
+        if c == '"':
+            i += 1
+            while i < length and data[i] != '"':
+                i += 2 if data[i] == "\\" else 1
+            i += 1
+        elif c == "/" and data.startswith("//", i):
+            result.append(data[start:i])
+            newline = data.find("\n", i)
+            i = length if newline < 0 else newline
+            start = i
+        elif c == "/" and data.startswith("/*", i):
+            result.append(data[start:i])
+            end = data.find("*/", i + 2)
+            i = length if end < 0 else end + 2
+            start = i
+        elif c == ",":
+            j = i + 1
+            while j < length and data[j].isspace():
+                j += 1
+            if j < length and data[j] in "}]":
+                result.append(data[start:i])
+                start = i + 1
+            i += 1
+        else:
+            i += 1
+    result.append(data[start:])
+    return json.loads("".join(result))
+
+
+MANIFEST = "manifest.json"
+CONTENT_PATCHER = "pathoschild.contentpatcher"
+CONTENT = "content.json"
+
+LOAD = "load"
+INCLUDE = "include"
+HARD = "hard"
+SOFT = "soft"
+
+ModManifest = collections.namedtuple("ModManifest", ["mod", "folder", "uniqueId", "name", "contentPackFor"])
+AssetAction = collections.namedtuple("AssetAction", ["mod", "uniqueId", "action", "file"])
+AssetConflict = collections.namedtuple("AssetConflict", ["asset", "kind", "actions"])
+
+
+class JsonFileCache(object):
+    """
+    Parsed json files, parsed again only when their size or modification time changes.
+    Files that no longer exist are dropped when the cache is saved.
+    """
+    CACHE_VERSION = 1
+
+    def __init__(self, cachePath=None):
+        self.__cachePath = cachePath
+        self.__files = {}
+        self.__dirty = False
+        if cachePath is not None:
+            try:
+                with open(cachePath, "rb") as cacheFile:
+                    version, files = pickle.load(cacheFile)
+                if version == self.CACHE_VERSION:
+                    self.__files = files
+            except Exception:
+                pass
+
+    def get(self, path):
+        """
+        @return the parsed content of a json file, None if it is missing or not valid.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        signature = (stat.st_size, stat.st_mtime_ns)
+        cached = self.__files.get(path)
+        if cached is None or cached[0] != signature:
+            try:
+                with open(path, "rb") as jsonFile:
+                    content = parseJson(jsonFile.read())
+            except (OSError, ValueError):
+                content = None
+            cached = self.__files[path] = (signature, content)
+            self.__dirty = True
+        return cached[1]
+
+    def save(self):
+        if not self.__dirty or self.__cachePath is None:
+            return
+        self.__dirty = False
+        self.__files = {path: entry for path, entry in self.__files.items() if os.path.exists(path)}
+        try:
+            with open(self.__cachePath, "wb") as cacheFile:
+                pickle.dump((self.CACHE_VERSION, self.__files), cacheFile, pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            pass
+
+
+def findModFolders(root, maxDepth=3):
+    """
+    @return the folders under root containing a manifest.json, SMAPI does not look inside those nor in hidden folders.
+    """
+    folders = []
+    level = [root]
+    for depth in range(maxDepth):
+        nextLevel = []
+        for directory in level:
+            try:
+                entries = [entry for entry in os.scandir(directory) if entry.is_dir()]
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                if os.path.isfile(os.path.join(entry.path, MANIFEST)):
+                    folders.append(entry.path)
+                else:
+                    nextLevel.append(entry.path)
+        level = nextLevel
+    return folders
+
+
+def readManifests(mods, files):
+    """
+    @param mods list of (MO2 mod name, mod folder).
+    @param files JsonFileCache.
+    @return list of ModManifest of the SMAPI mods of the given MO2 mods.
+    """
+    manifests = []
+    for mod, modPath in mods:
+        for folder in findModFolders(modPath):
+            manifest = files.get(os.path.join(folder, MANIFEST))
+            if not isinstance(manifest, dict):
+                continue
+            contentPackFor = manifest.get("ContentPackFor")
+            if isinstance(contentPackFor, dict):
+                contentPackFor = str(contentPackFor.get("UniqueID", "")).lower()
+            manifests.append(ModManifest(mod, folder, str(manifest.get("UniqueID", "")),
+                                         str(manifest.get("Name", os.path.basename(folder))), contentPackFor or ""))
+    return manifests
+
+
+def normalizeAsset(name):
+    name = name.strip().replace("\\", "/").strip("/")
+    if name.lower().endswith(".xnb"):
+        name = name[:-4]
+    return name.lower()
+
+
+def splitList(value):
+    """
+    @return the elements of a comma separated Content Patcher field, tokens are kept as they are.
+    """
+    if isinstance(value, list):
+        value = ",".join(str(element) for element in value)
+    return [element.strip() for element in str(value or "").split(",") if element.strip()]
+
+
+class ContentPatcherIndex(object):
+    """
+    Index asset -> actions of the Content Patcher packs, from their content.json and the files it includes.
+    Only the files that changed since they were parsed by the JsonFileCache are parsed again.
+    """
+    MAX_INCLUDE_DEPTH = 16
+
+    def __init__(self, files):
+        """
+        @param files JsonFileCache, usually the one the manifests were read with.
+        """
+        self.__files = files
+        self.__assets = {}
+
+    def index(self, manifests):
+        """
+        @param manifests list of ModManifest, the ones that are not Content Patcher packs are ignored.
+        @return dict normalized asset name -> list of AssetAction.
+        """
+        assets = {}
+        for manifest in manifests:
+            if manifest.contentPackFor != CONTENT_PATCHER:
+                continue
+            pending = [(CONTENT, 0)]
+            seen = set()
+            while pending:
+                relativePath, depth = pending.pop()
+                path = os.path.normpath(os.path.join(manifest.folder, relativePath))
+                if path in seen or depth > self.MAX_INCLUDE_DEPTH:
+                    continue
+                seen.add(path)
+                content = self.__files.get(path)
+                changes = content.get("Changes") if isinstance(content, dict) else None
+                for change in changes if isinstance(changes, list) else []:
+                    if not isinstance(change, dict):
+                        continue
+                    action = str(change.get("Action", "")).lower()
+                    if action == INCLUDE:
+                        pending += [(include, depth + 1) for include in splitList(change.get("FromFile"))]
+                        continue
+                    for target in splitList(change.get("Target")):
+                        assets.setdefault(normalizeAsset(target), []).append(
+                            AssetAction(manifest.mod, manifest.uniqueId, action, os.path.relpath(path, manifest.folder)))
+        self.__assets = assets
+        return assets
+
+    def assets(self):
+        return self.__assets
+
+    def conflicts(self):
+        """
+        @return list of AssetConflict for the assets changed by several mods: HARD when more than one of them
+            loads the asset, only one load is used, SOFT when several mods edit it, the edits are all applied
+            but may override each other.
+        """
+        conflicts = []
+        for asset, actions in sorted(self.__assets.items()):
+            if len(set(action.uniqueId for action in actions)) < 2:
+                continue
+            loads = [action for action in actions if action.action == LOAD]
+            if len(set(action.uniqueId for action in loads)) > 1:
+                conflicts.append(AssetConflict(asset, HARD, loads))
+            else:
+                edits = [action for action in actions if action.action != LOAD]
+                if len(set(action.uniqueId for action in edits)) > 1:
+                    conflicts.append(AssetConflict(asset, SOFT, edits))
+        return conflicts
+
+
+SMAPI_LOG = "SMAPI-latest.txt"
+LOG_LINE = re.compile(r"^\[(\d\d:\d\d:\d\d) (TRACE|DEBUG|INFO|ALERT|WARN|ERROR)\s+([^\]]+)\] ?(.*)$")
+ERROR = "ERROR"
+WARN = "WARN"
+
+
+class LogSummary(object):
+    """
+    Errors and warnings logged by one SMAPI mod, with the first messages of each kind.
+    """
+    MAX_MESSAGES = 5
+
+    def __init__(self):
+        self.errors = 0
+        self.warnings = 0
+        self.messages = []
+
+    def add(self, level, message):
+        if level == ERROR:
+            self.errors += 1
+        else:
+            self.warnings += 1
+        if len(self.messages) < self.MAX_MESSAGES:
+            self.messages.append((level, message))
+
+    def __repr__(self):
+        return "{} errors, {} warnings".format(self.errors, self.warnings)
+
+
+class SmapiLogAnalyzer(object):
+    """
+    Incremental reader of the SMAPI log. The read offset is remembered (and kept in statePath between sessions),
+    so each update only reads what was appended since the previous one. A new log, detected by a smaller size
+    or a different first line, is read from the start.
+    """
+    STATE_VERSION = 1
+    FINGERPRINT_SIZE = 256
+
+    def __init__(self, statePath=None):
+        self.__statePath = statePath
+        self.__reset()
+        if statePath is not None:
+            try:
+                with open(statePath, "rb") as stateFile:
+                    state = pickle.load(stateFile)
+                if state[0] == self.STATE_VERSION:
+                    version, self.__path, self.__offset, self.__fingerprint, self.__summaries = state
+            except Exception:
+                pass
+
+    def update(self, path):
+        """
+        @brief read the lines appended to the log since the last update.
+        @return dict SMAPI mod name -> LogSummary of the whole log.
+        """
+        try:
+            with open(path, "rb") as logFile:
+                fingerprint = logFile.read(self.FINGERPRINT_SIZE)
+                logFile.seek(0, os.SEEK_END)
+                size = logFile.tell()
+                if path != self.__path or size < self.__offset or fingerprint[:len(self.__fingerprint)] != self.__fingerprint:
+                    self.__reset()
+                    self.__path = path
+                self.__fingerprint = fingerprint
+                logFile.seek(self.__offset)
+                self.__read(logFile)
+        except OSError:
+            return self.__summaries
+        self.__save()
+        return self.__summaries
+
+    def summaries(self):
+        return self.__summaries
+
+    def summariesByMod(self, manifests):
+        """
+        @param manifests list of ModManifest used to map the names in the log to the MO2 mods.
+        @return dict MO2 mod name (None for SMAPI itself and unknown mods) -> dict SMAPI mod name -> LogSummary.
+        """
+        modOfName = {}
+        for manifest in manifests:
+            modOfName.setdefault(manifest.name.lower(), manifest.mod)
+            modOfName.setdefault(manifest.uniqueId.lower(), manifest.mod)
+        result = {}
+        for name, summary in self.__summaries.items():
+            result.setdefault(modOfName.get(name.lower()), {})[name] = summary
+        return result
+
+    def __read(self, logFile):
+        for line in logFile:
+            if not line.endswith(b"\n"):
+                # incomplete last line, read again next time
+                break
+            self.__offset += len(line)
+            prefix = line[:16]
+            if b" ERROR" not in prefix and b" WARN" not in prefix:
+                continue
+            match = LOG_LINE.match(line.decode("utf-8", "replace").rstrip("\r\n"))
+            if match is None:
+                # continuation of a multi line message, e.g. a stack trace
+                continue
+            level, source, message = match.group(2), match.group(3).strip(), match.group(4)
+            self.__summaries.setdefault(source, LogSummary()).add(level, message)
+
+    def __reset(self):
+        self.__path = None
+        self.__offset = 0
+        self.__fingerprint = b""
+        self.__summaries = {}
+
+    def __save(self):
+        if self.__statePath is None:
+            return
+        try:
+            with open(self.__statePath, "wb") as stateFile:
+                pickle.dump((self.STATE_VERSION, self.__path, self.__offset, self.__fingerprint, self.__summaries),
+                            stateFile, pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            pass
+
+
+SAVE_MOD_TYPE = re.compile(rb'xsi:type="(Mods_[^"]+)"')
+
+
+def saveModTypes(path):
+    """
+    @return set of the mod added types (xsi:type="Mods_...", used by SpaceCore and similar frameworks) of a save.
+    """
+    with open(path, "rb") as saveFile:
+        try:
+            data = mmap.mmap(saveFile.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return set()
+        with data:
+            return set(match.group(1).decode("utf-8", "replace") for match in SAVE_MOD_TYPE.finditer(data))
+
+
+def typeProviders(manifests):
+    """
+    @brief guess which mods provide the "Mods_<prefix>_<type>" types from their unique ids: the prefix is the
+        unique id, or its author part, with the characters not allowed in xml names replaced by "_".
+    @return function type name -> list of MO2 mod names.
+    """
+    prefixes = {}
+    for manifest in manifests:
+        uniqueId = re.sub(r"[^0-9a-z]", "_", manifest.uniqueId.lower())
+        if uniqueId:
+            prefixes.setdefault(uniqueId + "_", []).append(manifest.mod)
+            prefixes.setdefault(uniqueId.split("_", 1)[0] + "_", []).append(manifest.mod)
+
+    def providers(typeName):
+        name = typeName.lower()[len("mods_"):]
+        for prefix in sorted((prefix for prefix in prefixes if name.startswith(prefix)), key=len, reverse=True):
+            return sorted(set(prefixes[prefix]))
+        return []
+    return providers
@@ -0,0 +1,442 @@
+"""
+Thumbnails of mod textures, decoded on a thread pool and cached in memory and on disk.
+
+Thumbnails are keyed by the content hash of the image and their size, so a sprite shipped by several
+mods is decoded once and its thumbnail survives renames and reinstalls. Hashes are cached by path, size
+and modification time (gamesupport.hashing.HashCache), so an unchanged file is not read again to find its
+thumbnail. Decoded thumbnails are kept in an LRU bounded by a byte budget and written, zlib compressed,
+to the cache folder.
+
+Decoders are functions (path, maxSize) -> Thumbnail. decodeTpc reads KOTOR textures from the smallest
+mipmap that is large enough, GamePreview.decodeWithQt the formats Qt supports (PNG, TGA).
+
+GamePreview, the preview plugin of the game plugins, is only defined when mobase and PyQt5 can be imported,
+i.e. inside MO2. The rest of the module does not need them.
+"""
+
+import collections
+import os
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .cache import cacheDirectory
+from .hashing import HashCache, hashFile
+
+try:
+    import mobase
+    from PyQt5.QtCore import Qt, QCoreApplication
+    from PyQt5.QtGui import QImage, QImageReader, QPixmap
+    from PyQt5.QtWidgets import QLabel
+except ImportError:
+    mobase = None
+
+# pixels are RGBA, 4 bytes per pixel, rows top to bottom without padding
+Thumbnail = collections.namedtuple("Thumbnail", ["width", "height", "pixels"])
+
+SIZES = (64, 128, 256, 512, 1024)
+THUMBNAIL_HEADER = struct.Struct("<4sHH")
+THUMBNAIL_MAGIC = b"THB1"
+
+
+def thumbnailSize(maxSize):
+    """
+    @return the thumbnail size used for a requested size, requests are rounded up to a few sizes so that
+        previews of slightly different sizes share their thumbnails.
+    """
+    for size in SIZES:
+        if size >= maxSize:
+            return size
+    return SIZES[-1]
+
+
+def downsample(thumbnail, maxSize):
+    """
+    @return thumbnail with its largest side reduced to at most maxSize, by sampling every n-th pixel.
+    """
+    width, height, pixels = thumbnail
+    if max(width, height) <= maxSize:
+        return thumbnail
+    step = -(-max(width, height) // maxSize)
+    view = memoryview(pixels).cast("I")
+    rows = [view[y * width:(y + 1) * width:step].tobytes() for y in range(0, height, step)]
+    view.release()
+    return Thumbnail(len(range(0, width, step)), len(rows), b"".join(rows))
+
+
+TPC_HEADER = struct.Struct("<IfHHBB114x")
+TPC_GREY = 1
+TPC_RGB = 2
+TPC_RGBA = 4
+
+
+def _rgb565(color):
+    red = (color >> 11) & 0x1F
+    green = (color >> 5) & 0x3F
+    blue = color & 0x1F
+    return (red * 255 + 15) // 31, (green * 255 + 31) // 63, (blue * 255 + 15) // 31
+
+
+def _decodeDxt(data, offset, width, height, alpha):
+    """
+    @return RGBA pixels of a DXT1 (alpha False) or DXT5 (alpha True) image.
+    """
+    blocksWide = max(1, (width + 3) // 4)
+    blocksHigh = max(1, (height + 3) // 4)
+    stride = blocksWide * 16
+    output = bytearray(stride * blocksHigh * 4)
+    for blockY in range(blocksHigh):
+        for blockX in range(blocksWide):
+            alphas = None
+            if alpha:
+                alpha0, alpha1 = data[offset], data[offset + 1]
+                if alpha0 > alpha1:
+                    alphas = [alpha0, alpha1] + [((7 - i) * alpha0 + i * alpha1) // 7 for i in range(1, 7)]
+                else:
+                    alphas = [alpha0, alpha1] + [((5 - i) * alpha0 + i * alpha1) // 5 for i in range(1, 5)] + [0, 255]
+                alphaBits = int.from_bytes(data[offset + 2:offset + 8], "little")
+                offset += 8
+            color0, color1, colorBits = struct.unpack_from("<HHI", data, offset)
+            offset += 8
+            rgb0, rgb1 = _rgb565(color0), _rgb565(color1)
+            if color0 > color1 or alpha:
+                colors = [rgb0 + (255,), rgb1 + (255,),
+                    tuple((2 * a + b) // 3 for a, b in zip(rgb0, rgb1)) + (255,),
+                    tuple((a + 2 * b) // 3 for a, b in zip(rgb0, rgb1)) + (255,)]
+            else:
+                colors = [rgb0 + (255,), rgb1 + (255,), tuple((a + b) // 2 for a, b in zip(rgb0, rgb1)) + (255,), (0, 0, 0, 0)]
+            for row in range(4):
+                pixels = bytearray(16)
+                for column in range(4):
+                    pixel = 4 * row + column
+                    red, green, blue, opacity = colors[(colorBits >> (2 * pixel)) & 3]
+                    if alphas is not None:
+                        opacity = alphas[(alphaBits >> (3 * pixel)) & 7]
+                    pixels[4 * column:4 * column + 4] = (red, green, blue, opacity)
+                start = (blockY * 4 + row) * stride + blockX * 16
+                output[start:start + 16] = pixels
+    if stride != width * 4 or blocksHigh * 4 != height:
+        output = b"".join(output[y * stride:y * stride + width * 4] for y in range(height))
+    return bytes(output)
+
+
+def _expandToRgba(data, offset, width, height, channels):
+    count = width * height
+    source = data[offset:offset + count * channels]
+    output = bytearray(count * 4)
+    if channels == 1:
+        for channel in range(3):
+            output[channel::4] = source
+        output[3::4] = b"\xff" * count
+    elif channels == 3:
+        for channel in range(3):
+            output[channel::4] = source[channel::3]
+        output[3::4] = b"\xff" * count
+    else:
+        output[:] = source
+    return bytes(output)
+
+
+def decodeTpc(path, maxSize):
+    """
+    @brief decode a KOTOR .tpc texture from the smallest mipmap whose largest side is at least maxSize.
+        Only the first face of cube maps is decoded.
+    @return Thumbnail
+    @raise ValueError if the texture is not a supported tpc.
+    """
+    with open(path, "rb") as tpcFile:
+        data = tpcFile.read()
+    if len(data) < TPC_HEADER.size:
+        raise ValueError("truncated tpc header")
+    dataSize, alphaTest, width, height, encoding, mipCount = TPC_HEADER.unpack_from(data)
+    if not width or not height:
+        raise ValueError("empty tpc texture")
+    if height == width * 6:
+        height = width
+    compressed = dataSize != 0
+    if compressed:
+        if encoding not in (TPC_RGB, TPC_RGBA):
+            raise ValueError("unsupported tpc encoding {}".format(encoding))
+        blockSize = 8 if encoding == TPC_RGB else 16
+        levelSize = lambda w, h: max(1, (w + 3) // 4) * max(1, (h + 3) // 4) * blockSize
+    else:
+        channels = {TPC_GREY: 1, TPC_RGB: 3, TPC_RGBA: 4}.get(encoding)
+        if channels is None:
+            raise ValueError("unsupported tpc encoding {}".format(encoding))
+        levelSize = lambda w, h: w * h * channels
+    offset = TPC_HEADER.size
+    for level in range(1, max(mipCount, 1)):
+        smaller = (max(1, width // 2), max(1, height // 2))
+        if max(smaller) < maxSize:
+            break
+        offset += levelSize(width, height)
+        width, height = smaller
+    if offset + levelSize(width, height) > len(data):
+        raise ValueError("truncated tpc texture")
+    if compressed:
+        pixels = _decodeDxt(data, offset, width, height, encoding == TPC_RGBA)
+    else:
+        pixels = _expandToRgba(data, offset, width, height, channels)
+    return downsample(Thumbnail(width, height, pixels), maxSize)
+
+
+DECODERS = {
+    ".tpc": decodeTpc,
+    }
+
+
+class ThumbnailCache(object):
+    """
+    Thumbnails of image files, requested as futures and decoded on a thread pool.
+    """
+    SAVE_INTERVAL = 2.0
+
+    def __init__(self, decoders=None, cacheDirectory=None, hashCachePath=None, memoryBudget=64 * 1024 * 1024, workers=None):
+        """
+        @param decoders dict extension (".png") -> function (path, maxSize) -> Thumbnail, DECODERS by default.
+        @param cacheDirectory folder of the persistent thumbnails, None to only keep them in memory.
+        @param hashCachePath file in which the content hashes of the images are persisted.
+        @param memoryBudget bytes of pixels kept in memory, the least recently used thumbnails are dropped first.
+        """
+        self.__decoders = {extension.lower(): decoder for extension, decoder in (decoders or DECODERS).items()}
+        self.__directory = cacheDirectory
+        self.__hashes = HashCache(hashCachePath)
+        self.__budget = memoryBudget
+        self.__memory = collections.OrderedDict()
+        self.__memoryBytes = 0
+        self.__pending = {}
+        self.__lock = threading.Lock()
+        self.__lastSave = time.monotonic()
+        self.__executor = ThreadPoolExecutor(max_workers=workers or min(8, os.cpu_count() or 2), thread_name_prefix="thumbnails")
+
+    def supportedExtensions(self):
+        """
+        @return set of the supported extensions, without the dot.
+        """
+        return set(extension.lstrip(".") for extension in self.__decoders)
+
+    def request(self, path, maxSize):
+        """
+        @return Future of the Thumbnail of path, whose largest side is at most thumbnailSize(maxSize).
+            The future is already done when the thumbnail is in memory. It raises OSError or ValueError
+            if the file can not be read or decoded.
+        """
+        size = thumbnailSize(maxSize)
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            return self.__failed(e)
+        decoder = self.__decoders.get(os.path.splitext(path)[1].lower())
+        if decoder is None:
+            return self.__failed(ValueError("unsupported image format: {}".format(path)))
+        digest = self.__hashes.get(path, stat)
+        with self.__lock:
+            if digest is not None:
+                thumbnail = self.__memory.get((digest, size))
+                if thumbnail is not None:
+                    self.__memory.move_to_end((digest, size))
+                    future = Future()
+                    future.set_result(thumbnail)
+                    return future
+            key = (path, stat.st_size, stat.st_mtime_ns, size)
+            future = self.__pending.get(key)
+            if future is None:
+                future = self.__pending[key] = self.__executor.submit(self.__load, path, stat, size, decoder)
+                future.add_done_callback(lambda done: self.__forget(key))
+            return future
+
+    def get(self, path, maxSize, timeout=None):
+        """
+        @return Thumbnail of path, see request().
+        """
+        return self.request(path, maxSize).result(timeout)
+
+    def prefetch(self, paths, maxSize):
+        """
+        @brief start decoding the thumbnails of the supported files of paths, e.g. a folder being browsed.
+        """
+        for path in paths:
+            if os.path.splitext(path)[1].lower() in self.__decoders:
+                self.request(path, maxSize)
+
+    def memoryUsage(self):
+        """
+        @return (number of thumbnails in memory, bytes of pixels they use)
+        """
+        with self.__lock:
+            return len(self.__memory), self.__memoryBytes
+
+    def save(self):
+        self.__lastSave = time.monotonic()
+        try:
+            self.__hashes.save()
+        except OSError:
+            pass
+
+    def shutdown(self):
+        self.__executor.shutdown(wait=False)
+        self.save()
+
+    def __failed(self, error):
+        future = Future()
+        future.set_exception(error)
+        return future
+
+    def __forget(self, key):
+        with self.__lock:
+            self.__pending.pop(key, None)
+
+    def __load(self, path, stat, size, decoder):
+        digest = self.__hashes.get(path, stat)
+        if digest is None:
+            digest = hashFile(path, stat.st_size)
+            self.__hashes.set(path, stat, digest)
+            if time.monotonic() - self.__lastSave > self.SAVE_INTERVAL:
+                self.save()
+        with self.__lock:
+            thumbnail = self.__memory.get((digest, size))
+        if thumbnail is None:
+            thumbnail = self.__readThumbnail(digest, size)
+            if thumbnail is None:
+                thumbnail = downsample(decoder(path, size), size)
+                self.__writeThumbnail(digest, size, thumbnail)
+        self.__remember((digest, size), thumbnail)
+        return thumbnail
+
+    def __remember(self, key, thumbnail):
+        with self.__lock:
+            if key in self.__memory:
+                self.__memory.move_to_end(key)
+                return
+            self.__memory[key] = thumbnail
+            self.__memoryBytes += len(thumbnail.pixels)
+            while self.__memoryBytes > self.__budget and len(self.__memory) > 1:
+                key, evicted = self.__memory.popitem(last=False)
+                self.__memoryBytes -= len(evicted.pixels)
+
+    def __thumbnailPath(self, digest, size):
+        return os.path.join(self.__directory, digest[:2], "{}-{}.thumb".format(digest, size))
+
+    def __readThumbnail(self, digest, size):
+        if self.__directory is None:
+            return None
+        try:
+            with open(self.__thumbnailPath(digest, size), "rb") as thumbnailFile:
+                data = thumbnailFile.read()
+            magic, width, height = THUMBNAIL_HEADER.unpack_from(data)
+            pixels = zlib.decompress(data[THUMBNAIL_HEADER.size:])
+        except (OSError, struct.error, zlib.error):
+            return None
+        if magic != THUMBNAIL_MAGIC or len(pixels) != width * height * 4:
+            return None
+        return Thumbnail(width, height, pixels)
+
+    def __writeThumbnail(self, digest, size, thumbnail):
+        if self.__directory is None:
+            return
+        path = self.__thumbnailPath(digest, size)
+        temporary = "{}.{}.tmp".format(path, threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temporary, "wb") as thumbnailFile:
+                thumbnailFile.write(THUMBNAIL_HEADER.pack(THUMBNAIL_MAGIC, thumbnail.width, thumbnail.height))
+                thumbnailFile.write(zlib.compress(thumbnail.pixels, 1))
+            os.replace(temporary, path)
+        except OSError:
+            pass
+
+
+if mobase is not None:
+    class GamePreview(mobase.IPluginPreview):
+        """
+        Companion plugin of a game plugin previewing the textures of its mods. Images are decoded on a thread
+        pool and downsampled by a ThumbnailCache, which keeps the thumbnails in memory and in the thumbnails
+        cache folder, keyed by content. Previewing a file also prefetches the other images of its folder.
+        """
+        MEMORY_BUDGET = 64 * 1024 * 1024
+        MAX_PREFETCH = 64
+
+        def __init__(self, game, name, description, decoders):
+            """
+            @param game plugin of the game, the preview is only active for the instances managing it.
+            @param name name of the plugin, description its untranslated description.
+            @param decoders dict lower case extension -> decoder, e.g. GamePreview.decodeWithQt or decodeTpc.
+            """
+            super(GamePreview, self).__init__()
+            self.__game = game
+            self.__name = name
+            self.__description = description
+            self.__decoders = decoders
+            self.__thumbnails = None
+
+        def init(self, organizer):
+            directory = cacheDirectory("thumbnails")
+            self.__thumbnails = ThumbnailCache(self.__decoders, directory,
+                os.path.join(directory, self.__game.gameShortName() + ".hashes"), self.MEMORY_BUDGET)
+            return True
+
+        def name(self):
+            return self.__name
+
+        def author(self):
+            return "AnyOldName3, AL12, erri120"
+
+        def description(self):
+            return self.__tr(self.__description)
+
+        def version(self):
+            return mobase.VersionInfo(0, 1, 0, mobase.ReleaseType.prealpha)
+
+        def isActive(self):
+            return self.__game.isManaged()
+
+        def settings(self):
+            return []
+
+        def supportedExtensions(self):
+            return self.__thumbnails.supportedExtensions()
+
+        def genFilePreview(self, fileName, maxSize):
+            size = max(maxSize.width(), maxSize.height())
+            try:
+                thumbnail = self.__thumbnails.get(fileName, size)
+            except (OSError, ValueError) as e:
+                return QLabel(self.__tr("Could not preview {}: {}").format(os.path.basename(fileName), e))
+            finally:
+                self.__prefetch(fileName, size)
+            image = QImage(thumbnail.pixels, thumbnail.width, thumbnail.height, thumbnail.width * 4, QImage.Format_RGBA8888)
+            label = QLabel()
+            label.setAlignment(Qt.AlignCenter)
+            label.setPixmap(QPixmap.fromImage(image))
+            return label
+
+        def thumbnails(self):
+            """
+            @return the ThumbnailCache of this plugin.
+            """
+            return self.__thumbnails
+
+        @staticmethod
+        def decodeWithQt(path, maxSize):
+            reader = QImageReader(path)
+            size = reader.size()
+            if size.isValid() and max(size.width(), size.height()) > maxSize:
+                reader.setScaledSize(size.scaled(maxSize, maxSize, Qt.KeepAspectRatio))
+            image = reader.read()
+            if image.isNull():
+                raise ValueError(reader.errorString())
+            image = image.convertToFormat(QImage.Format_RGBA8888)
+            return Thumbnail(image.width(), image.height(), image.constBits().asstring(image.sizeInBytes()))
+
+        def __prefetch(self, fileName, size):
+            directory = os.path.dirname(fileName)
+            try:
+                names = sorted(os.listdir(directory))[:self.MAX_PREFETCH]
+            except OSError:
+                return
+            self.__thumbnails.prefetch([os.path.join(directory, name) for name in names], size)
+
+        def __tr(self, str):
+            return QCoreApplication.translate("GamePreview", str)
@@ -0,0 +1,207 @@
+"""
+XNB headers of the Stardew Valley Content folder and checks of the .xnb files that mods replace.
+
+Only the header (platform, format version, flags) and, for uncompressed files, the type reader strings
+are read, from memory mapped files. Type readers of compressed files are inside the compressed stream
+and are not available.
+"""
+
+import collections
+import mmap
+import os
+import pickle
+import re
+import struct
+
+XnbHeader = collections.namedtuple("XnbHeader", ["platform", "version", "flags", "size", "typeReaders"])
+XnbIssue = collections.namedtuple("XnbIssue", ["asset", "issue", "details"])
+
+HIDEF = 0x01
+LZ4 = 0x40
+LZX = 0x80
+COMPRESSION_FLAGS = LZ4 | LZX
+
+NOT_XNB = "not an xnb file"
+WRONG_PLATFORM = "wrong platform"
+INCOMPATIBLE_COMPRESSION = "incompatible compression"
+OUTDATED = "outdated"
+
+HEADER = struct.Struct("<3sccBI")
+MAX_TYPE_READERS = 64
+ASSEMBLY_DETAILS = re.compile(r",\s*(?:Version|Culture|PublicKeyToken)=[^,\]]*")
+
+
+def _read7BitInt(view, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = view[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+        if shift > 28:
+            raise ValueError("invalid 7 bit encoded integer")
+
+
+def parseXnbHeader(view):
+    """
+    @param view bytes like object starting with the xnb header, only the header pages are touched.
+    @return XnbHeader, typeReaders is a tuple of (reader name, reader version) or None for compressed files.
+    @raise ValueError if the data is not an xnb file.
+    """
+    if len(view) < HEADER.size:
+        raise ValueError(NOT_XNB)
+    magic, platform, version, flags, size = HEADER.unpack_from(view)
+    if magic != b"XNB":
+        raise ValueError(NOT_XNB)
+    typeReaders = None
+    if not flags & COMPRESSION_FLAGS:
+        typeReaders = []
+        try:
+            count, offset = _read7BitInt(view, HEADER.size)
+            if count > MAX_TYPE_READERS:
+                raise ValueError("too many type readers")
+            for index in range(count):
+                length, offset = _read7BitInt(view, offset)
+                name = bytes(view[offset:offset + length]).decode("utf-8", "replace")
+                offset += length
+                readerVersion = struct.unpack_from("<i", view, offset)[0]
+                offset += 4
+                typeReaders.append((ASSEMBLY_DETAILS.sub("", name), readerVersion))
+        except (IndexError, struct.error):
+            raise ValueError("truncated xnb header")
+        typeReaders = tuple(typeReaders)
+    return XnbHeader(platform.decode("latin-1"), ord(version), flags, size, typeReaders)
+
+
+def readXnbHeader(path):
+    """
+    @return XnbHeader of a file, see parseXnbHeader().
+    """
+    with open(path, "rb") as xnbFile:
+        try:
+            data = mmap.mmap(xnbFile.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ValueError(NOT_XNB)
+        with data:
+            view = memoryview(data)
+            try:
+                return parseXnbHeader(view)
+            finally:
+                view.release()
+
+
+def assetName(relativePath):
+    """
+    @return the normalized asset name of a path relative to Content, e.g. "portraits/abigail".
+    """
+    name = relativePath.replace("\\", "/").strip("/").lower()
+    return name[:-4] if name.endswith(".xnb") else name
+
+
+class XnbFingerprintIndex(object):
+    """
+    Headers of the vanilla xnb files of a Content folder by asset name. After the first scan only the
+    files whose size or modification time changed are read again.
+    """
+    CACHE_VERSION = 1
+
+    def __init__(self, contentPath, cachePath=None):
+        self.__contentPath = contentPath
+        self.__cachePath = cachePath
+        self.__entries = {}
+        if cachePath is not None:
+            try:
+                with open(cachePath, "rb") as cacheFile:
+                    version, entries = pickle.load(cacheFile)
+                if version == self.CACHE_VERSION:
+                    self.__entries = entries
+            except Exception:
+                pass
+
+    def scan(self):
+        """
+        @brief update the index from the Content folder.
+        @return number of files whose header was read.
+        """
+        entries = {}
+        read = 0
+        for directory, dirs, files in os.walk(self.__contentPath):
+            for fileName in files:
+                if not fileName.lower().endswith(".xnb"):
+                    continue
+                path = os.path.join(directory, fileName)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                asset = assetName(os.path.relpath(path, self.__contentPath))
+                signature = (stat.st_size, stat.st_mtime_ns)
+                cached = self.__entries.get(asset)
+                if cached is None or cached[0] != signature:
+                    try:
+                        cached = (signature, readXnbHeader(path))
+                    except (OSError, ValueError):
+                        continue
+                    read += 1
+                entries[asset] = cached
+        self.__entries = entries
+        self.__save()
+        return read
+
+    def header(self, asset):
+        entry = self.__entries.get(asset)
+        return entry[1] if entry is not None else None
+
+    def platforms(self):
+        return set(entry[1].platform for entry in self.__entries.values())
+
+    def compressions(self):
+        return set(entry[1].flags & COMPRESSION_FLAGS for entry in self.__entries.values())
+
+    def check(self, replacements):
+        """
+        @param replacements dict asset name -> path of the xnb files of a mod.
+        @return list of XnbIssue for the replacements that the game is unlikely to load correctly.
+        """
+        platforms = self.platforms()
+        compressions = self.compressions()
+        issues = []
+        for asset, path in sorted(replacements.items()):
+            try:
+                header = readXnbHeader(path)
+            except (OSError, ValueError) as e:
+                issues.append(XnbIssue(asset, NOT_XNB, str(e)))
+                continue
+            vanilla = self.header(asset)
+            expectedPlatform = vanilla.platform if vanilla is not None else None
+            if expectedPlatform is None and len(platforms) == 1:
+                expectedPlatform = next(iter(platforms))
+            if expectedPlatform is not None and header.platform != expectedPlatform:
+                issues.append(XnbIssue(asset, WRONG_PLATFORM,
+                    "built for platform '{}', the game uses '{}'".format(header.platform, expectedPlatform)))
+            compression = header.flags & COMPRESSION_FLAGS
+            if compression == COMPRESSION_FLAGS or (compressions and compression not in compressions and compression):
+                issues.append(XnbIssue(asset, INCOMPATIBLE_COMPRESSION,
+                    "compression flags 0x{:02x} are not used by the game files".format(compression)))
+            if vanilla is None:
+                if self.__entries:
+                    issues.append(XnbIssue(asset, OUTDATED, "the game has no such asset, it was renamed or removed"))
+            elif header.version != vanilla.version:
+                issues.append(XnbIssue(asset, OUTDATED,
+                    "format version {} instead of {}".format(header.version, vanilla.version)))
+            elif header.typeReaders is not None and vanilla.typeReaders is not None \
+                    and [name for name, version in header.typeReaders] != [name for name, version in vanilla.typeReaders]:
+                issues.append(XnbIssue(asset, OUTDATED, "content types differ from the game file"))
+        return issues
+
+    def __save(self):
+        if self.__cachePath is None:
+            return
+        try:
+            with open(self.__cachePath, "wb") as cacheFile:
+                pickle.dump((self.CACHE_VERSION, self.__entries), cacheFile, pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            pass
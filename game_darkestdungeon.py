@@ -61,16 +61,36 @@ SOFTWARE.
 
 import sys
 import os
-import winreg
-import re
 
-from PyQt5.QtCore import QCoreApplication, QDateTime, QDir, QFileInfo, QStandardPaths
+from PyQt5.QtCore import QCoreApplication, QDateTime, QDir, QFileInfo, qInfo, qWarning
 from PyQt5.QtGui import QIcon
 from PyQt5.QtWidgets import QMessageBox, QFileIconProvider
 
 if "mobase" not in sys.modules:
     import mock_mobase as mobase
 
+# MO2 puts plugins/data on the python path, this also covers loading the plugin from elsewhere
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+if DATA_PATH not in sys.path:
+    sys.path.append(DATA_PATH)
+
+try:
+    import winreg
+except ImportError:
+    from gamesupport import registry as winreg
+
+from gamesupport.archives import ArchiveListing, InspectionCache
+from gamesupport.backup import SaveBackup
+from gamesupport.cache import cacheFile
+from gamesupport.darkestdungeon import ModCatalog, Profile, lastPlayedProfile, listProfiles, parseProject, steamSavesPath, workshopPath
+from gamesupport.dedup import ModDeduplicator, isManaged, HARDLINK
+from gamesupport.deploy import InstanceDeployment, COPY
+from gamesupport.detection import BackgroundDetection, defaultSteamRoots
+from gamesupport.knownfolders import KnownFolders, DOCUMENTS
+from gamesupport.registry import nativePath, queryValue
+from gamesupport.savedeps import SaveDependencyCache, missingDependencies
+from gamesupport.thumbnails import GamePreview
+
 class DarkestDungeonGamePlugins(mobase.GamePlugins):
     """
     Game feature class for plugin type mods.
@@ -93,6 +113,211 @@ class DarkestDungeonGamePlugins(mobase.GamePlugins):
     def getLoadOrder(self, loadOrder):
         return
 
+class DarkestDungeonModDataChecker(mobase.ModDataChecker):
+    """
+    Game feature checking the layout of mods before installation.
+    The game loads every folder of mods/ containing a project.xml, so a valid mod has such folders at its top level.
+    Archives with the mod folders nested inside other folders are fixed by moving them up.
+    """
+    PROJECT = "project.xml"
+    MAX_DEPTH = 3
+
+    def __init__(self):
+        super(DarkestDungeonModDataChecker, self).__init__()
+        self.__inspections = InspectionCache(self.__inspect)
+
+    def dataLooksValid(self, filetree):
+        return self.__check(filetree, self.__findModRoot(filetree))
+
+    def fix(self, filetree):
+        modRoot = self.__findModRoot(filetree)
+        if modRoot is None or modRoot is filetree:
+            return filetree
+        for entry in list(modRoot):
+            filetree.move(entry, "/", mobase.IFileTree.MERGE)
+        modRoot.detach()
+        return filetree
+
+    def inspectArchive(self, archivePath):
+        """
+        @brief check the layout of an archive before it is extracted, with the checks of dataLooksValid() on its file list.
+        The archive is inspected once per version of the file, the check of a download and of its installation share it.
+        Only the file list and the project.xml of each mod folder are read from the archive.
+        @return (CheckReturn, dict of project.xml path in the archive -> dict of its top level elements)
+        """
+        return self.__inspections.get(archivePath)
+
+    def __inspect(self, archivePath):
+        with ArchiveListing.open(archivePath) as listing:
+            tree = listing.tree()
+            modRoot = self.__findModRoot(tree)
+            result = self.__check(tree, modRoot)
+            if result == mobase.ModDataChecker.INVALID:
+                return result, {}
+            paths = [entry.find(self.PROJECT).path() for entry in modRoot if entry.isDir() and entry.exists(self.PROJECT)]
+            projects = {}
+            for path, data in listing.readMany(paths).items():
+                project = parseProject(data)
+                if project is not None:
+                    projects[path] = project
+        return result, projects
+
+    def __check(self, filetree, modRoot):
+        if modRoot is None:
+            return mobase.ModDataChecker.INVALID
+        if modRoot is filetree:
+            return mobase.ModDataChecker.VALID
+        return mobase.ModDataChecker.FIXABLE
+
+    def __findModRoot(self, filetree):
+        """
+        @return the shallowest directory having a subfolder that contains a project.xml, or None.
+        The search goes level by level and stops at the first match.
+        """
+        level = [filetree]
+        for depth in range(self.MAX_DEPTH):
+            nextLevel = []
+            for directory in level:
+                for entry in directory:
+                    if not entry.isDir():
+                        continue
+                    if entry.exists(self.PROJECT, mobase.IFileTree.FILE):
+                        return directory
+                    nextLevel.append(entry)
+            level = nextLevel
+        return None
+
+class DarkestDungeonModSources(object):
+    """
+    The game loads both the mods of its mods/ folder and the Steam Workshop subscriptions, so a mod installed
+    in MO2 that is also subscribed to is loaded twice. This indexes the workshop, the game mods/ folder and the
+    MO2 mods into one catalog keyed by PublishedFileId to find those duplicates.
+    It can also copy the active MO2 mods to the game mods/ folder as real files, leaving out the workshop
+    duplicates. The manifest of the deployment is kept in the instance and shared by all the profiles, so
+    only the difference with the previous deployment is copied, whichever profile it was made for.
+    index() is built once and shared by the deployment, the duplicates and the save dependencies check.
+    """
+    WORKSHOP = "Steam Workshop"
+    GAME = "game mods folder"
+
+    def __init__(self, organizer, game):
+        self.__organizer = organizer
+        self.__game = game
+        self.__catalog = ModCatalog(cacheFile("darkestdungeon", organizer.modsPath()))
+
+    def activeMods(self):
+        modList = self.__organizer.modList()
+        return [modName for modName in modList.allModsByProfilePriority() if modList.state(modName) & mobase.ModState.active]
+
+    def index(self):
+        """
+        @brief index the workshop, the game mods/ folder and every installed MO2 mod, active or not, in one pass.
+        @return dict key -> list of ModEntry, the source of an entry being WORKSHOP, GAME or the name of the MO2 mod.
+        """
+        gamePath = self.__game.gameDirectory().absolutePath()
+        sources = [(self.WORKSHOP, workshopPath(gamePath)), (self.GAME, os.path.join(gamePath, "mods"))]
+        modsPath = self.__organizer.modsPath()
+        sources += [(modName, os.path.join(modsPath, modName)) for modName in self.__organizer.modList().allModsByProfilePriority()]
+        return self.__catalog.index(sources)
+
+    def duplicates(self, entries=None):
+        """
+        @param entries result of index(), indexed again if None.
+        @return dict key -> list of ModEntry for the mods loaded more than once by the game, from the workshop,
+            the game mods/ folder or the active MO2 mods. The game mods/ copies made by deploy() are ignored.
+        """
+        if entries is None:
+            entries = self.index()
+        loaded = set(self.activeMods())
+        loaded.update([self.WORKSHOP, self.GAME])
+        deployed = set(target.split("/", 1)[0].lower() for target in self.deployer().manifest.entries)
+        result = {}
+        for key, modEntries in entries.items():
+            modEntries = [entry for entry in modEntries if entry.source in loaded and (entry.source != self.GAME
+                or (os.path.basename(entry.path).lower() not in deployed and os.path.isdir(entry.path)))]
+            if len(modEntries) > 1:
+                result[key] = modEntries
+        return result
+
+    def deployer(self):
+        return self.__deployment().deployer(self.__game.dataDirectory().absolutePath(), COPY)
+
+    def deploy(self, enabled=True, skipWorkshopDuplicates=True, entries=None):
+        """
+        @brief copy the active mods to the game mods/ folder, with enabled False every deployed file is removed.
+        @param entries result of index(), indexed again if None and needed to skip the workshop duplicates.
+        @return dict target folder -> (DeploymentPlan, list of targets skipped because they could not be placed),
+            the game mods/ folder and a previous mods/ folder when the game moved.
+        """
+        desired = {}
+        if enabled:
+            skipped = set()
+            if skipWorkshopDuplicates:
+                for modEntries in self.duplicates(entries).values():
+                    if any(entry.source == self.WORKSHOP for entry in modEntries):
+                        skipped.update(os.path.normcase(entry.path) for entry in modEntries
+                                       if entry.source not in (self.WORKSHOP, self.GAME))
+            for modName in self.activeMods():
+                modPath = os.path.join(self.__organizer.modsPath(), modName)
+                for directory, dirs, files in os.walk(modPath):
+                    if os.path.normcase(directory) in skipped:
+                        dirs[:] = []
+                        continue
+                    relative = os.path.relpath(directory, modPath).replace("\\", "/")
+                    for fileName in files:
+                        target = fileName if relative == "." else relative + "/" + fileName
+                        if target.lower() != "meta.ini":
+                            desired[target] = os.path.join(directory, fileName)
+        return self.__deployment().deploy({self.__game.dataDirectory().absolutePath(): desired}, COPY)
+
+    def __deployment(self):
+        return InstanceDeployment(self.__organizer.basePath(), self.__game.gameShortName())
+
+class DarkestDungeonSaveDependencies(object):
+    """
+    Mods a save profile was played with (applied_ugcs) that are neither enabled in the current profile
+    nor available from the Steam Workshop or the game mods/ folder.
+    """
+    def __init__(self, organizer, game, modSources):
+        self.__organizer = organizer
+        self.__game = game
+        self.__modSources = modSources
+        self.__cache = None
+
+    def check(self, profiles, entries=None):
+        """
+        @param profiles list of profile folders or files inside them.
+        @param entries result of DarkestDungeonModSources.index(), indexed again if None.
+        @return dict profile -> {mod key (PublishedFileId or "folder:<name>"): list of the installed mods providing it}
+            for the mods that are not available.
+        """
+        savesPath = self.__game.savesDirectory().absolutePath()
+        if self.__cache is None or self.__cache[0] != savesPath:
+            self.__cache = (savesPath, SaveDependencyCache(cacheFile("darkestdungeon-saves", savesPath)))
+        cache = self.__cache[1]
+        if entries is None:
+            entries = self.__modSources.index()
+        providers = {}
+        for key, modEntries in entries.items():
+            providers[key] = sorted(set(entry.source for entry in modEntries))
+        enabled = set(self.__modSources.activeMods())
+        enabled.update([self.__modSources.WORKSHOP, self.__modSources.GAME])
+        result = {}
+        for profile in profiles:
+            folder = profile if os.path.isdir(profile) else os.path.dirname(profile)
+            dependencies = cache.dependencies(os.path.join(folder, "persist.game.json"),
+                lambda path: Profile(os.path.dirname(path)).dependencies())
+            result[profile] = missingDependencies(dependencies, providers, enabled)
+        cache.save()
+        return result
+
+    def getMissingAssets(self, save):
+        """
+        @param save path of a profile folder, or a mobase.ISaveGame.
+        """
+        path = save if isinstance(save, str) else save.getFilepath()
+        return self.check([path])[path]
+
 class DarkestDungeon(mobase.IPluginGame):
     """
     Actual plugin class, extends the IPluginGame interface, meaning it adds support for a new game.
@@ -107,10 +332,24 @@ class DarkestDungeon(mobase.IPluginGame):
     """
     
     def init(self, organizer):
+        self.__organizer = organizer
         self.__featureMap[mobase.GamePlugins] = DarkestDungeonGamePlugins(organizer)
-        self.m_GameDir=""
+        self.__featureMap[mobase.ModDataChecker] = DarkestDungeonModDataChecker()
+        self.__deduplicator = ModDeduplicator(organizer, self, qInfo)
+        organizer.onUserInterfaceInitialized(self.__onUserInterfaceInitialized)
+        self.__modSources = DarkestDungeonModSources(organizer, self)
+        self.__saveDependencies = DarkestDungeonSaveDependencies(organizer, self, self.__modSources)
+        self.__saveBackup = SaveBackup(organizer, self, qInfo, qWarning)
+        organizer.onAboutToRun(self.__onAboutToRun)
+        organizer.onFinishedRun(self.__onFinishedRun)
+        organizer.downloadManager().onDownloadComplete(self.__onDownloadComplete)
+        organizer.onModInstalled(self.__onModInstalled)
+        self.m_GameDir=None
         self.m_DataDir=""
         self.m_DocumentsDir=""
+        self.__savesPath = None
+        self.__detection = BackgroundDetection(self.name(), self.__detectGamePath)
+        self.__detection.start()
         return True
 
     def name(self):
@@ -159,7 +398,19 @@ class DarkestDungeon(mobase.IPluginGame):
         Example: [mobase.PluginSetting("enabled", self.__tr("Enable this plugin), True)]
         To retrieve it: isEnabled = self.__organizer.pluginSetting(self.name(), "enabled")
         """
-        return []    
+        return [
+            mobase.PluginSetting("deduplicate_mods", self.__tr("Replace identical mod files by links to a single copy when MO2 starts. "
+                "Linked files share their content, editing one of them in place edits all of them."), False),
+            mobase.PluginSetting("deduplicate_mode", self.__tr("How duplicates are linked, \"hardlink\" or \"reflink\" (copy-on-write, "
+                "falls back to hardlinks if the filesystem does not support it)."), HARDLINK),
+            mobase.PluginSetting("deploy_mods", self.__tr("Before running a program, copy the active mods to the mods/ folder of the game "
+                "instead of relying on the virtual file system. Only changed files are copied again."), False),
+            mobase.PluginSetting("skip_workshop_duplicates", self.__tr("Do not deploy mods that are also subscribed to on the Steam Workshop, "
+                "the game would load them twice."), True),
+            mobase.PluginSetting("backup_saves", self.__tr("Snapshot the saves folder before and after running a program. "
+                "Snapshots are deduplicated and compressed, saves that did not change take no space."), False),
+            mobase.PluginSetting("backup_keep", self.__tr("Number of save snapshots to keep, 0 keeps all of them."), 0)
+            ]
 
     """
     Here IPluginGame interface stuff. 
@@ -240,8 +491,8 @@ class DarkestDungeon(mobase.IPluginGame):
         """
         @return list of automatically discovered executables of the game itself and tools surrounding it.
         """
-        game = mobase.ExecutableInfo("Darkest Dungeon", QFileInfo(self.m_GameDir, "_windows/Darkest.exe"))
-        game.withWorkingDirectory(self.m_GameDir)
+        game = mobase.ExecutableInfo("Darkest Dungeon", QFileInfo(self.gameDirectory(), "_windows/Darkest.exe"))
+        game.withWorkingDirectory(self.gameDirectory())
         return [game]
 
     def savegameExtension(self):
@@ -360,21 +611,25 @@ class DarkestDungeon(mobase.IPluginGame):
         HKEY_LOCAL_MACHINE\\SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Uninstall\\Steam App 262060 has InstallLocation
         https://github.com/ModOrganizer2/modorganizer-game_gamebryo/blob/master/src/gamebryo/gamegamebryo.cpp#L299
         """
-        try:
-            RawKey = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, "SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Uninstall\\Steam App 262060")
-            Key = winreg.QueryValueEx(RawKey, "InstallLocation")
-            winreg.CloseKey(RawKey)
-            Dir = re.search("'(.*)'", str(Key))
-            self.setGamePath(str(Dir[1]))
-            return True
-        except:
+        path = self.__detection.result()
+        if not path:
             return False
+        self.setGamePath(path)
+        return True
+
+    def __detectGamePath(self):
+        """
+        @return the install location of the game, called on the background thread of the detection.
+        """
+        path = queryValue(winreg.HKEY_LOCAL_MACHINE,
+            "SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Uninstall\\Steam App 262060", "InstallLocation", appId=self.steamAPPId())
+        return nativePath(path) if path else None
     
     def gameDirectory(self):
         """
         @return directory to the game installation.
         """
-        return self.m_GameDir
+        return self.m_GameDir if self.m_GameDir is not None else QDir()
     
     def dataDirectory(self):
         """
@@ -391,19 +646,164 @@ class DarkestDungeon(mobase.IPluginGame):
         """
         self.m_GameDir=QDir(pathStr)
         self.m_DataDir=QDir(self.m_GameDir.path() + "/mods/")
+        self.__savesPath = None
     
     def documentsDirectory(self):
         """
         @return directory of the documents folder where configuration files and such for this game reside.
+        The documents folder is the one of the Proton/Wine prefix when the game runs in one.
         """
-        return QDir("{}/My Games".format(os.getenv("CSIDL_MYDOCUMENTS")))
+        return QDir(os.path.join(self.__knownFolders().path(DOCUMENTS), "My Games"))
     
     def savesDirectory(self):
         """
         @return path to where save games are stored.
+        The Steam version keeps the profile_* folders in the Steam Cloud folder of the account
+        (userdata/<account>/262060/remote), other versions in Documents/Darkest.
+        The folder is looked up once per game path, the Steam libraries are not scanned on every call.
+        """
+        gamePath = self.__gamePath()
+        if self.__savesPath is None or self.__savesPath[0] != gamePath:
+            steamRoots = defaultSteamRoots()
+            if gamePath:
+                # the library of the game, which is the Steam installation for the default library
+                steamRoots.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.normpath(gamePath)))))
+            remote = steamSavesPath(steamRoots)
+            if remote is None:
+                remote = os.path.join(self.__knownFolders().path(DOCUMENTS), "Darkest")
+            self.__savesPath = (gamePath, remote)
+        return QDir(self.__savesPath[1])
+
+    def profiles(self):
+        """
+        @return list of gamesupport.darkestdungeon.Profile of the saves folder, decoded lazily when their
+            estate name, roster, wallet or applied mods are read.
+        """
+        return listProfiles(self.savesDirectory().absolutePath())
+
+    def currentProfile(self):
         """
-        return self.documentsDirectory()
+        @return the Profile saved last, which the game continues, or None if there are no saves.
+        """
+        return lastPlayedProfile(self.profiles())
     
+    def __gamePath(self):
+        return self.m_GameDir.absolutePath() if self.m_GameDir is not None else ""
+
+    def __knownFolders(self):
+        return KnownFolders.forGame(self.__gamePath(), self.steamAPPId())
+
+    def deduplicator(self):
+        """
+        @return the gamesupport.dedup.ModDeduplicator of this plugin.
+        """
+        return self.__deduplicator
+
+    def isManaged(self):
+        """
+        @return true if this is the game managed by the current instance, callbacks fire for every game plugin.
+        """
+        return isManaged(self.__organizer, self)
+
+    def modSources(self):
+        """
+        @return the DarkestDungeonModSources of this plugin.
+        """
+        return self.__modSources
+
+    def saveDependencies(self):
+        """
+        @return the DarkestDungeonSaveDependencies of this plugin.
+        """
+        return self.__saveDependencies
+
+    def saveBackup(self):
+        """
+        @return the gamesupport.backup.SaveBackup of this plugin.
+        """
+        return self.__saveBackup
+
+    def __onAboutToRun(self, appPath):
+        if not self.isManaged():
+            return True
+        if self.__saveBackup.isEnabled():
+            self.__saveBackup.start("before " + os.path.basename(appPath))
+        # a single index of the mods for the deployment, the duplicates and the save dependencies
+        modEntries = self.__modSources.index()
+        deployMods = bool(self.__organizer.pluginSetting(self.name(), "deploy_mods"))
+        results = self.__modSources.deploy(deployMods,
+            bool(self.__organizer.pluginSetting(self.name(), "skip_workshop_duplicates")), modEntries)
+        for folder, (plan, skipped) in sorted(results.items()):
+            if not plan.isEmpty():
+                qInfo("Deployed mods to {}: {}, {} skipped".format(folder, plan, len(skipped)))
+        for key, entries in self.__modSources.duplicates(modEntries).items():
+            qWarning("{} is loaded {} times: {}".format(entries[0].title, len(entries), ", ".join(entry.path for entry in entries)))
+        profile = self.currentProfile()
+        if profile is not None:
+            for key, mods in sorted(self.__saveDependencies.check([profile.path], modEntries)[profile.path].items()):
+                qWarning("{} was played with the mod {}, provided by {}, which is not enabled".format(
+                    os.path.basename(profile.path), key, ", ".join(mods) or "no installed mod"))
+        return True
+
+    def __onFinishedRun(self, appPath, exitCode):
+        if self.isManaged() and self.__saveBackup.isEnabled():
+            self.__saveBackup.start("after " + os.path.basename(appPath))
+
+    def __onDownloadComplete(self, downloadId):
+        """
+        @brief check the layout of a downloaded archive before it is installed, from its file list and project.xml files.
+        """
+        if not self.isManaged():
+            return
+        path = self.__organizer.downloadManager().downloadPath(downloadId)
+        inspection = self.__inspectArchive(path)
+        if inspection is None:
+            return
+        result, projects = inspection
+        if result == mobase.ModDataChecker.INVALID:
+            qWarning("{} has no mod folder with a project.xml, it can not be installed automatically".format(os.path.basename(path)))
+        else:
+            titles = [project.get("Title") or member for member, project in sorted(projects.items())]
+            qInfo("{} contains {}".format(os.path.basename(path), ", ".join(titles) or "no readable project.xml"))
+
+    def __onModInstalled(self, modName):
+        """
+        @brief warn about the mods of the installed archive that are also subscribed to on the Steam Workshop,
+            from the project.xml files read when the archive was downloaded.
+        """
+        if not self.isManaged():
+            return
+        mod = self.__organizer.modList().getMod(modName)
+        archive = mod.installationFile() if mod is not None else ""
+        if not archive:
+            return
+        inspection = self.__inspectArchive(os.path.join(self.__organizer.downloadsPath(), archive))
+        if inspection is None:
+            return
+        workshop = workshopPath(self.__gamePath())
+        for member, project in sorted(inspection[1].items()):
+            publishedFileId = project.get("PublishedFileId", "")
+            if publishedFileId and publishedFileId != "0" and os.path.isdir(os.path.join(workshop, publishedFileId)):
+                qWarning("{}: {} is also subscribed to on the Steam Workshop, the game would load it twice".format(
+                    modName, project.get("Title") or member))
+
+    def __inspectArchive(self, path):
+        """
+        @return (CheckReturn, projects) of DarkestDungeonModDataChecker.inspectArchive(), None if the archive is gone
+            or can not be read.
+        """
+        if not os.path.isfile(path):
+            return None
+        try:
+            return self.__featureMap[mobase.ModDataChecker].inspectArchive(path)
+        except (OSError, ValueError) as e:
+            qWarning("Could not inspect {}: {}".format(path, e))
+            return None
+
+    def __onUserInterfaceInitialized(self, mainWindow):
+        if self.__deduplicator.isEnabled():
+            self.__deduplicator.start()
+
     def _featureList(self):
         """
         Map of features that the game supports where each feature is a class abiding to
@@ -417,5 +817,7 @@ class DarkestDungeon(mobase.IPluginGame):
     def __tr(self, str):
         return QCoreApplication.translate("DarkestDungeon", str)
     
-def createPlugin():
-    return DarkestDungeon()
\ No newline at end of file
+def createPlugins():
+    game = DarkestDungeon()
+    return [game, GamePreview(game, "Darkest Dungeon Preview", "Cached previews of the PNG sprites of Darkest Dungeon mods.",
+        {".png": GamePreview.decodeWithQt})]
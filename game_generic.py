@@ -41,6 +41,9 @@ SOFTWARE.
     either select a game from the list of detected ones or browse to a game directory.
     Select the Browse option and choose the folder in which you want Mo2 to put the mod files.
     A new generic instance will be generated.
+    The name, executable, mods subfolder, saves location and additional targets of the
+    generic game can be changed from the plugin settings (Settings -> Plugins -> GenericGamePlugin)
+    without editing this file.
 
     Attention! If this plugin is installed you might accidentally create a generic instance 
     instead of one of another supported game. It's advised to not have this plugin installed
@@ -63,14 +66,27 @@ SOFTWARE.
 import sys
 import os
 import pathlib
+import json
+import configparser
 
-from PyQt5.QtCore import QCoreApplication, QDateTime, QDir, QFileInfo, QStandardPaths
+from PyQt5.QtCore import QCoreApplication, QDateTime, QDir, QFileInfo, qInfo, qWarning
 from PyQt5.QtGui import QIcon
 from PyQt5.QtWidgets import QMessageBox
 
 if "mobase" not in sys.modules:
     import mock_mobase as mobase
 
+# MO2 puts plugins/data on the python path, this also covers loading the plugin from elsewhere
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+if DATA_PATH not in sys.path:
+    sys.path.append(DATA_PATH)
+
+from gamesupport.cache import cacheFile
+from gamesupport.dedup import isManaged
+from gamesupport.deploy import InstanceDeployment, COPY, METHODS
+from gamesupport.detection import BackgroundDetection, GameDetector
+from gamesupport.knownfolders import KnownFolders, DOCUMENTS
+
 class GenericGameGamePlugins(mobase.GamePlugins):
     """
     Game feature class for plugin type mods.
@@ -93,14 +109,391 @@ class GenericGameGamePlugins(mobase.GamePlugins):
     def getLoadOrder(self, loadOrder):
         return
 
+class GenericGameMappingTrie(object):
+    """
+    Path-prefix trie of the (subpath -> target) mappings configured by the user.
+    Components are stored lower case since Windows paths are case insensitive, so resolving
+    a path only costs one dictionary lookup per path component.
+    """
+    def __init__(self, mappings=None):
+        self.__root = {}
+        for subpath, target in (mappings or []):
+            self.insert(subpath, target)
+
+    @staticmethod
+    def parse(settingStr):
+        """
+        @brief parse the "mappings" setting, a ';' separated list of subpath=target pairs.
+        @return list of (subpath, target) tuples, invalid entries are skipped.
+        """
+        mappings = []
+        for entry in settingStr.split(";"):
+            subpath, sep, target = entry.partition("=")
+            subpath = subpath.strip().strip("/\\")
+            target = target.strip()
+            if sep and subpath and target:
+                mappings.append((subpath, target))
+        return mappings
+
+    @staticmethod
+    def split(path):
+        return [part for part in path.replace("\\", "/").split("/") if part and part != "."]
+
+    def insert(self, subpath, target):
+        node = self.__root
+        for part in self.split(subpath):
+            node = node.setdefault(part.lower(), {})
+        node[None] = target
+
+    def isEmpty(self):
+        return not self.__root
+
+    def resolve(self, path):
+        """
+        @brief find the target of the longest configured subpath that prefixes path.
+        @param path path relative to the mod root.
+        @return (target, remaining path) or None if path is not mapped.
+        """
+        parts = self.split(path)
+        node = self.__root
+        match = None
+        for index, part in enumerate(parts):
+            node = node.get(part.lower())
+            if node is None:
+                break
+            if None in node:
+                match = (node[None], "/".join(parts[index + 1:]))
+        return match
+
+    def mappedDirectories(self, root):
+        """
+        @brief walk the directories of root that match a configured subpath, following the longest prefix as resolve() does.
+        Only directories along the trie are listed, the rest of the tree is never visited. A matched directory
+        containing longer subpaths is not mapped as a whole, its other entries are mapped one by one.
+        @return list of (absolute path, target, is directory) tuples.
+        """
+        result = []
+        pending = [(root, self.__root, None)]
+        while pending:
+            path, node, target = pending.pop()
+            try:
+                entries = list(os.scandir(path))
+            except OSError:
+                continue
+            for entry in entries:
+                isDirectory = entry.is_dir()
+                child = node.get(entry.name.lower()) if isDirectory else None
+                if child is None:
+                    if target is not None:
+                        result.append((entry.path, os.path.join(target, entry.name), isDirectory))
+                    continue
+                childTarget = child.get(None)
+                if childTarget is None and target is not None:
+                    childTarget = os.path.join(target, entry.name)
+                if len(child) > (None in child):
+                    pending.append((entry.path, child, childTarget))
+                else:
+                    result.append((entry.path, childTarget, True))
+        return result
+
+class GenericGameFileMapper(mobase.IPluginFileMapper):
+    """
+    Companion plugin providing the additional virtualization targets of the generic game.
+    Each configured subpath of an active mod is mapped to its own target folder, so a single instance
+    can manage both the game folder and, for example, a documents or config folder.
+    """
+    def __init__(self, game):
+        super(GenericGameFileMapper, self).__init__()
+        self.__game = game
+        self.__organizer = None
+
+    def init(self, organizer):
+        self.__organizer = organizer
+        return True
+
+    def name(self):
+        return self.__game.name().replace("GenericGamePlugin", "GenericGameFileMapper")
+
+    def author(self):
+        return "AnyOldName3, AL12"
+
+    def description(self):
+        return QCoreApplication.translate("GenericGameFileMapper", "Maps subfolders of mods to additional targets for the generic game.")
+
+    def version(self):
+        return mobase.VersionInfo(0, 1, 0, mobase.ReleaseType.prealpha)
+
+    def isActive(self):
+        return True
+
+    def settings(self):
+        return []
+
+    def mappings(self):
+        """
+        @return list of mobase.Mapping for every configured subpath found in the active mods.
+        Mods are visited by priority so later mods take precedence in the VFS.
+        """
+        managedGame = self.__organizer.managedGame()
+        if managedGame is None or managedGame.name() != self.__game.name():
+            return []
+        trie = self.__game.mappingTrie()
+        if trie.isEmpty():
+            return []
+        result = []
+        modList = self.__organizer.modList()
+        for modName in modList.allModsByProfilePriority():
+            if not modList.state(modName) & mobase.ModState.active:
+                continue
+            modPath = os.path.join(self.__organizer.modsPath(), modName)
+            for source, target, isDirectory in trie.mappedDirectories(modPath):
+                result.append(self.__mapping(source, target, isDirectory, False))
+        # files created by programs inside the mapped targets end up in overwrite
+        # deeper subpaths last, so the longest prefix wins for the files created inside nested mappings
+        mappings = sorted(GenericGameMappingTrie.parse(self.__game.mappingSetting()),
+            key=lambda mapping: len(GenericGameMappingTrie.split(mapping[0])))
+        for subpath, target in mappings:
+            result.append(self.__mapping(os.path.join(self.__organizer.overwritePath(), subpath), target, True, True))
+        return result
+
+    def __mapping(self, source, destination, isDirectory, createTarget):
+        mapping = mobase.Mapping()
+        mapping.source = source
+        mapping.destination = destination
+        mapping.isDirectory = isDirectory
+        mapping.createTarget = createTarget
+        return mapping
+
+class GenericGameDeployment(object):
+    """
+    Alternative to the virtual file system: links the files of the active mods into the data folder of the
+    game, and into the targets of the "mappings" setting, with hardlinks, symlinks, reflinks or copies.
+    This covers what USVFS can not virtualize, such as load-time linked dlls, and platforms without it.
+    Every target folder has a gamesupport.deploy manifest in the deployment folder of the instance, so
+    deploying again after a profile change only applies the difference. Game files replaced by mod files
+    are moved to a backup folder next to the manifest and put back by undeploy().
+    """
+    def __init__(self, organizer, game):
+        self.__organizer = organizer
+        self.__game = game
+
+    def method(self):
+        """
+        @return the placement method of the "deployment_mode" setting, None when mods are virtualized.
+        """
+        mode = self.__game.setting("deployment_mode").strip().lower()
+        return mode if mode in METHODS else None
+
+    def deploymentPath(self):
+        return self.__instanceDeployment().path()
+
+    def desiredFiles(self):
+        """
+        @return dict target folder -> dict target path -> source file, for the active mods and overwrite.
+            Mods are visited by priority, so files of later mods win.
+        """
+        dataPath = self.__game.dataDirectory().absolutePath()
+        trie = self.__game.mappingTrie()
+        desired = {}
+        modList = self.__organizer.modList()
+        roots = [os.path.join(self.__organizer.modsPath(), modName) for modName in modList.allModsByProfilePriority()
+            if modList.state(modName) & mobase.ModState.active]
+        for root in roots + [self.__organizer.overwritePath()]:
+            for directory, dirs, files in os.walk(root):
+                relative = os.path.relpath(directory, root).replace("\\", "/")
+                for fileName in files:
+                    path = fileName if relative == "." else relative + "/" + fileName
+                    if path.lower() == "meta.ini":
+                        continue
+                    mapped = trie.resolve(path) if not trie.isEmpty() else None
+                    targetRoot, target = mapped if mapped is not None else (dataPath, path)
+                    if target:
+                        # the game sees a single file for paths differing only by case on Windows
+                        desired.setdefault(targetRoot, {})[os.path.normcase(target)] = (target, os.path.join(directory, fileName))
+        return {targetRoot: dict(files.values()) for targetRoot, files in desired.items()}
+
+    def deployers(self, method=None):
+        """
+        @return dict target folder -> Deployer, for the folders deployed to before.
+        """
+        return self.__instanceDeployment().deployers(method or self.method() or COPY)
+
+    def deploy(self):
+        """
+        @brief deploy the active mods, or undeploy everything if mods are virtualized.
+        @return dict target folder -> (DeploymentPlan, list of targets skipped because they could not be placed)
+        """
+        method = self.method()
+        if method is None:
+            return self.undeploy()
+        return self.__instanceDeployment().deploy(self.desiredFiles(), method)
+
+    def undeploy(self):
+        """
+        @brief remove the deployed files of every target folder and put back the files they replaced.
+        @return dict target folder -> (DeploymentPlan, list of targets that could not be removed)
+        """
+        return self.__instanceDeployment().undeploy()
+
+    def __instanceDeployment(self):
+        return InstanceDeployment(self.__organizer.basePath(), self.__game.gameShortName())
+
+class GenericGameCatalog(object):
+    """
+    Game definitions (*.json or *.ini files) registered as additional generic games.
+    Parsed definitions are cached as json in the gamesupport cache folder and only parsed again when a file changes.
+    A json definition is a single object, an ini definition has a [Game] section, with the keys:
+        game_name, short_name, binary, data_subfolder, saves_location, mappings (see GenericGame.settings())
+        nexus_name, nexus_id, steam_id (optional)
+    """
+    CACHE_VERSION = 2
+    REQUIRED_KEYS = ("game_name", "short_name")
+
+    def __init__(self, directory):
+        self.__directory = directory
+
+    def definitions(self):
+        """
+        @return list of definition dicts, sorted by file name.
+        """
+        signature = self.__signature()
+        if not signature:
+            return []
+        cachePath = self.__cachePath()
+        if cachePath is not None:
+            try:
+                with open(cachePath, "r", encoding="utf-8") as catalogFile:
+                    cached = json.load(catalogFile)
+                if cached["version"] == self.CACHE_VERSION and cached["signature"] == signature:
+                    return cached["definitions"]
+            except (OSError, ValueError, KeyError, TypeError):
+                # no cache yet, or a cache written by another version
+                pass
+        definitions = []
+        shortNames = set()
+        for fileName, mtime, size in signature:
+            definition = self.__parse(os.path.join(self.__directory, fileName))
+            if definition is None:
+                continue
+            if definition["short_name"].lower() in shortNames:
+                qWarning("Skipping game definition {}, short name {} is already used".format(fileName, definition["short_name"]))
+                continue
+            shortNames.add(definition["short_name"].lower())
+            definitions.append(definition)
+        if cachePath is not None:
+            try:
+                with open(cachePath + ".tmp", "w", encoding="utf-8") as catalogFile:
+                    json.dump({"version": self.CACHE_VERSION, "signature": signature, "definitions": definitions}, catalogFile)
+                os.replace(cachePath + ".tmp", cachePath)
+            except OSError:
+                pass
+        return definitions
+
+    def __cachePath(self):
+        """
+        @return the cache file of the definitions, None if the cache folder can not be created.
+        """
+        try:
+            return cacheFile("generic-catalog", self.__directory, ".json")
+        except OSError:
+            return None
+
+    def __signature(self):
+        try:
+            entries = list(os.scandir(self.__directory))
+        except OSError:
+            return []
+        signature = []
+        for entry in entries:
+            if entry.is_file() and os.path.splitext(entry.name)[1].lower() in (".json", ".ini"):
+                stat = entry.stat()
+                signature.append([entry.name, stat.st_mtime_ns, stat.st_size])
+        return sorted(signature)
+
+    def __parse(self, path):
+        try:
+            if path.lower().endswith(".json"):
+                with open(path, "r", encoding="utf-8") as definitionFile:
+                    definition = json.load(definitionFile)
+            else:
+                parser = configparser.ConfigParser(interpolation=None)
+                parser.read(path, encoding="utf-8")
+                definition = dict(parser["Game"])
+        except Exception as e:
+            qWarning("Failed to read game definition {}: {}".format(path, e))
+            return None
+        if not isinstance(definition, dict) or not all(definition.get(key) for key in self.REQUIRED_KEYS):
+            qWarning("Game definition {} requires {}".format(path, ", ".join(self.REQUIRED_KEYS)))
+            return None
+        definition = {key: str(value) for key, value in definition.items()}
+        try:
+            definition["nexus_id"] = int(definition.get("nexus_id") or 0)
+        except ValueError:
+            definition["nexus_id"] = 0
+        return definition
+
+class GenericGameCatalogDetection(object):
+    """
+    Shared detection of the catalog games, the Steam libraries are scanned once for all of them
+    on a background thread started when the first game is initialized.
+    """
+    def __init__(self):
+        self.__games = []
+        self.__background = BackgroundDetection("GenericGamePlugin catalog", self.__detect)
+
+    def add(self, game):
+        self.__games.append(game)
+
+    def start(self):
+        self.__background.start()
+
+    def gamePath(self, game):
+        """
+        @return detected folder of game or None.
+        """
+        return (self.__background.result() or {}).get(game.name())
+
+    def __detect(self):
+        return GameDetector().detect([(g.name(), g.steamAPPId(), g.binaryName()) for g in self.__games])
+
 class GenericGame(mobase.IPluginGame):
     """
     Actual plugin class, extends the IPluginGame interface, meaning it adds support for a new game.
     """
 
-    def __init__(self):
+    """
+    Default values of the settings exposed in settings(), also used before the organizer is available.
+    """
+    DEFAULT_SETTINGS = {
+        "game_name": "Generic Game",
+        "short_name": "GenericGame",
+        "binary": "",
+        "data_subfolder": "",
+        "saves_location": "",
+        "mappings": "",
+        "deployment_mode": "",
+        }
+
+    def __init__(self, definition=None, detection=None):
+        """
+        @param definition optional game definition from the GenericGameCatalog, its values replace the defaults.
+        @param detection GenericGameCatalogDetection shared by the catalog games.
+        """
         super(GenericGame, self).__init__()
         self.__featureMap = {}
+        self.__organizer = None
+        self.__definition = definition or {}
+        self.__detection = detection
+        if detection is not None:
+            detection.add(self)
+        self.__defaults = dict(self.DEFAULT_SETTINGS)
+        for key in self.__defaults:
+            if key in self.__definition:
+                self.__defaults[key] = self.__definition[key]
+        self.__settings = dict(self.__defaults)
+        self.__mappingTrie = GenericGameMappingTrie()
+        self.m_GamePath=""
+        self.m_DataPath=""
 
     """
     Here IPlugin interface stuff. 
@@ -112,10 +505,15 @@ class GenericGame(mobase.IPluginGame):
         If you are able to detect game installation you may do so here and already set the various paths.
         MO2 will call setGamePath() in case the user already has an instance or selects a custom location.
         """
+        self.__organizer = organizer
         self.__featureMap[mobase.GamePlugins] = GenericGameGamePlugins(organizer)
-        self.m_GamePath=""
-        self.m_DataPath=""
         self.m_DocumentsPath=""
+        self.__refreshSettings()
+        organizer.onPluginSettingChanged(self.__onPluginSettingChanged)
+        self.__deployment = GenericGameDeployment(organizer, self)
+        organizer.onAboutToRun(self.__onAboutToRun)
+        if self.__detection is not None:
+            self.__detection.start()
         return True
 
     def name(self):
@@ -124,7 +522,10 @@ class GenericGame(mobase.IPluginGame):
         @note Please ensure you use a name that will not change. Do NOT include a version number in the name.
         Do NOT use a localizable string (tr()) here.
         Settings for example are tied to this name, if you rename your plugin you lose settings users made.
+        Games from the catalog are named after their short name, which must therefore not change either.
         """
+        if self.__definition:
+            return "GenericGamePlugin ({})".format(self.__definition["short_name"])
         return "GenericGamePlugin"
 
     def author(self):
@@ -139,6 +540,8 @@ class GenericGame(mobase.IPluginGame):
         """
         @return a short description of the plugin to be displayed to the user
         """
+        if self.__definition:
+            return self.__tr("Adds support for {} from a generic game definition.").format(self.__definition["game_name"])
         return self.__tr("Adds support for a generic game (this is basically a hack, so expect some features to not work or be unavailable).")
 
     def version(self):
@@ -163,7 +566,92 @@ class GenericGame(mobase.IPluginGame):
         Example: [mobase.PluginSetting("enabled", self.__tr("Enable this plugin), True)]
         To retrieve it: isEnabled = self.__organizer.pluginSetting(self.name(), "enabled")
         """
-        return []    
+        return [
+            mobase.PluginSetting("game_name", self.__tr("Name of the game displayed by MO2."), self.__defaults["game_name"]),
+            mobase.PluginSetting("short_name", self.__tr("Short name of the game, used for Nexus and internal settings storage."),
+                self.__defaults["short_name"]),
+            mobase.PluginSetting("binary", self.__tr("Executable of the game, relative to the game folder."), self.__defaults["binary"]),
+            mobase.PluginSetting("data_subfolder", self.__tr("Subfolder of the game folder in which mods are installed, empty for the game folder itself."),
+                self.__defaults["data_subfolder"]),
+            mobase.PluginSetting("saves_location", self.__tr("Folder where save games are stored, relative to the documents folder or absolute."),
+                self.__defaults["saves_location"]),
+            mobase.PluginSetting("mappings", self.__tr("Additional targets as a ';' separated list of subpath=target pairs, "
+                "e.g. \"Documents=C:/Users/me/Documents/My Games/Game\". Mod subfolders matching a subpath are virtualized to its target."),
+                self.__defaults["mappings"]),
+            mobase.PluginSetting("deployment_mode", self.__tr("Empty to virtualize mods, or \"hardlink\", \"symlink\", \"reflink\" or \"copy\" "
+                "to place the files of the active mods in the game folder before running a program. Replaced game files are "
+                "backed up and put back when switching back to the virtual file system."), self.__defaults["deployment_mode"])
+            ]
+
+    def setting(self, key):
+        """
+        @return cached value of one of the settings, only refreshed when the organizer reports a change.
+        """
+        return self.__settings[key]
+
+    def mappingSetting(self):
+        """
+        @return raw value of the "mappings" setting.
+        """
+        return self.__settings["mappings"]
+
+    def mappingTrie(self):
+        """
+        @return the GenericGameMappingTrie built from the "mappings" setting.
+        """
+        return self.__mappingTrie
+
+    def deployment(self):
+        """
+        @return the GenericGameDeployment of this game.
+        """
+        return self.__deployment
+
+    def isManaged(self):
+        """
+        @return true if this is the game managed by the current instance, callbacks fire for every game plugin.
+        """
+        return isManaged(self.__organizer, self)
+
+    def __refreshSettings(self):
+        for key, default in self.__defaults.items():
+            value = self.__organizer.pluginSetting(self.name(), key)
+            self.__settings[key] = default if value is None else value
+        self.__applySettings()
+
+    def __onPluginSettingChanged(self, pluginName, key, oldValue, newValue):
+        if pluginName != self.name() or key not in self.__settings:
+            return
+        self.__settings[key] = self.__defaults[key] if newValue is None else newValue
+        self.__applySettings()
+        if key == "deployment_mode" and self.__deployment.method() is None and self.isManaged():
+            self.__report("Undeployed mods", self.__deployment.undeploy())
+
+    def __onAboutToRun(self, appPath):
+        if self.isManaged() and self.__deployment.method() is not None:
+            self.__report("Deployed mods", self.__deployment.deploy())
+        return True
+
+    def __report(self, action, results):
+        for folder, (plan, skipped) in sorted(results.items()):
+            if not plan.isEmpty():
+                qInfo("{} to {}: {}".format(action, folder, plan))
+            for target in skipped[:20]:
+                qWarning("{}: {} could not be updated".format(folder, target))
+
+    def __applySettings(self):
+        """
+        Recompute everything derived from the settings so that getters stay simple lookups.
+        """
+        self.__mappingTrie = GenericGameMappingTrie(GenericGameMappingTrie.parse(self.__settings["mappings"]))
+        self.__updateDataPath()
+
+    def __updateDataPath(self):
+        subfolder = self.__settings["data_subfolder"].strip("/\\")
+        if self.m_GamePath and subfolder:
+            self.m_DataPath = os.path.join(self.m_GamePath, subfolder)
+        else:
+            self.m_DataPath = self.m_GamePath
 
     """
     Here IPluginGame interface stuff. 
@@ -173,7 +661,7 @@ class GenericGame(mobase.IPluginGame):
         """
         @return name of the game.
         """
-        return "Generic Game"
+        return self.__settings["game_name"]
     
     def gameShortName(self):
         """
@@ -182,7 +670,7 @@ class GenericGame(mobase.IPluginGame):
         The short name of the game is used for savegames, registry entries,
         Nexus API calls and some MO2 internal settings storage.
         """
-        return "GenericGame"
+        return self.__settings["short_name"]
     
     def gameIcon(self):
         """
@@ -204,7 +692,7 @@ class GenericGame(mobase.IPluginGame):
         """
         @brief get the Nexus name of the game, used for API calls and for mod pages resolution.
         """
-        return ""
+        return self.__definition.get("nexus_name", "")
     
     def nexusModOrganizerID(self):
         """
@@ -217,7 +705,7 @@ class GenericGame(mobase.IPluginGame):
         """
         @brief Get the Nexus Game ID (you may find this in a download link from nexus).
         """
-        return 0
+        return self.__definition.get("nexus_id", 0)
     
     def steamAPPId(self):
         """
@@ -225,13 +713,13 @@ class GenericGame(mobase.IPluginGame):
         @note if a game is available in multiple versions those might have different app ids.
             the plugin should try to return the right one
         """
-        return ""
+        return self.__definition.get("steam_id", "")
     
     def binaryName(self):
         """
         @brief Get the name of the executable that gets run.
         """
-        return ""
+        return self.__settings["binary"]
     
     def getLauncherName(self):
         """
@@ -246,7 +734,11 @@ class GenericGame(mobase.IPluginGame):
             mobase.ExecutableInfo("Display name", QFileInfo("absolute/path/to/exe"))
         The path can either be absolute or relative to the gameDirectory.
         """
-        return []
+        if not self.binaryName():
+            return []
+        game = mobase.ExecutableInfo(self.gameName(), QFileInfo(self.gameDirectory(), self.binaryName()))
+        game.withWorkingDirectory(self.gameDirectory())
+        return [game]
 
     def savegameExtension(self):
         """
@@ -349,6 +841,8 @@ class GenericGame(mobase.IPluginGame):
         """
         @brief See if the supplied directory looks like a valid installation of the game.
         """
+        if self.__definition and self.binaryName():
+            return QFileInfo(aQDir, self.binaryName()).exists()
         return True
     
     def isInstalled(self):
@@ -358,7 +852,13 @@ class GenericGame(mobase.IPluginGame):
         Used to allow fast instance creation. This function can be used to check
         registry keys for the path of the game and setting the internal game/data directories.
         """
-        return False
+        if self.__detection is None:
+            return False
+        path = self.__detection.gamePath(self)
+        if path is None:
+            return False
+        self.setGamePath(path)
+        return True
     
     def gameDirectory(self):
         """
@@ -380,19 +880,23 @@ class GenericGame(mobase.IPluginGame):
             relevant if the path wasn't auto-detected but had to be set manually by the user.
         """
         self.m_GamePath=pathStr
-        self.m_DataPath=self.m_GamePath
+        self.__updateDataPath()
     
     def documentsDirectory(self):
         """
         @return directory (QDir) of the documents folder where configuration files and such for this game reside.
+        The documents folder is the one of the Proton/Wine prefix when the game runs in one.
         """
-        return QDir("{}/My Games".format(QStandardPaths.writableLocation(QStandardPaths.DocumentsLocation)))
+        return QDir(os.path.join(KnownFolders.forGame(self.m_GamePath, self.steamAPPId()).path(DOCUMENTS), "My Games"))
     
     def savesDirectory(self):
         """
         @return path to where save games are stored.
         """
-        return self.documentsDirectory()
+        savesLocation = self.__settings["saves_location"]
+        if not savesLocation:
+            return self.documentsDirectory()
+        return QDir(os.path.join(self.documentsDirectory().absolutePath(), savesLocation))
     
     def _featureList(self):
         """
@@ -407,5 +911,12 @@ class GenericGame(mobase.IPluginGame):
     def __tr(self, str):
         return QCoreApplication.translate("GenericGame", str)
     
-def createPlugin():
-    return GenericGame()
\ No newline at end of file
+def createPlugins():
+    game = GenericGame()
+    plugins = [game, GenericGameFileMapper(game)]
+    catalog = GenericGameCatalog(os.path.join(DATA_PATH, "games"))
+    detection = GenericGameCatalogDetection()
+    for definition in catalog.definitions():
+        game = GenericGame(definition, detection)
+        plugins += [game, GenericGameFileMapper(game)]
+    return plugins
\ No newline at end of file
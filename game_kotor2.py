@@ -63,16 +63,36 @@ SOFTWARE.
 import sys
 import os
 import pathlib
-import winreg
-import re
 
-from PyQt5.QtCore import QCoreApplication, QDateTime, QDir, QFileInfo, QStandardPaths 
+from PyQt5.QtCore import QCoreApplication, QDateTime, QDir, QFileInfo, qInfo, qWarning
 from PyQt5.QtGui import QIcon
 from PyQt5.QtWidgets import QMessageBox, QFileIconProvider
 
 if "mobase" not in sys.modules:
     import mock_mobase as mobase
 
+# MO2 puts plugins/data on the python path, this also covers loading the plugin from elsewhere
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+if DATA_PATH not in sys.path:
+    sys.path.append(DATA_PATH)
+
+try:
+    import winreg
+except ImportError:
+    from gamesupport import registry as winreg
+
+from gamesupport.archives import ArchiveListing
+from gamesupport.backup import SaveBackup
+from gamesupport.cache import cacheFile
+from gamesupport.dedup import ModDeduplicator, isManaged, HARDLINK
+from gamesupport.detection import BackgroundDetection
+from gamesupport.deploy import InstanceDeployment
+from gamesupport.knownfolders import KnownFolders, DOCUMENTS
+from gamesupport.kotor import ContainerTables, ResourceIndex, findPath, listModules, moduleConflicts, saveModules, REPLACES_VANILLA, SAME_MODULE, SAVE_GAME
+from gamesupport.registry import nativePath, queryValue
+from gamesupport.savedeps import SaveDependencyCache, missingDependencies
+from gamesupport.thumbnails import GamePreview, decodeTpc
+
 class KotorTwoGameGamePlugins(mobase.GamePlugins):
     """
     Game feature class for plugin type mods.
@@ -95,6 +115,290 @@ class KotorTwoGameGamePlugins(mobase.GamePlugins):
     def getLoadOrder(self, loadOrder):
         return
 
+class KotorTwoGameModDataChecker(mobase.ModDataChecker):
+    """
+    Game feature checking the layout of mods before installation.
+    Mods are installed in the game folder, so a valid mod contains one of the game resource folders.
+    Archives with those folders nested inside another folder are moved up, and loose resources
+    (textures, 2da, scripts...) are moved to override/ where the game looks for them.
+    """
+    GAME_FOLDERS = set(["override", "modules", "movies", "lips", "streammusic", "streamsounds", "streamvoice", "texturepacks"])
+    OVERRIDE_EXTENSIONS = set([
+        "2da", "are", "bik", "dds", "dlg", "fac", "git", "gui", "ifo", "jrl", "lip", "lyt", "mdl", "mdx", "ncs", "nss",
+        "pth", "ssf", "tga", "tlk", "tpc", "txi", "utc", "utd", "ute", "uti", "utm", "utp", "uts", "utt", "utw", "vis",
+        "wav", "wok", "pwk", "dwk"])
+    MAX_DEPTH = 3
+
+    def __init__(self):
+        super(KotorTwoGameModDataChecker, self).__init__()
+
+    def dataLooksValid(self, filetree):
+        directory, hasGameFolders = self.__findModRoot(filetree)
+        if directory is None:
+            return mobase.ModDataChecker.INVALID
+        if directory is filetree and hasGameFolders:
+            return mobase.ModDataChecker.VALID
+        return mobase.ModDataChecker.FIXABLE
+
+    def fix(self, filetree):
+        directory, hasGameFolders = self.__findModRoot(filetree)
+        if directory is None:
+            return filetree
+        if hasGameFolders:
+            for entry in list(directory):
+                filetree.move(entry, "/", mobase.IFileTree.MERGE)
+        else:
+            for entry in list(directory):
+                if entry.isFile() and self.__isResource(entry):
+                    filetree.move(entry, "override/", mobase.IFileTree.MERGE)
+        if directory is not filetree and not len(directory):
+            directory.detach()
+        return filetree
+
+    def inspectArchive(self, archivePath):
+        """
+        @brief check the layout of an archive before it is extracted, only its file list is read.
+        @return CheckReturn
+        """
+        with ArchiveListing.open(archivePath) as listing:
+            return self.dataLooksValid(listing.tree())
+
+    def __isResource(self, entry):
+        return entry.suffix().lower() in self.OVERRIDE_EXTENSIONS
+
+    def __findModRoot(self, filetree):
+        """
+        @return (directory, True) for the shallowest directory containing game folders,
+            (directory, False) for the shallowest directory containing loose resources,
+            (None, False) if the tree has neither. The search stops at the first level with a match.
+        """
+        level = [filetree]
+        for depth in range(self.MAX_DEPTH):
+            nextLevel = []
+            looseResources = None
+            for directory in level:
+                for entry in directory:
+                    if entry.isDir():
+                        if entry.name().lower() in self.GAME_FOLDERS:
+                            return directory, True
+                        nextLevel.append(entry)
+                    elif looseResources is None and self.__isResource(entry):
+                        looseResources = directory
+            if looseResources is not None:
+                return looseResources, False
+            level = nextLevel
+        return None, False
+
+class KotorTwoGameOverridePlanner(object):
+    """
+    The game only reads the files directly inside override/, files of mods nested in subfolders of
+    override/ are ignored. This flattens them: the override/ files of all active mods, nested or not, are
+    resolved against the mod priority order and the nested winners are deployed directly in override/.
+    A winner goes to the game override/ folder, or to the overwrite folder when a lower priority mod has
+    the same file directly in its override/: the virtual file system would show that file over a real file
+    of the game folder, while the overwrite folder takes precedence over every mod.
+    The manifests are kept per target folder in the instance, so switching profiles only applies the difference.
+    """
+    def __init__(self, organizer, game):
+        self.__organizer = organizer
+        self.__game = game
+
+    def desiredFiles(self):
+        """
+        @return dict target folder -> dict "override/<name>" -> source file, for every nested file that wins its name.
+        """
+        winners = {}
+        direct = set()
+        modList = self.__organizer.modList()
+        for modName in modList.allModsByProfilePriority():
+            if not modList.state(modName) & mobase.ModState.active:
+                continue
+            override = self.__findOverride(os.path.join(self.__organizer.modsPath(), modName))
+            if override is None:
+                continue
+            modFiles = {}
+            for directory, dirs, files in os.walk(override):
+                nested = os.path.normcase(directory) != os.path.normcase(override)
+                for fileName in files:
+                    # the game loads the file directly in override/ over the nested copies of the same mod
+                    modFiles.setdefault(fileName.lower(), (os.path.join(directory, fileName), nested))
+            winners.update(modFiles)
+            direct.update(name for name, (source, nested) in modFiles.items() if not nested)
+        # files directly in override/ of the overwrite folder win over every mod, unless we deployed them
+        overwritePath = self.__organizer.overwritePath()
+        deployed = self.__deployment().deployer(overwritePath).manifest.entries
+        winners.update(self.__directFiles(os.path.join(overwritePath, "override"), deployed))
+        gamePath = self.__game.gameDirectory().absolutePath()
+        desired = {}
+        for name, (source, nested) in winners.items():
+            if nested:
+                desired.setdefault(overwritePath if name in direct else gamePath, {})["override/" + name] = source
+        return desired
+
+    def plan(self):
+        """
+        @return dict target folder -> gamesupport.deploy.DeploymentPlan against the previous deployment.
+        """
+        return self.__deployment().plan(self.desiredFiles())
+
+    def deploy(self, enabled=True):
+        """
+        @brief apply the plan, with enabled False every previously deployed file is removed.
+        @return dict target folder -> (DeploymentPlan, list of targets skipped because they could not be placed)
+        """
+        return self.__deployment().deploy(self.desiredFiles() if enabled else {})
+
+    def __deployment(self):
+        return InstanceDeployment(self.__organizer.basePath(), self.__game.gameShortName())
+
+    @staticmethod
+    def __directFiles(override, deployed):
+        """
+        @return dict lower case name -> (path, False) for the files of an override/ folder, leaving out deployed targets.
+        """
+        try:
+            return {entry.name.lower(): (entry.path, False) for entry in os.scandir(override)
+                    if entry.is_file() and "override/" + entry.name.lower() not in deployed}
+        except OSError:
+            return {}
+
+    @staticmethod
+    def __findOverride(modPath):
+        try:
+            for entry in os.scandir(modPath):
+                if entry.is_dir() and entry.name.lower() == "override":
+                    return entry.path
+        except OSError:
+            pass
+        return None
+
+class KotorTwoGameResourceAnalyzer(object):
+    """
+    Tells which files of a mod replace resources of the base game and which ones are new,
+    from the index of chitin.key, the BIF files and the modules of the game, and which active mods
+    conflict with the module containers (.mod, .rim, .erf) of a mod.
+    """
+    def __init__(self, organizer, game):
+        self.__organizer = organizer
+        self.__game = game
+        self.__index = None
+        self.__indexPath = None
+        self.__containerTables = ContainerTables()
+
+    def resourceIndex(self):
+        """
+        @return gamesupport.kotor.ResourceIndex of the game, built on first use and cached on disk.
+        """
+        gamePath = self.__game.gameDirectory().absolutePath()
+        if self.__index is None or self.__indexPath != gamePath:
+            self.__index = ResourceIndex(gamePath, cacheFile("kotor2", gamePath))
+            self.__indexPath = gamePath
+        return self.__index.load()
+
+    def classifyOverride(self, modName):
+        """
+        @return dict name -> REPLACES_VANILLA or NEW for the resources of the override/ folder of a mod,
+            nested folders included as they are flattened on deployment.
+        """
+        index = self.resourceIndex()
+        result = {}
+        modPath = os.path.join(self.__organizer.modsPath(), modName)
+        try:
+            overrides = [entry.path for entry in os.scandir(modPath) if entry.is_dir() and entry.name.lower() == "override"]
+        except OSError:
+            overrides = []
+        for override in overrides:
+            for directory, dirs, files in os.walk(override):
+                for fileName in files:
+                    classification = index.classify(fileName)
+                    if classification is not None:
+                        result[fileName.lower()] = classification
+        return result
+
+    def moduleConflicts(self, modName):
+        """
+        @return list of gamesupport.kotor.ModuleConflict between the modules/ containers of a mod and the active mods.
+        """
+        modList = self.__organizer.modList()
+        mods = [(name, os.path.join(self.__organizer.modsPath(), name)) for name in modList.allModsByProfilePriority()
+                if name == modName or modList.state(name) & mobase.ModState.active]
+        if all(name != modName for name, path in mods):
+            mods.append((modName, os.path.join(self.__organizer.modsPath(), modName)))
+        return moduleConflicts(modName, mods, self.__containerTables)
+
+    def report(self, modName):
+        """
+        @return summary of the analysis of a mod, for the log.
+        """
+        classification = self.classifyOverride(modName)
+        replaced = sum(1 for value in classification.values() if value == REPLACES_VANILLA)
+        lines = ["{}: {} override files replace base game resources, {} are new".format(modName, replaced, len(classification) - replaced)]
+        for conflict in self.moduleConflicts(modName):
+            if conflict.kind == SAME_MODULE:
+                lines.append("  modules/{} is also installed by {}, only one of them is loaded".format(conflict.module, conflict.otherMod))
+            else:
+                lines.append("  {} resources of modules/{} are replaced by the override of {}".format(
+                    len(conflict.resources), conflict.module, conflict.otherMod))
+        return "\n".join(lines)
+
+class KotorTwoGameSaveDependencies(object):
+    """
+    Mods a save needs that are not enabled in the current profile: the modules stored in the save
+    that are neither part of the game nor shipped by an enabled mod.
+    """
+    def __init__(self, organizer, game, resourceAnalyzer):
+        self.__organizer = organizer
+        self.__game = game
+        self.__resourceAnalyzer = resourceAnalyzer
+        self.__cache = None
+
+    def saves(self):
+        """
+        @return save folders, most recent first.
+        """
+        savesPath = self.__game.savesDirectory().absolutePath()
+        try:
+            saves = [(entry.stat().st_mtime, entry.path) for entry in os.scandir(savesPath) if entry.is_dir()]
+        except OSError:
+            return []
+        return [path for mtime, path in sorted(saves, reverse=True)]
+
+    def check(self, saves):
+        """
+        @param saves list of save folders or SAVEGAME.sav files.
+        @return dict save -> {module: list of the installed mods shipping it} for the modules that
+            no enabled mod ships.
+        """
+        savesPath = self.__game.savesDirectory().absolutePath()
+        if self.__cache is None or self.__cache[0] != savesPath:
+            self.__cache = (savesPath, SaveDependencyCache(cacheFile("kotor2-saves", savesPath)))
+        cache = self.__cache[1]
+        vanilla = set(os.path.splitext(os.path.basename(container))[0].lower()
+                      for container in self.__resourceAnalyzer.resourceIndex().containers() if container.startswith("modules/"))
+        modList = self.__organizer.modList()
+        providers = {}
+        enabled = set()
+        for modName in modList.allModsByProfilePriority():
+            if modList.state(modName) & mobase.ModState.active:
+                enabled.add(modName)
+            modules = findPath(os.path.join(self.__organizer.modsPath(), modName), "modules")
+            for module in listModules(modules or ""):
+                providers.setdefault(os.path.splitext(os.path.basename(module))[0].lower(), []).append(modName)
+        result = {}
+        for save in saves:
+            path = findPath(save, SAVE_GAME) if os.path.isdir(save) else save
+            dependencies = cache.dependencies(path, saveModules) - vanilla if path is not None else frozenset()
+            result[save] = missingDependencies(dependencies, providers, enabled)
+        cache.save()
+        return result
+
+    def getMissingAssets(self, save):
+        """
+        @param save path of a save folder, or a mobase.ISaveGame.
+        """
+        path = save if isinstance(save, str) else save.getFilepath()
+        return self.check([path])[path]
+
 class KotorTwoGame(mobase.IPluginGame):
     """
     Actual plugin class, extends the IPluginGame interface, meaning it adds support for a new game.
@@ -114,10 +418,24 @@ class KotorTwoGame(mobase.IPluginGame):
         If you are able to detect game installation you may do so here and already set the various paths.
         MO2 will call setGamePath() in case the user already has an instance or selects a custom location.
         """
+        self.__organizer = organizer
         self.__featureMap[mobase.GamePlugins] = KotorTwoGameGamePlugins(organizer)
+        self.__featureMap[mobase.ModDataChecker] = KotorTwoGameModDataChecker()
+        self.__deduplicator = ModDeduplicator(organizer, self, qInfo)
+        organizer.onUserInterfaceInitialized(self.__onUserInterfaceInitialized)
+        self.__overridePlanner = KotorTwoGameOverridePlanner(organizer, self)
+        organizer.onAboutToRun(self.__onAboutToRun)
+        organizer.onFinishedRun(self.__onFinishedRun)
+        self.__resourceAnalyzer = KotorTwoGameResourceAnalyzer(organizer, self)
+        self.__saveDependencies = KotorTwoGameSaveDependencies(organizer, self, self.__resourceAnalyzer)
+        self.__saveBackup = SaveBackup(organizer, self, qInfo, qWarning)
+        organizer.onModInstalled(self.__onModInstalled)
+        organizer.downloadManager().onDownloadComplete(self.__onDownloadComplete)
         self.m_GamePath=""
         self.m_DataPath=""
         self.m_DocumentsPath=""
+        self.__detection = BackgroundDetection(self.name(), self.__detectGamePath)
+        self.__detection.start()
         return True
 
     def name(self):
@@ -165,7 +483,17 @@ class KotorTwoGame(mobase.IPluginGame):
         Example: [mobase.PluginSetting("enabled", self.__tr("Enable this plugin), True)]
         To retrieve it: isEnabled = self.__organizer.pluginSetting(self.name(), "enabled")
         """
-        return []    
+        return [
+            mobase.PluginSetting("deduplicate_mods", self.__tr("Replace identical mod files by links to a single copy when MO2 starts. "
+                "Linked files share their content, editing one of them in place edits all of them."), False),
+            mobase.PluginSetting("deduplicate_mode", self.__tr("How duplicates are linked, \"hardlink\" or \"reflink\" (copy-on-write, "
+                "falls back to hardlinks if the filesystem does not support it)."), HARDLINK),
+            mobase.PluginSetting("flatten_override", self.__tr("Before running a program, deploy the files that mods put in "
+                "subfolders of override/ directly in the override/ folder of the game, where the game can find them."), False),
+            mobase.PluginSetting("backup_saves", self.__tr("Snapshot the saves folder before and after running a program. "
+                "Snapshots are deduplicated and compressed, saves that did not change take no space."), False),
+            mobase.PluginSetting("backup_keep", self.__tr("Number of save snapshots to keep, 0 keeps all of them."), 0)
+            ]
 
     """
     Here IPluginGame interface stuff. 
@@ -363,15 +691,19 @@ class KotorTwoGame(mobase.IPluginGame):
         Used to allow fast instance creation. This function can be used to check
         registry keys for the path of the game and setting the internal game/data directories.
         """
-        try:
-            RawKey = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, "SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Uninstall\\Steam App 208580")
-            Key = winreg.QueryValueEx(RawKey, "InstallLocation")
-            winreg.CloseKey(RawKey)
-            Dir = re.search("'(.*)'", str(Key))
-            self.setGamePath(str(Dir[1]))
-            return True
-        except:
+        path = self.__detection.result()
+        if not path:
             return False
+        self.setGamePath(path)
+        return True
+
+    def __detectGamePath(self):
+        """
+        @return the install location of the game, called on the background thread of the detection.
+        """
+        path = queryValue(winreg.HKEY_LOCAL_MACHINE,
+            "SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Uninstall\\Steam App 208580", "InstallLocation", appId=self.steamAPPId())
+        return nativePath(path) if path else None
     
     def gameDirectory(self):
         """
@@ -398,15 +730,97 @@ class KotorTwoGame(mobase.IPluginGame):
     def documentsDirectory(self):
         """
         @return directory (QDir) of the documents folder where configuration files and such for this game reside.
+        The documents folder is the one of the Proton/Wine prefix when the game runs in one.
         """
-        return QDir("{}/My Games".format(QStandardPaths.writableLocation(QStandardPaths.DocumentsLocation)))
+        return QDir(os.path.join(KnownFolders.forGame(self.m_GamePath, self.steamAPPId()).path(DOCUMENTS), "My Games"))
     
     def savesDirectory(self):
         """
-        @return path to where save games are stored.
+        @return path to where save games are stored, the game keeps them in its own folder.
         """
-        return self.documentsDirectory()
+        return QDir(os.path.join(self.m_GamePath, "saves"))
     
+    def deduplicator(self):
+        """
+        @return the gamesupport.dedup.ModDeduplicator of this plugin.
+        """
+        return self.__deduplicator
+
+    def isManaged(self):
+        """
+        @return true if this is the game managed by the current instance, callbacks fire for every game plugin.
+        """
+        return isManaged(self.__organizer, self)
+
+    def overridePlanner(self):
+        """
+        @return the KotorTwoGameOverridePlanner of this plugin.
+        """
+        return self.__overridePlanner
+
+    def resourceAnalyzer(self):
+        """
+        @return the KotorTwoGameResourceAnalyzer of this plugin.
+        """
+        return self.__resourceAnalyzer
+
+    def saveDependencies(self):
+        """
+        @return the KotorTwoGameSaveDependencies of this plugin.
+        """
+        return self.__saveDependencies
+
+    def saveBackup(self):
+        """
+        @return the gamesupport.backup.SaveBackup of this plugin.
+        """
+        return self.__saveBackup
+
+    def __onDownloadComplete(self, downloadId):
+        """
+        @brief check the layout of a downloaded archive before it is installed, only its file list is read.
+        """
+        if not self.isManaged():
+            return
+        path = self.__organizer.downloadManager().downloadPath(downloadId)
+        try:
+            result = self.__featureMap[mobase.ModDataChecker].inspectArchive(path)
+        except (OSError, ValueError) as e:
+            qWarning("Could not inspect {}: {}".format(path, e))
+            return
+        if result == mobase.ModDataChecker.INVALID:
+            qWarning("{} has neither game folders nor override resources, it can not be installed automatically".format(
+                os.path.basename(path)))
+
+    def __onModInstalled(self, modName):
+        if self.isManaged():
+            try:
+                qInfo(self.__resourceAnalyzer.report(modName))
+            except (OSError, ValueError) as e:
+                qWarning("Could not analyze the resources of {}: {}".format(modName, e))
+
+    def __onAboutToRun(self, appPath):
+        if self.isManaged():
+            if self.__saveBackup.isEnabled():
+                self.__saveBackup.run("before " + os.path.basename(appPath))
+            for folder, (plan, skipped) in sorted(self.__overridePlanner.deploy(
+                    bool(self.__organizer.pluginSetting(self.name(), "flatten_override"))).items()):
+                if not plan.isEmpty():
+                    qInfo("Flattened override to {}: {}, {} skipped".format(folder, plan, len(skipped)))
+            for save, missing in self.__saveDependencies.check(self.__saveDependencies.saves()[:1]).items():
+                for module, mods in sorted(missing.items()):
+                    qWarning("{} uses the module {}, shipped by {}, which is not enabled".format(
+                        os.path.basename(save), module, ", ".join(mods) or "no installed mod"))
+        return True
+
+    def __onFinishedRun(self, appPath, exitCode):
+        if self.isManaged() and self.__saveBackup.isEnabled():
+            self.__saveBackup.start("after " + os.path.basename(appPath))
+
+    def __onUserInterfaceInitialized(self, mainWindow):
+        if self.__deduplicator.isEnabled():
+            self.__deduplicator.start()
+
     def _featureList(self):
         """
         Map of features that the game supports where each feature is a class abiding to
@@ -420,5 +834,7 @@ class KotorTwoGame(mobase.IPluginGame):
     def __tr(self, str):
         return QCoreApplication.translate("KotorTwoGame", str)
     
-def createPlugin():
-    return KotorTwoGame()
\ No newline at end of file
+def createPlugins():
+    game = KotorTwoGame()
+    return [game, GamePreview(game, "Kotor 2 Preview", "Cached previews of the TGA and TPC textures of KOTOR 2 mods.",
+        {".tga": GamePreview.decodeWithQt, ".tpc": decodeTpc})]
@@ -63,16 +63,35 @@ SOFTWARE.
 import sys
 import os
 import pathlib
-import re
-import winreg
 
-from PyQt5.QtCore import QCoreApplication, QDateTime, QDir, QFileInfo, QStandardPaths
+from PyQt5.QtCore import QCoreApplication, QDateTime, QDir, QFileInfo, qInfo, qWarning
 from PyQt5.QtGui import QIcon
 from PyQt5.QtWidgets import QMessageBox, QFileIconProvider
 
 if "mobase" not in sys.modules:
     import mock_mobase as mobase
 
+# MO2 puts plugins/data on the python path, this also covers loading the plugin from elsewhere
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+if DATA_PATH not in sys.path:
+    sys.path.append(DATA_PATH)
+
+try:
+    import winreg
+except ImportError:
+    from gamesupport import registry as winreg
+
+from gamesupport.archives import ArchiveListing, InspectionCache
+from gamesupport.backup import SaveBackup
+from gamesupport.cache import cacheFile
+from gamesupport.dedup import isManaged
+from gamesupport.detection import BackgroundDetection
+from gamesupport.knownfolders import KnownFolders, ROAMING_APPDATA
+from gamesupport.registry import nativePath, queryValue
+from gamesupport.savedeps import SaveDependencyCache, missingDependencies
+from gamesupport.stardew import ContentPatcherIndex, JsonFileCache, SmapiLogAnalyzer, parseJson, readManifests, saveModTypes, typeProviders, HARD, SMAPI_LOG
+from gamesupport.xnb import XnbFingerprintIndex, assetName
+
 class GenericGameGamePlugins(mobase.GamePlugins):
     """
     Game feature class for plugin type mods.
@@ -95,6 +114,237 @@ class GenericGameGamePlugins(mobase.GamePlugins):
     def getLoadOrder(self, loadOrder):
         return
 
+class StardewValleyModDataChecker(mobase.ModDataChecker):
+    """
+    Game feature checking the layout of mods before installation.
+    SMAPI loads every folder of Mods/ containing a manifest.json, so a valid mod has such folders at its top level.
+    Archives with the mod folders nested inside other folders are fixed by moving them up.
+    """
+    MANIFEST = "manifest.json"
+    MAX_DEPTH = 3
+
+    def __init__(self):
+        super(StardewValleyModDataChecker, self).__init__()
+        self.__inspections = InspectionCache(self.__inspect)
+
+    def dataLooksValid(self, filetree):
+        return self.__check(filetree, self.__findModRoot(filetree))
+
+    def fix(self, filetree):
+        modRoot = self.__findModRoot(filetree)
+        if modRoot is None or modRoot is filetree:
+            return filetree
+        for entry in list(modRoot):
+            filetree.move(entry, "/", mobase.IFileTree.MERGE)
+        modRoot.detach()
+        return filetree
+
+    def inspectArchive(self, archivePath):
+        """
+        @brief check the layout of an archive before it is extracted, with the checks of dataLooksValid() on its file list.
+        The archive is inspected once per version of the file, the check of a download and of its installation share it.
+        Only the file list and the manifest.json of each mod folder are read from the archive.
+        @return (CheckReturn, dict of manifest path in the archive -> parsed manifest)
+        """
+        return self.__inspections.get(archivePath)
+
+    def __inspect(self, archivePath):
+        with ArchiveListing.open(archivePath) as listing:
+            tree = listing.tree()
+            modRoot = self.__findModRoot(tree)
+            result = self.__check(tree, modRoot)
+            if result == mobase.ModDataChecker.INVALID:
+                return result, {}
+            paths = [entry.find(self.MANIFEST).path() for entry in modRoot if entry.isDir() and entry.exists(self.MANIFEST)]
+            manifests = {}
+            for path, data in listing.readMany(paths).items():
+                try:
+                    manifests[path] = parseJson(data)
+                except ValueError:
+                    pass
+        return result, manifests
+
+    def __check(self, filetree, modRoot):
+        if modRoot is None:
+            return mobase.ModDataChecker.INVALID
+        if modRoot is filetree:
+            return mobase.ModDataChecker.VALID
+        return mobase.ModDataChecker.FIXABLE
+
+    def __findModRoot(self, filetree):
+        """
+        @return the shallowest directory having a subfolder that contains a manifest.json, or None.
+        The search goes level by level and stops at the first match.
+        """
+        level = [filetree]
+        for depth in range(self.MAX_DEPTH):
+            nextLevel = []
+            for directory in level:
+                for entry in directory:
+                    if not entry.isDir():
+                        continue
+                    if entry.exists(self.MANIFEST, mobase.IFileTree.FILE):
+                        return directory
+                    nextLevel.append(entry)
+            level = nextLevel
+        return None
+
+class StardewValleyModIndex(object):
+    """
+    SMAPI mods of the active MO2 mods and the game assets changed by their Content Patcher packs.
+    The parsed manifest.json and content files are cached on disk, refreshing only reads the files that changed.
+    """
+    def __init__(self, organizer):
+        self.__organizer = organizer
+        self.__modsPath = None
+        self.__files = None
+        self.__contentPatcher = None
+        self.__manifests = []
+
+    def refresh(self, extraMods=()):
+        """
+        @brief index the active mods, and extraMods even if they are not active (e.g. a mod being installed).
+        @return self
+        """
+        modsPath = self.__updateModsPath()
+        modList = self.__organizer.modList()
+        names = [name for name in modList.allModsByProfilePriority()
+                 if name in extraMods or modList.state(name) & mobase.ModState.active]
+        names += [name for name in extraMods if name not in names]
+        self.__manifests = readManifests([(name, os.path.join(modsPath, name)) for name in names], self.__files)
+        self.__contentPatcher.index(self.__manifests)
+        self.__files.save()
+        return self
+
+    def manifests(self):
+        """
+        @return list of gamesupport.stardew.ModManifest of the last refresh.
+        """
+        return self.__manifests
+
+    def installedManifests(self):
+        """
+        @return list of gamesupport.stardew.ModManifest of every installed mod, active or not.
+        """
+        modsPath = self.__updateModsPath()
+        manifests = readManifests([(name, os.path.join(modsPath, name))
+                                   for name in self.__organizer.modList().allModsByProfilePriority()], self.__files)
+        self.__files.save()
+        return manifests
+
+    def __updateModsPath(self):
+        modsPath = self.__organizer.modsPath()
+        if modsPath != self.__modsPath:
+            self.__modsPath = modsPath
+            self.__files = JsonFileCache(cacheFile("stardew", modsPath))
+            self.__contentPatcher = ContentPatcherIndex(self.__files)
+        return modsPath
+
+    def assetConflicts(self, modName=None):
+        """
+        @return list of gamesupport.stardew.AssetConflict of the last refresh, only the ones involving modName if given.
+        """
+        if self.__contentPatcher is None:
+            return []
+        return [conflict for conflict in self.__contentPatcher.conflicts()
+                if modName is None or any(action.mod == modName for action in conflict.actions)]
+
+class StardewValleyXnbChecker(object):
+    """
+    Checks the .xnb files that old style mods put in Content/ against the headers of the game files,
+    to spot replacements built for another platform, with an unsupported compression or for an older game version.
+    """
+    def __init__(self, organizer, game):
+        self.__organizer = organizer
+        self.__game = game
+        self.__index = None
+
+    def fingerprintIndex(self):
+        """
+        @return gamesupport.xnb.XnbFingerprintIndex of the game Content folder, only changed files are read again.
+        """
+        contentPath = os.path.join(self.__game.gameDirectory().absolutePath(), "Content")
+        if self.__index is None or self.__index[0] != contentPath:
+            self.__index = (contentPath, XnbFingerprintIndex(contentPath, cacheFile("stardew-xnb", contentPath)))
+        self.__index[1].scan()
+        return self.__index[1]
+
+    def replacements(self, modName):
+        """
+        @return dict asset name -> path of the .xnb files of a mod, relative to its Content folder if it has one.
+        """
+        modPath = os.path.join(self.__organizer.modsPath(), modName)
+        replacements = {}
+        for directory, dirs, files in os.walk(modPath):
+            for fileName in files:
+                if not fileName.lower().endswith(".xnb"):
+                    continue
+                parts = os.path.relpath(os.path.join(directory, fileName), modPath).replace("\\", "/").split("/")
+                lowerParts = [part.lower() for part in parts]
+                if "content" in lowerParts:
+                    parts = parts[lowerParts.index("content") + 1:]
+                replacements[assetName("/".join(parts))] = os.path.join(directory, fileName)
+        return replacements
+
+    def check(self, modName):
+        """
+        @return list of gamesupport.xnb.XnbIssue of the .xnb files of a mod.
+        """
+        replacements = self.replacements(modName)
+        if not replacements:
+            return []
+        return self.fingerprintIndex().check(replacements)
+
+class StardewValleySaveDependencies(object):
+    """
+    Mods a save needs that are not enabled in the current profile, from the mod added types the save contains.
+    """
+    def __init__(self, organizer, game, modIndex):
+        self.__organizer = organizer
+        self.__game = game
+        self.__modIndex = modIndex
+        self.__cache = None
+
+    def saves(self):
+        """
+        @return save files, most recent first. Each save is a Saves/<name>/<name> file.
+        """
+        savesPath = self.__game.savesDirectory().absolutePath()
+        try:
+            saves = [os.path.join(entry.path, entry.name) for entry in os.scandir(savesPath) if entry.is_dir()]
+        except OSError:
+            return []
+        saves = [(os.stat(path).st_mtime, path) for path in saves if os.path.isfile(path)]
+        return [path for mtime, path in sorted(saves, reverse=True)]
+
+    def check(self, saves):
+        """
+        @param saves list of save files or folders.
+        @return dict save -> {mod added type: list of the installed mods that may provide it} for the types
+            that no enabled mod provides.
+        """
+        savesPath = self.__game.savesDirectory().absolutePath()
+        if self.__cache is None or self.__cache[0] != savesPath:
+            self.__cache = (savesPath, SaveDependencyCache(cacheFile("stardew-saves", savesPath)))
+        cache = self.__cache[1]
+        providers = typeProviders(self.__modIndex.installedManifests())
+        modList = self.__organizer.modList()
+        enabled = set(name for name in modList.allModsByProfilePriority() if modList.state(name) & mobase.ModState.active)
+        result = {}
+        for save in saves:
+            path = os.path.join(save, os.path.basename(save)) if os.path.isdir(save) else save
+            dependencies = cache.dependencies(path, saveModTypes)
+            result[save] = missingDependencies(dependencies, {name: providers(name) for name in dependencies}, enabled)
+        cache.save()
+        return result
+
+    def getMissingAssets(self, save):
+        """
+        @param save path of a save file, or a mobase.ISaveGame.
+        """
+        path = save if isinstance(save, str) else save.getFilepath()
+        return self.check([path])[path]
+
 class StardewValley(mobase.IPluginGame):
     """
     Actual plugin class, extends the IPluginGame interface, meaning it adds support for a new game.
@@ -114,10 +364,23 @@ class StardewValley(mobase.IPluginGame):
         If you are able to detect game installation you may do so here and already set the various paths.
         MO2 will call setGamePath() in case the user already has an instance or selects a custom location.
         """
+        self.__organizer = organizer
         self.__featureMap[mobase.GamePlugins] = GenericGameGamePlugins(organizer)
+        self.__featureMap[mobase.ModDataChecker] = StardewValleyModDataChecker()
+        self.__modIndex = StardewValleyModIndex(organizer)
+        self.__xnbChecker = StardewValleyXnbChecker(organizer, self)
+        self.__saveDependencies = StardewValleySaveDependencies(organizer, self, self.__modIndex)
+        self.__saveBackup = SaveBackup(organizer, self, qInfo, qWarning)
+        organizer.onAboutToRun(self.__onAboutToRun)
+        self.__smapiLog = None
+        organizer.onFinishedRun(self.__onFinishedRun)
+        organizer.onModInstalled(self.__onModInstalled)
+        organizer.downloadManager().onDownloadComplete(self.__onDownloadComplete)
         self.m_GamePath=""
         self.m_DataPath=""
         self.m_DocumentsPath=""
+        self.__detection = BackgroundDetection(self.name(), self.__detectGamePath)
+        self.__detection.start()
         return True
 
     def name(self):
@@ -165,7 +428,11 @@ class StardewValley(mobase.IPluginGame):
         Example: [mobase.PluginSetting("enabled", self.__tr("Enable this plugin), True)]
         To retrieve it: isEnabled = self.__organizer.pluginSetting(self.name(), "enabled")
         """
-        return []    
+        return [
+            mobase.PluginSetting("backup_saves", self.__tr("Snapshot the saves folder before and after running a program. "
+                "Snapshots are deduplicated and compressed, saves that did not change take no space."), False),
+            mobase.PluginSetting("backup_keep", self.__tr("Number of save snapshots to keep, 0 keeps all of them."), 0)
+            ]
 
     """
     Here IPluginGame interface stuff. 
@@ -364,15 +631,19 @@ class StardewValley(mobase.IPluginGame):
         Used to allow fast instance creation. This function can be used to check
         registry keys for the path of the game and setting the internal game/data directories.
         """
-        try:
-            RawKey = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, "SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Uninstall\\Steam App 413150")
-            Key = winreg.QueryValueEx(RawKey, "InstallLocation")
-            winreg.CloseKey(RawKey)
-            Dir = re.search("'(.*)'", str(Key))
-            self.setGamePath(str(Dir[1]))
-            return True
-        except:
+        path = self.__detection.result()
+        if not path:
             return False
+        self.setGamePath(path)
+        return True
+
+    def __detectGamePath(self):
+        """
+        @return the install location of the game, called on the background thread of the detection.
+        """
+        path = queryValue(winreg.HKEY_LOCAL_MACHINE,
+            "SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Uninstall\\Steam App 413150", "InstallLocation", appId=self.steamAPPId())
+        return nativePath(path) if path else None
     
     def gameDirectory(self):
         """
@@ -399,15 +670,160 @@ class StardewValley(mobase.IPluginGame):
     def documentsDirectory(self):
         """
         @return directory (QDir) of the documents folder where configuration files and such for this game reside.
+        This is %APPDATA%/StardewValley, inside the Proton/Wine prefix when the game runs in one.
         """
-        return QDir("{}/StardewValley/Saves".format(QStandardPaths.writableLocation(QStandardPaths.AppDataLocation)))
+        return QDir(os.path.join(KnownFolders.forGame(self.m_GamePath, self.steamAPPId()).path(ROAMING_APPDATA), "StardewValley"))
     
     def savesDirectory(self):
         """
         @return path to where save games are stored.
         """
-        return self.documentsDirectory()
+        return QDir(os.path.join(self.documentsDirectory().absolutePath(), "Saves"))
     
+    def isManaged(self):
+        """
+        @return true if this is the game managed by the current instance, callbacks fire for every game plugin.
+        """
+        return isManaged(self.__organizer, self)
+
+    def modIndex(self):
+        """
+        @return the StardewValleyModIndex of this plugin.
+        """
+        return self.__modIndex
+
+    def saveDependencies(self):
+        """
+        @return the StardewValleySaveDependencies of this plugin.
+        """
+        return self.__saveDependencies
+
+    def saveBackup(self):
+        """
+        @return the gamesupport.backup.SaveBackup of this plugin.
+        """
+        return self.__saveBackup
+
+    def __onAboutToRun(self, appPath):
+        if self.isManaged():
+            if self.__saveBackup.isEnabled():
+                self.__saveBackup.run("before " + os.path.basename(appPath))
+            saves = self.__saveDependencies.saves()[:1]
+            for save, missing in self.__saveDependencies.check(saves).items():
+                for typeName, mods in sorted(missing.items()):
+                    qWarning("{} uses {}, provided by {}, which is not enabled".format(
+                        os.path.basename(save), typeName, ", ".join(mods) or "no installed mod"))
+        return True
+
+    def xnbChecker(self):
+        """
+        @return the StardewValleyXnbChecker of this plugin.
+        """
+        return self.__xnbChecker
+
+    def smapiLogPath(self):
+        return os.path.join(self.documentsDirectory().absolutePath(), "ErrorLogs", SMAPI_LOG)
+
+    def smapiLogSummary(self):
+        """
+        @brief read what SMAPI logged since the previous call, the log is not read again from the start.
+        @return dict MO2 mod name (None for SMAPI and mods that are not managed by MO2) ->
+            dict SMAPI mod name -> gamesupport.stardew.LogSummary, for the whole current log.
+        """
+        logPath = self.smapiLogPath()
+        if self.__smapiLog is None or self.__smapiLog[0] != logPath:
+            self.__smapiLog = (logPath, SmapiLogAnalyzer(cacheFile("stardew-smapi", logPath)))
+        analyzer = self.__smapiLog[1]
+        analyzer.update(logPath)
+        return analyzer.summariesByMod(self.__modIndex.refresh().manifests())
+
+    def __onFinishedRun(self, appPath, exitCode):
+        if self.isManaged() and self.__saveBackup.isEnabled():
+            self.__saveBackup.start("after " + os.path.basename(appPath))
+        if not self.isManaged() or not os.path.isfile(self.smapiLogPath()):
+            return
+        try:
+            summaries = self.smapiLogSummary()
+        except (OSError, ValueError) as e:
+            qWarning("Could not read the SMAPI log: {}".format(e))
+            return
+        for modName, mods in sorted(summaries.items(), key=lambda item: item[0] or ""):
+            for smapiName, summary in sorted(mods.items()):
+                if summary.errors:
+                    qWarning("SMAPI log: {} ({}) {}".format(smapiName, modName or "not managed by MO2", summary))
+
+    def __onDownloadComplete(self, downloadId):
+        """
+        @brief check the layout of a downloaded archive before it is installed, from its file list and manifest.json files.
+        """
+        if not self.isManaged():
+            return
+        path = self.__organizer.downloadManager().downloadPath(downloadId)
+        inspection = self.__inspectArchive(path)
+        if inspection is None:
+            return
+        result, manifests = inspection
+        if result == mobase.ModDataChecker.INVALID:
+            qWarning("{} has no mod folder with a manifest.json, it can not be installed automatically".format(os.path.basename(path)))
+        else:
+            names = [str(manifest.get("Name") or member) if isinstance(manifest, dict) else member
+                     for member, manifest in sorted(manifests.items())]
+            qInfo("{} contains {}".format(os.path.basename(path), ", ".join(names) or "no readable manifest.json"))
+
+    def __onModInstalled(self, modName):
+        if not self.isManaged():
+            return
+        try:
+            for issue in self.__xnbChecker.check(modName):
+                qWarning("{}: {} is {}, {}".format(modName, issue.asset, issue.issue, issue.details))
+            modIndex = self.__modIndex.refresh([modName])
+            conflicts = modIndex.assetConflicts(modName)
+        except (OSError, ValueError) as e:
+            qWarning("Could not analyze {}: {}".format(modName, e))
+            return
+        for conflict in conflicts:
+            mods = ", ".join(sorted(set(action.mod for action in conflict.actions)))
+            if conflict.kind == HARD:
+                qWarning("{} is loaded by several mods, only one of them is used: {}".format(conflict.asset, mods))
+            else:
+                qInfo("{} is edited by several mods: {}".format(conflict.asset, mods))
+        self.__checkUniqueIds(modName, modIndex.manifests())
+
+    def __checkUniqueIds(self, modName, manifests):
+        """
+        @brief warn about the SMAPI mods of the installed archive whose UniqueID an active mod already has, SMAPI
+            skips duplicates. The manifest.json files are the ones read when the archive was downloaded.
+        """
+        mod = self.__organizer.modList().getMod(modName)
+        archive = mod.installationFile() if mod is not None else ""
+        if not archive:
+            return
+        inspection = self.__inspectArchive(os.path.join(self.__organizer.downloadsPath(), archive))
+        if inspection is None:
+            return
+        providers = {}
+        for manifest in manifests:
+            if manifest.mod != modName and manifest.uniqueId:
+                providers.setdefault(manifest.uniqueId.lower(), []).append(manifest.mod)
+        for member, manifest in sorted(inspection[1].items()):
+            uniqueId = str(manifest.get("UniqueID", "")) if isinstance(manifest, dict) else ""
+            if uniqueId.lower() in providers:
+                qWarning("{}: {} has the UniqueID of {}, SMAPI only loads one of them".format(
+                    modName, uniqueId, ", ".join(sorted(set(providers[uniqueId.lower()])))))
+
+    def __inspectArchive(self, path):
+        """
+        @return (CheckReturn, manifests) of StardewValleyModDataChecker.inspectArchive(), None if the archive is gone
+            or can not be read.
+        """
+        if not os.path.isfile(path):
+            return None
+        try:
+            return self.__featureMap[mobase.ModDataChecker].inspectArchive(path)
+        except (OSError, ValueError) as e:
+            qWarning("Could not inspect {}: {}".format(path, e))
+            return None
+
     def _featureList(self):
         """
         Map of features that the game supports where each feature is a class abiding to
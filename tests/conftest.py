@@ -0,0 +1,5 @@
+import os
+import sys
+
+# MO2 adds plugins/data to the python path, the tests do the same to import gamesupport
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data"))
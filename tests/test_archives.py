@@ -0,0 +1,67 @@
+import os
+import zipfile
+
+import pytest
+
+from gamesupport.archives import ArchiveListing, InspectionCache, ListingTree, DIRECTORY, FILE
+
+
+def writeZip(path, members):
+    with zipfile.ZipFile(path, "w") as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+
+
+def test_zip_listing(tmp_path):
+    path = str(tmp_path / "mod.zip")
+    writeZip(path, {"Wrapper/MyMod/manifest.json": '{"Name": "My Mod"}', "Wrapper/MyMod/assets/big.png": b"\0" * 4096})
+    with ArchiveListing.open(path) as listing:
+        assert sorted(listing.names()) == ["Wrapper/MyMod/assets/big.png", "Wrapper/MyMod/manifest.json"]
+        assert listing.find("wrapper\\mymod\\MANIFEST.JSON") == "Wrapper/MyMod/manifest.json"
+        assert listing.read("Wrapper/MyMod/manifest.json") == b'{"Name": "My Mod"}'
+        assert listing.read("Wrapper/MyMod/assets/big.png", maxSize=1024) is None
+        assert listing.readMany(["wrapper/mymod/manifest.json", "missing"]) == {"wrapper/mymod/manifest.json": b'{"Name": "My Mod"}'}
+        tree = listing.tree()
+    modFolder = tree.find("wrapper/mymod")
+    assert modFolder.isDir() and modFolder.path() == "Wrapper/MyMod"
+    assert modFolder.exists("manifest.json", FILE) and not modFolder.exists("manifest.json", DIRECTORY)
+    assert modFolder.exists("assets", DIRECTORY) and not modFolder.exists("assets", FILE)
+    assert modFolder.find("manifest.json").suffix() == "json"
+    assert [entry.name() for entry in tree] == ["Wrapper"]
+
+
+def test_unsupported_archives(tmp_path, monkeypatch):
+    path = str(tmp_path / "broken.rar")
+    with open(path, "wb") as archiveFile:
+        archiveFile.write(b"not an archive")
+    monkeypatch.setattr("gamesupport.archives.rarfile", None)
+    monkeypatch.setattr("gamesupport.archives.CommandLineListing.executable", staticmethod(lambda: None))
+    with pytest.raises(ValueError):
+        ArchiveListing.open(path)
+
+
+def test_inspection_cache(tmp_path):
+    path = str(tmp_path / "mod.zip")
+    writeZip(path, {"MyMod/manifest.json": "{}"})
+    inspected = []
+
+    def inspect(archivePath):
+        inspected.append(archivePath)
+        with ArchiveListing.open(archivePath) as listing:
+            return sorted(listing.names())
+
+    cache = InspectionCache(inspect)
+    assert cache.get(path) == ["MyMod/manifest.json"]
+    assert cache.get(path) == ["MyMod/manifest.json"] and len(inspected) == 1
+    writeZip(path, {"MyMod/manifest.json": "{}", "MyMod/content.json": "{}"})
+    os.utime(path, ns=(0, 10 ** 9))
+    assert cache.get(path) == ["MyMod/content.json", "MyMod/manifest.json"] and len(inspected) == 2
+    with pytest.raises(OSError):
+        cache.get(str(tmp_path / "missing.zip"))
+
+
+def test_listing_tree_from_names():
+    tree = ListingTree.fromNames(["a/b/c.txt", "a\\d.txt", "e"])
+    assert sorted(entry.name() for entry in tree.find("a")) == ["b", "d.txt"]
+    assert tree.find("A/B/C.TXT").isFile() and tree.find("a/b/c.txt/x") is None
+    assert tree.exists("e", FILE) and len(tree) == 2
@@ -0,0 +1,75 @@
+import os
+
+from gamesupport.backup import SaveBackup
+
+
+class Folder(object):
+    def __init__(self, path):
+        self.path = path
+
+    def absolutePath(self):
+        return self.path
+
+
+class Organizer(object):
+    def __init__(self, basePath, settings):
+        self.__basePath = basePath
+        self.settings = settings
+
+    def basePath(self):
+        return self.__basePath
+
+    def pluginSetting(self, pluginName, key):
+        return self.settings.get(key)
+
+
+class Game(object):
+    def __init__(self, savesPath):
+        self.__savesPath = savesPath
+
+    def name(self):
+        return "Test Game Plugin"
+
+    def gameShortName(self):
+        return "testgame"
+
+    def savesDirectory(self):
+        return Folder(self.__savesPath)
+
+
+def writeSave(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as saveFile:
+        saveFile.write(data)
+
+
+def test_save_backup(tmp_path):
+    saves = str(tmp_path / "saves")
+    save = os.path.join(saves, "profile_0", "persist.game.json")
+    writeSave(save, os.urandom(100000))
+    organizer = Organizer(str(tmp_path / "instance"), {"backup_saves": True, "backup_keep": 2})
+    messages = []
+    backup = SaveBackup(organizer, Game(saves), messages.append, messages.append)
+    assert backup.isEnabled()
+    first = backup.run("before")
+    assert first is not None and messages == ["Saves backed up as snapshot {}".format(first)]
+    assert backup.run("after") is None
+    assert backup.store().root() == os.path.join(str(tmp_path / "instance"), "savebackups", "testgame")
+    for index in range(3):
+        writeSave(save, os.urandom(100000))
+        assert backup.run("after {}".format(index)) is not None
+    assert len(backup.snapshots()) == 2
+    writeSave(save, b"lost")
+    backup.restore(backup.snapshots()[-1])
+    with open(save, "rb") as saveFile:
+        assert len(saveFile.read()) == 100000
+
+
+def test_save_backup_reports_errors(tmp_path):
+    blocker = str(tmp_path / "instance")
+    open(blocker, "w").close()
+    messages = []
+    backup = SaveBackup(Organizer(blocker, {}), Game(str(tmp_path)), warning=messages.append)
+    assert not backup.isEnabled()
+    assert backup.run() is None
+    assert messages and messages[0].startswith("Could not back up the saves")
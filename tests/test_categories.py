@@ -0,0 +1,45 @@
+import json
+import os
+
+from gamesupport.categories import CategoryIndex, loadCategories, readNexusDump, syncNexusCategories
+
+DARKEST_DUNGEON = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "categories", "darkestdungeon", "categories.dat")
+
+
+def test_category_index():
+    index = CategoryIndex.load(DARKEST_DUNGEON)
+    assert CategoryIndex.load(DARKEST_DUNGEON) is index
+    assert index.byNexusId(14).name == "Visuals and Graphics"
+    assert index.byNexusId(999999) is None
+    assert index.categorize([14, 8, 999999]) == [81, 80, 0]
+
+
+def test_category_index_reloads_changed_files(tmp_path):
+    path = str(tmp_path / "categories.dat")
+    assert CategoryIndex.load(path).categorize([1]) == [0]
+    with open(path, "w", encoding="utf-8") as categoriesFile:
+        categoriesFile.write("2|Armour|1,5|0\n1|Weapons|1|0\nnot a category\n")
+    index = CategoryIndex.load(path)
+    assert index.categorize([1, 5]) == [2, 2]
+
+
+def test_sync_nexus_dump(tmp_path):
+    dump = str(tmp_path / "stardewvalley.json")
+    with open(dump, "w", encoding="utf-8") as dumpFile:
+        json.dump({"name": "Stardew Valley", "categories": [
+            {"category_id": 1, "name": "Stardew Valley", "parent_category": False},
+            {"category_id": 105, "name": "Visuals and Graphics", "parent_category": 1},
+            {"category_id": 109, "name": "Maps", "parent_category": 1},
+            {"category_id": 112, "name": "Farmhouse", "parent_category": 109},
+            ]}, dumpFile)
+    nexusCategories = readNexusDump(dump)
+    assert nexusCategories == [(105, "Visuals and Graphics", 0), (109, "Maps", 0), (112, "Farmhouse", 109)]
+    existing = loadCategories(DARKEST_DUNGEON)
+    merged, changes = syncNexusCategories(existing, nexusCategories)
+    byName = {category.name: category for category in merged}
+    assert byName["Visuals and Graphics"].id == 81 and 105 in byName["Visuals and Graphics"].nexusIds
+    assert [category.name for category in changes["added"]] == ["Maps", "Farmhouse"]
+    assert byName["Farmhouse"].parentId == byName["Maps"].id
+    assert merged[0].id > merged[-1].id
+    assert syncNexusCategories(merged, nexusCategories)[1]["added"] == []
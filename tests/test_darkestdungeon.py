@@ -0,0 +1,170 @@
+import json
+import os
+import struct
+
+import pytest
+
+from gamesupport.darkestdungeon import (ModCatalog, PersistFile, Profile, BDHD_HEADER, BDHD_MAGIC, BDHD_META1, BDHD_META2,
+    lastPlayedProfile, listProfiles, parseProject, workshopPath)
+
+
+class BdhdWriter(object):
+    """
+    Writes the binary "BDHD" format of the persist.*.json saves from nested dicts. Values are ints, floats,
+    strings, bools (a single byte), or bytes for embedded files.
+    """
+    def __init__(self):
+        self.meta1 = []
+        self.meta2 = []
+        self.data = bytearray()
+
+    def field(self, name, value):
+        encodedName = name.encode("utf-8") + b"\0"
+        index = len(self.meta2)
+        offset = len(self.data)
+        self.data += encodedName
+        if isinstance(value, dict):
+            meta1Index = len(self.meta1)
+            self.meta1.append(None)
+            self.meta2.append((offset, 1, len(encodedName), meta1Index))
+            first = len(self.meta2)
+            for childName, childValue in value.items():
+                self.field(childName, childValue)
+            self.meta1[meta1Index] = (index, 0, len(value), len(self.meta2) - first)
+            return
+        self.meta2.append((offset, 0, len(encodedName), 0))
+        if isinstance(value, bool):
+            self.data += b"\x01" if value else b"\x00"
+            return
+        self.data += bytes(-len(self.data) % 4)
+        if isinstance(value, int):
+            self.data += struct.pack("<i", value)
+        elif isinstance(value, float):
+            self.data += struct.pack("<f", value)
+        elif isinstance(value, str):
+            encoded = value.encode("utf-8") + b"\0"
+            self.data += struct.pack("<i", len(encoded)) + encoded
+        else:
+            self.data += struct.pack("<i", len(value)) + value
+
+    def write(self, fields):
+        for name, value in fields.items():
+            self.field(name, value)
+        meta1Offset = BDHD_HEADER.size
+        meta2Offset = meta1Offset + len(self.meta1) * BDHD_META1.size
+        dataOffset = meta2Offset + len(self.meta2) * BDHD_META2.size
+        header = BDHD_HEADER.pack(BDHD_MAGIC, 0, BDHD_HEADER.size, 0, len(self.meta1) * BDHD_META1.size,
+            len(self.meta1), meta1Offset, len(self.meta2), meta2Offset, 0, len(self.data), dataOffset)
+        meta1 = b"".join(BDHD_META1.pack(*entry) for entry in self.meta1)
+        meta2 = b"".join(BDHD_META2.pack(0, offset, isObject | (nameLength << 2) | (meta1Index << 11))
+                         for offset, isObject, nameLength, meta1Index in self.meta2)
+        return header + meta1 + meta2 + bytes(self.data)
+
+
+def bdhd(fields):
+    return BdhdWriter().write(fields)
+
+
+def writeProfile(savesPath, name, game=None, estate=None, roster=None, mtime=None):
+    folder = os.path.join(savesPath, name)
+    os.makedirs(folder, exist_ok=True)
+    for persistName, fields in (("game", game), ("estate", estate), ("roster", roster)):
+        if fields is not None:
+            path = os.path.join(folder, "persist.{}.json".format(persistName))
+            with open(path, "wb") as persistFile:
+                persistFile.write(fields if isinstance(fields, bytes) else bdhd(fields))
+            if mtime is not None:
+                os.utime(path, (mtime, mtime))
+    return folder
+
+
+def test_persist_file_fields():
+    root = PersistFile(bdhd({"base_root": {"flag": True, "count": -7, "ratio": 0.5, "title": "Hamlet",
+                                           "nested": {"deep": {"value": 3}}, "last": "end"}})).root()
+    base = root.child("base_root")
+    assert base.isObject() and [name for name, field in base.children()] == ["flag", "count", "ratio", "title", "nested", "last"]
+    assert base.child("flag").asBool() is True
+    assert base.child("count").asInt() == -7
+    assert base.child("ratio").asFloat() == 0.5
+    assert base.child("title").asString() == "Hamlet"
+    assert root.find("base_root/nested/deep/value").asInt() == 3
+    # the field after a nested object is found by skipping its descendants
+    assert base.child("last").asString() == "end"
+    assert root.find("base_root/missing/value") is None
+
+
+def test_persist_file_errors():
+    with pytest.raises(ValueError):
+        PersistFile(b"{}" + bytes(100))
+    truncated = bdhd({"base_root": {"name": "x" * 100}})[:-50]
+    with pytest.raises(ValueError):
+        PersistFile(truncated)
+
+
+def test_profile(tmp_path):
+    hero = bdhd({"base_root": {"actor": {"name": "Reynauld"}, "heroClass": "crusader"}})
+    folder = writeProfile(str(tmp_path), "profile_0",
+        game={"base_root": {"estatename": "Hamlet", "applied_ugcs_1_0": {
+            "0": {"name": "885957080", "source": "Steam"},
+            "1": {"name": "LocalMod", "source": "mods"},
+            "2": {"name": 12, "source": "Steam"}}}},
+        estate={"base_root": {"wallet": {"0": {"type": "gold", "amount": 1500}, "busts": 4}}},
+        roster={"base_root": {"heroes": {"1": {"hero_file_data": {"raw_data": hero}}}}})
+    profile = Profile(folder)
+    assert profile.estateName() == "Hamlet"
+    assert profile.dependencies() == {"885957080", "folder:localmod"}
+    assert profile.estate() == {"gold": 1500, "busts": 4}
+    assert profile.roster() == [("1", "Reynauld", "crusader")]
+
+
+def test_json_profile(tmp_path):
+    game = json.dumps({"base_root": {"estatename": "Old Road", "applied_ugcs_1_0": {"0": {"name": "42", "source": "Steam"}}}})
+    profile = Profile(writeProfile(str(tmp_path), "profile_1", game=game.encode("utf-8")))
+    assert profile.estateName() == "Old Road"
+    assert profile.dependencies() == {"42"}
+    assert profile.roster() == []
+
+
+def test_list_profiles(tmp_path):
+    saves = str(tmp_path)
+    for index, mtime in ((0, 1000), (2, 3000), (10, 2000)):
+        writeProfile(saves, "profile_{}".format(index), game={"base_root": {"estatename": str(index)}}, mtime=mtime)
+    os.makedirs(os.path.join(saves, "profile_3"))
+    os.makedirs(os.path.join(saves, "other"))
+    profiles = listProfiles(saves)
+    assert [os.path.basename(profile.path) for profile in profiles] == ["profile_0", "profile_2", "profile_3", "profile_10"]
+    assert os.path.basename(lastPlayedProfile(profiles).path) == "profile_2"
+    assert lastPlayedProfile([]) is None
+    assert listProfiles(str(tmp_path / "missing")) == []
+
+
+def writeProject(folder, title, publishedFileId=""):
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, "project.xml"), "w", encoding="utf-8") as projectFile:
+        projectFile.write("<project><Title>{}</Title><PublishedFileId>{}</PublishedFileId></project>".format(title, publishedFileId))
+
+
+def test_parse_project():
+    assert parseProject(b"<project><Title> Mod </Title><Tags/></project>") == {"Title": "Mod", "Tags": ""}
+    assert parseProject(b"<project>") is None
+
+
+def test_mod_catalog(tmp_path):
+    game = tmp_path / "steamapps" / "common" / "DarkestDungeon"
+    workshop = workshopPath(str(game))
+    assert workshop == str(tmp_path / "steamapps" / "workshop" / "content" / "262060")
+    writeProject(os.path.join(workshop, "885957080"), "Marvin Seo", "885957080")
+    writeProject(str(tmp_path / "mods" / "Marvin" / "marvin"), "Marvin Seo (MO2)", "885957080")
+    writeProject(str(tmp_path / "mods" / "Local" / "local_mod"), "Local", "0")
+    os.makedirs(str(tmp_path / "mods" / "Local" / "no_project"))
+    sources = [("Steam Workshop", workshop), ("Marvin", str(tmp_path / "mods" / "Marvin")),
+               ("Local", str(tmp_path / "mods" / "Local"))]
+    cachePath = str(tmp_path / "catalog.cache")
+    entries = ModCatalog(cachePath).index(sources)
+    assert sorted(entries) == ["885957080", "folder:local_mod"]
+    assert [entry.source for entry in entries["885957080"]] == ["Steam Workshop", "Marvin"]
+    catalog = ModCatalog(cachePath)
+    catalog.index(sources)
+    assert list(catalog.duplicates()) == ["885957080"]
+    writeProject(str(tmp_path / "mods" / "Marvin" / "marvin"), "Renamed", "885957081")
+    assert sorted(ModCatalog(cachePath).index(sources)) == ["885957080", "885957081", "folder:local_mod"]
@@ -0,0 +1,148 @@
+import os
+
+from gamesupport.deploy import Deployer, InstanceDeployment, COPY, HARDLINK, SYMLINK
+
+
+def write(path, text=""):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as textFile:
+        textFile.write(text)
+
+
+def read(path):
+    with open(path, "r", encoding="utf-8") as textFile:
+        return textFile.read()
+
+
+def makeMods(root, mods):
+    """
+    @param mods dict mod name -> dict relative path -> content.
+    @return dict mod name -> dict relative path -> absolute source file.
+    """
+    sources = {}
+    for modName, files in mods.items():
+        for path, content in files.items():
+            source = os.path.join(str(root), modName, *path.split("/"))
+            write(source, content)
+            sources.setdefault(modName, {})[path] = source
+    return sources
+
+
+def test_incremental_deployment(tmp_path):
+    target = str(tmp_path / "game")
+    sources = makeMods(tmp_path / "mods", {"a": {"x/project.xml": "a", "x/art.png": "png"}, "b": {"y.txt": "b"}})
+    deployer = Deployer(target, str(tmp_path / "manifest.json"), COPY)
+    plan, skipped = deployer.deploy(dict(sources["a"], **sources["b"]))
+    assert len(plan.add) == 3 and not skipped
+    assert read(os.path.join(target, "x", "project.xml")) == "a"
+    plan, skipped = Deployer(target, str(tmp_path / "manifest.json"), COPY).deploy(sources["a"])
+    assert plan.add == [] and plan.replace == [] and plan.remove == ["y.txt"]
+    assert not os.path.exists(os.path.join(target, "y.txt"))
+    write(sources["a"]["x/project.xml"], "changed")
+    plan, skipped = Deployer(target, str(tmp_path / "manifest.json"), COPY).deploy(sources["a"])
+    assert plan.replace == [("x/project.xml", sources["a"]["x/project.xml"])]
+    assert read(os.path.join(target, "x", "project.xml")) == "changed"
+
+
+def test_foreign_files(tmp_path):
+    target = str(tmp_path / "game")
+    write(os.path.join(target, "game.txt"), "original")
+    sources = makeMods(tmp_path / "mods", {"a": {"game.txt": "mod"}})
+    plan, skipped = Deployer(target, str(tmp_path / "plain.json")).deploy(sources["a"])
+    assert skipped == ["game.txt"] and read(os.path.join(target, "game.txt")) == "original"
+    deployer = Deployer(target, str(tmp_path / "manifest.json"), HARDLINK, str(tmp_path / "backup"))
+    plan, skipped = deployer.deploy(sources["a"])
+    assert not skipped and read(os.path.join(target, "game.txt")) == "mod"
+    deployer.undeploy()
+    assert read(os.path.join(target, "game.txt")) == "original"
+    assert os.listdir(target) == ["game.txt"]
+
+
+def test_method_change(tmp_path):
+    target = str(tmp_path / "game")
+    sources = makeMods(tmp_path / "mods", {"a": {"data/file.txt": "a"}})
+    Deployer(target, str(tmp_path / "manifest.json"), COPY).deploy(sources["a"])
+    assert not os.path.islink(os.path.join(target, "data", "file.txt"))
+    plan, skipped = Deployer(target, str(tmp_path / "manifest.json"), SYMLINK).deploy(sources["a"])
+    assert len(plan.replace) == 1 and not skipped
+    plan, missing = Deployer(target, str(tmp_path / "manifest.json"), SYMLINK).undeploy()
+    assert not missing and not os.path.exists(target)
+
+
+def test_profile_switch(tmp_path):
+    """
+    Both profiles deploy x/project.xml from a different mod, the second profile replaces the file of the
+    first one instead of skipping it as a foreign file, and the files only the first profile had are removed.
+    """
+    instance = str(tmp_path / "instance")
+    target = str(tmp_path / "game" / "mods")
+    sources = makeMods(tmp_path / "mods", {"a": {"x/project.xml": "a", "x/only_a.txt": "a"}, "b": {"x/project.xml": "b"}})
+    profileA = {target: sources["a"]}
+    profileB = {target: sources["b"]}
+    results = InstanceDeployment(instance, "darkestdungeon").deploy(profileA, COPY)
+    assert len(results[target][0].add) == 2
+    results = InstanceDeployment(instance, "darkestdungeon").deploy(profileB, COPY)
+    plan, skipped = results[target]
+    assert not skipped and plan.remove == ["x/only_a.txt"] and [name for name, source in plan.replace] == ["x/project.xml"]
+    assert sorted(os.listdir(os.path.join(target, "x"))) == ["project.xml"]
+    assert read(os.path.join(target, "x", "project.xml")) == "b"
+    assert InstanceDeployment(instance, "darkestdungeon").plan(profileB, COPY)[target].isEmpty()
+
+
+def test_instance_deployment_folders(tmp_path):
+    instance = str(tmp_path / "instance")
+    game, documents = str(tmp_path / "game"), str(tmp_path / "documents")
+    write(os.path.join(documents, "settings.ini"), "original")
+    sources = makeMods(tmp_path / "mods", {"a": {"mod.dll": "dll", "settings.ini": "modded"}})
+    deployment = InstanceDeployment(instance, "generic")
+    deployment.deploy({game: {"mod.dll": sources["a"]["mod.dll"]}, documents: {"settings.ini": sources["a"]["settings.ini"]}})
+    assert read(os.path.join(documents, "settings.ini")) == "modded"
+    # the same folder spelled differently shares its manifest, the folders left out are emptied
+    results = deployment.deploy({os.path.join(game, ""): {"mod.dll": sources["a"]["mod.dll"]}})
+    assert len(results) == 2 and all(not skipped for plan, skipped in results.values())
+    assert read(os.path.join(documents, "settings.ini")) == "original"
+    assert os.path.exists(os.path.join(game, "mod.dll"))
+    deployment.undeploy()
+    assert not os.path.exists(game) and os.listdir(documents) == ["settings.ini"]
+
+
+def snapshot(root):
+    """
+    @return dict relative path -> content of the files of root, None for the folders.
+    """
+    result = {}
+    for directory, dirs, files in os.walk(root):
+        relative = os.path.relpath(directory, root)
+        if relative != ".":
+            result[relative] = None
+        for name in files:
+            result[os.path.join(relative, name)] = read(os.path.join(directory, name))
+    return result
+
+
+def test_batched_deployment(tmp_path):
+    """
+    More files than Deployer.BATCH_SIZE are placed and removed on the thread pool, and undeploy() leaves the
+    target folder exactly as it was, replaced files and pre-existing empty folders included.
+    """
+    target = str(tmp_path / "game")
+    write(os.path.join(target, "bin", "game.exe"), "exe")
+    write(os.path.join(target, "data", "000", "file.txt"), "original")
+    os.makedirs(os.path.join(target, "empty"))
+    before = snapshot(target)
+    count = 3 * Deployer.BATCH_SIZE + 1
+    sources = makeMods(tmp_path / "mods", {
+        "a": {"data/{:03}/file.txt".format(index // 10): str(index) for index in range(0, count, 10)},
+        "b": {"data/{:03}/{}.txt".format(index // 10, index): str(index) for index in range(count)}})
+    desired = dict(sources["b"], **sources["a"])
+    deployer = lambda: Deployer(target, str(tmp_path / "manifest.json"), HARDLINK, str(tmp_path / "backup"), workers=4)
+    plan, skipped = deployer().deploy(desired)
+    assert len(plan.add) == len(desired) > Deployer.BATCH_SIZE and not skipped
+    assert read(os.path.join(target, "data", "000", "file.txt")) == "0"
+    assert os.path.samefile(os.path.join(target, "data", "076", "765.txt"), sources["b"]["data/076/765.txt"])
+    plan, skipped = deployer().deploy(sources["b"])
+    assert len(plan.remove) == len(sources["a"]) and not skipped
+    assert read(os.path.join(target, "data", "000", "file.txt")) == "original"
+    plan, missing = deployer().undeploy()
+    assert len(plan.remove) == len(sources["b"]) and not missing
+    assert snapshot(target) == before
@@ -0,0 +1,153 @@
+import json
+import os
+import threading
+import time
+
+from gamesupport.detection import BackgroundDetection, GameDetector, parseVdf, steamLibraries
+
+
+def write(path, text=""):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as textFile:
+        textFile.write(text)
+
+
+def appManifest(appId, installDir):
+    return '"AppState"\n{{\n\t"appid"\t\t"{}"\n\t"installdir"\t\t"{}"\n}}\n'.format(appId, installDir)
+
+
+def makeSteam(tmp_path, newLayout=True):
+    """
+    @return (steam root, second library): Stardew Valley in the root, Darkest Dungeon in the second library,
+        KOTOR 2 has a manifest but its folder was deleted.
+    """
+    root = tmp_path / "Steam"
+    library = tmp_path / "Library Two"
+    if newLayout:
+        folders = '"libraryfolders"\n{{\n\t"0"\n\t{{\n\t\t"path"\t\t"{}"\n\t}}\n\t"1"\n\t{{\n\t\t"path"\t\t"{}"\n\t}}\n}}\n'
+        folders = folders.format(str(root).replace("\\", "\\\\"), str(library).replace("\\", "\\\\"))
+    else:
+        folders = '"LibraryFolders"\n{{\n\t"TimeNextStatsReport"\t\t"1"\n\t"1"\t\t"{}"\n}}\n'.format(
+            str(library).replace("\\", "\\\\"))
+    write(str(root / "steamapps" / "libraryfolders.vdf"), folders)
+    write(str(root / "steamapps" / "appmanifest_413150.acf"), appManifest(413150, "Stardew Valley"))
+    write(str(root / "steamapps" / "common" / "Stardew Valley" / "Stardew Valley.exe"))
+    write(str(root / "steamapps" / "appmanifest_208580.acf"), appManifest(208580, "Knights of the Old Republic II"))
+    write(str(library / "steamapps" / "appmanifest_262060.acf"), appManifest(262060, "DarkestDungeon"))
+    write(str(library / "steamapps" / "common" / "DarkestDungeon" / "_windows" / "Darkest.exe"))
+    return root, library
+
+
+GAMES = [
+    ("stardew", 413150, "Stardew Valley.exe"),
+    ("darkest", 262060, "_windows/Darkest.exe"),
+    ("kotor2", 208580, "swkotor2.exe"),
+    ]
+
+
+def test_parse_vdf():
+    data = parseVdf('// comment\n"Root"\n{\n\t"Key"\t"a \\"quoted\\" value"\n\t"Child" { "Path" "C:\\\\Games" }\n}\n')
+    assert data == {"root": {"key": 'a "quoted" value', "child": {"path": "C:\\Games"}}}
+
+
+def test_libraries_of_both_layouts(tmp_path):
+    for newLayout in (True, False):
+        root, library = makeSteam(tmp_path / str(newLayout), newLayout)
+        assert steamLibraries([str(root)]) == [str(root), str(library)]
+
+
+def test_detect_steam_libraries(tmp_path):
+    root, library = makeSteam(tmp_path)
+    found = GameDetector(steamRoots=[str(root)], useRegistry=False).detect(GAMES)
+    assert found == {
+        "stardew": str(root / "steamapps" / "common" / "Stardew Valley"),
+        "darkest": str(library / "steamapps" / "common" / "DarkestDungeon"),
+        }
+
+
+def test_detect_gog_folder(tmp_path):
+    root, library = makeSteam(tmp_path)
+    gog = tmp_path / "GOG Games"
+    write(str(gog / "Star Wars KOTOR 2" / "swkotor2.exe"))
+    write(str(gog / "Other Game" / "other.exe"))
+    detector = GameDetector(steamRoots=[str(root)], searchPaths=[str(gog), str(tmp_path / "missing")], useRegistry=False)
+    found = detector.detect(GAMES)
+    assert found["kotor2"] == str(gog / "Star Wars KOTOR 2")
+    assert found["stardew"] == str(root / "steamapps" / "common" / "Stardew Valley")
+
+
+def test_binary_is_required(tmp_path):
+    root, library = makeSteam(tmp_path)
+    os.remove(str(library / "steamapps" / "common" / "DarkestDungeon" / "_windows" / "Darkest.exe"))
+    found = GameDetector(steamRoots=[str(root)], useRegistry=False).detect(GAMES)
+    assert "darkest" not in found
+
+
+def test_no_steam(tmp_path):
+    assert GameDetector(steamRoots=[str(tmp_path / "missing")], useRegistry=False).detect(GAMES) == {}
+
+
+def test_background_detection_returns_the_cached_answer(tmp_path):
+    cachePath = str(tmp_path / "answers.json")
+    cachedPath = str(tmp_path / "cached")
+    os.makedirs(cachedPath)
+    with open(cachePath, "w", encoding="utf-8") as answersFile:
+        json.dump({"game": cachedPath}, answersFile)
+    release = threading.Event()
+
+    def detect():
+        release.wait(5)
+        return str(tmp_path)
+
+    detection = BackgroundDetection("game", detect, cachePath)
+    start = time.perf_counter()
+    assert detection.result(timeout=5) == cachedPath
+    assert time.perf_counter() - start < 1
+    release.set()
+    detection.start().result(5)
+    assert detection.result() == str(tmp_path)
+    assert detection.cached() == str(tmp_path)
+
+
+def test_background_detection_ignores_missing_cached_folders(tmp_path):
+    cachePath = str(tmp_path / "answers.json")
+    with open(cachePath, "w", encoding="utf-8") as answersFile:
+        json.dump({"game": str(tmp_path / "uninstalled")}, answersFile)
+    release = threading.Event()
+    detection = BackgroundDetection("game", lambda: release.wait(5) and None, cachePath)
+    assert detection.result(timeout=0.05) is None
+    release.set()
+    assert detection.result(timeout=5) is None
+
+
+def test_background_detection_without_cache_folder(tmp_path, monkeypatch):
+    blocker = str(tmp_path / "file")
+    open(blocker, "w").close()
+    # the cache folder can not be created under a file
+    monkeypatch.setenv("XDG_CACHE_HOME", blocker)
+    monkeypatch.setenv("LOCALAPPDATA", blocker)
+    detection = BackgroundDetection("game", lambda: str(tmp_path))
+    assert detection.cached() is None
+    assert detection.result(timeout=5) == str(tmp_path)
+
+
+def test_background_detection_validates_on_its_thread(tmp_path):
+    cachePath = str(tmp_path / "answers.json")
+    with open(cachePath, "w", encoding="utf-8") as answersFile:
+        json.dump({"game": str(tmp_path)}, answersFile)
+    threads = []
+    release = threading.Event()
+
+    def isValid(answer):
+        threads.append(threading.current_thread())
+        release.wait(5)
+        return True
+
+    detection = BackgroundDetection("game", lambda: None, cachePath, isValid)
+    start = time.perf_counter()
+    # the validation blocks like a sleeping drive would, the caller only waits for the timeout
+    assert detection.result(timeout=0.05) is None
+    assert time.perf_counter() - start < 1
+    release.set()
+    assert detection.start().result(5) is None
+    assert threads and threading.current_thread() not in threads
@@ -0,0 +1,113 @@
+import hashlib
+import os
+import time
+
+import pytest
+
+from gamesupport.hashing import FileHasher, HashCache, hashFile
+
+# the large benchmarks write 100k files and a multi-GB file, they only run when asked for
+BENCHMARK = bool(os.getenv("GAMESUPPORT_BENCHMARK"))
+benchmark = pytest.mark.skipif(not BENCHMARK, reason="set GAMESUPPORT_BENCHMARK=1 to run the benchmarks")
+
+
+def blake2b(data):
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+def makeFiles(folder, count, size=64):
+    paths = {}
+    for index in range(count):
+        directory = os.path.join(str(folder), "{:03d}".format(index // 1000))
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "{}.bin".format(index))
+        data = index.to_bytes(4, "little") * (size // 4)
+        with open(path, "wb") as dataFile:
+            dataFile.write(data)
+        paths[path] = data
+    return paths
+
+
+def test_hash_file_through_mmap(tmp_path):
+    path = str(tmp_path / "large.bin")
+    data = os.urandom(256 * 1024)
+    with open(path, "wb") as dataFile:
+        dataFile.write(data)
+    assert hashFile(path, mmapThreshold=1024) == hashFile(path) == blake2b(data)
+    empty = str(tmp_path / "empty.bin")
+    open(empty, "wb").close()
+    assert hashFile(empty, mmapThreshold=0) == blake2b(b"")
+
+
+def test_many_small_files(tmp_path):
+    files = makeFiles(tmp_path, 3000)
+    digests = FileHasher(smallFileSize=1024, batchBytes=4096).hashFiles(files)
+    assert digests == {path: blake2b(data) for path, data in files.items()}
+
+
+def test_unreadable_files_are_left_out(tmp_path):
+    files = makeFiles(tmp_path, 3)
+    digests = FileHasher().hashFiles(list(files) + [str(tmp_path / "missing.bin")])
+    assert set(digests) == set(files)
+
+
+def test_cache_is_invalidated_by_changes(tmp_path):
+    files = makeFiles(tmp_path, 10)
+    cachePath = str(tmp_path / "hashes.cache")
+    cache = HashCache(cachePath)
+    FileHasher(cache).hashFiles(files)
+    cache.save()
+    changed = sorted(files)[0]
+    with open(changed, "wb") as dataFile:
+        dataFile.write(b"changed content")
+    reloaded = HashCache(cachePath)
+    assert sum(reloaded.get(path, os.stat(path)) is not None for path in files) == len(files) - 1
+    digests = FileHasher(reloaded).hashFiles(files)
+    assert digests[changed] == blake2b(b"changed content")
+
+
+def test_other_algorithm_cache_is_ignored(tmp_path):
+    files = makeFiles(tmp_path, 2)
+    cachePath = str(tmp_path / "hashes.cache")
+    cache = HashCache(cachePath)
+    FileHasher(cache).hashFiles(files)
+    cache.save()
+    other = HashCache(cachePath, algorithm="sha1")
+    path = sorted(files)[0]
+    assert other.get(path, os.stat(path)) is None
+    assert FileHasher(other, algorithm="sha1").hashFiles([path])[path] == hashlib.sha1(files[path]).hexdigest()
+
+
+def timedHash(hasher, paths):
+    start = time.perf_counter()
+    digests = hasher.hashFiles(paths)
+    return digests, time.perf_counter() - start
+
+
+@benchmark
+def test_benchmark_100k_files(tmp_path):
+    files = makeFiles(tmp_path, 100000)
+    hasher = FileHasher()
+    digests, cold = timedHash(hasher, list(files))
+    assert len(digests) == len(files)
+    cached, warm = timedHash(hasher, list(files))
+    assert cached == digests
+    print("100k files: {:.2f}s cold, {:.2f}s cached".format(cold, warm))
+    assert warm < cold
+
+
+@benchmark
+def test_benchmark_multi_gigabyte_file(tmp_path):
+    path = str(tmp_path / "large.bin")
+    chunk = os.urandom(16 * 1024 * 1024)
+    with open(path, "wb") as dataFile:
+        for index in range(128):
+            dataFile.write(chunk)
+    hasher = FileHasher()
+    digests, cold = timedHash(hasher, [path])
+    expected = hashlib.blake2b(digest_size=20)
+    for index in range(128):
+        expected.update(chunk)
+    assert digests[path] == expected.hexdigest()
+    print("2 GiB file: {:.2f}s ({:.0f} MiB/s)".format(cold, 2048 / cold))
+    assert timedHash(hasher, [path])[1] < cold
@@ -0,0 +1,185 @@
+import os
+
+import pytest
+
+from gamesupport.kotor import (ContainerTables, ResourceIndex, BIF_ENTRY, BIF_HEADER, ERF_HEADER, ERF_KEY_ENTRY,
+    ERF_RESOURCE_ENTRY, KEY_ENTRY, KEY_FILE_ENTRY, KEY_HEADER, NEW, RESOURCE_TYPES, REPLACES_VANILLA, RIM_HEADER,
+    RIM_KEY_ENTRY, SAME_MODULE, SHADOWED_BY_OVERRIDE, findPath, moduleConflicts, readBifTable, readContainerTable,
+    readKeyFile, saveModules, splitResourceName)
+
+
+def writeFile(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as dataFile:
+        dataFile.write(data)
+
+
+def keyFile(bifs, keys):
+    """
+    @param bifs list of BIF file names.
+    @param keys list of (resref, resource type, bif index, resource index).
+    """
+    fileTableOffset = KEY_HEADER.size
+    namesOffset = fileTableOffset + len(bifs) * KEY_FILE_ENTRY.size
+    fileTable, names = b"", b""
+    for name in bifs:
+        encoded = name.encode("latin-1") + b"\0"
+        fileTable += KEY_FILE_ENTRY.pack(0, namesOffset + len(names), len(encoded), 1)
+        names += encoded
+    keyTableOffset = namesOffset + len(names)
+    keyTable = b"".join(KEY_ENTRY.pack(resref.encode("latin-1"), resourceType, bif << 20 | index)
+                        for resref, resourceType, bif, index in keys)
+    header = KEY_HEADER.pack(b"KEY V1  ", len(bifs), len(keys), fileTableOffset, keyTableOffset)
+    return header + fileTable + names + keyTable
+
+
+def bifFile(resources):
+    """
+    @param resources list of (resource type, payload), indexed in order.
+    """
+    tableOffset = BIF_HEADER.size
+    offset = tableOffset + len(resources) * BIF_ENTRY.size
+    table, payloads = b"", b""
+    for index, (resourceType, payload) in enumerate(resources):
+        table += BIF_ENTRY.pack(index, offset + len(payloads), len(payload), resourceType)
+        payloads += payload
+    return BIF_HEADER.pack(b"BIFFV1  ", len(resources), 0, tableOffset) + table + payloads
+
+
+def erfFile(resources, signature=b"MOD V1.0"):
+    """
+    @param resources list of (resref, resource type, payload).
+    """
+    keyOffset = ERF_HEADER.size
+    resourceOffset = keyOffset + len(resources) * ERF_KEY_ENTRY.size
+    offset = resourceOffset + len(resources) * ERF_RESOURCE_ENTRY.size
+    keys, table, payloads = b"", b"", b""
+    for index, (resref, resourceType, payload) in enumerate(resources):
+        keys += ERF_KEY_ENTRY.pack(resref.encode("latin-1"), index, resourceType)
+        table += ERF_RESOURCE_ENTRY.pack(offset + len(payloads), len(payload))
+        payloads += payload
+    return ERF_HEADER.pack(signature, 0, len(resources), keyOffset, keyOffset, resourceOffset) + keys + table + payloads
+
+
+def rimFile(resources):
+    """
+    @param resources list of (resref, resource type, payload).
+    """
+    keyOffset = RIM_HEADER.size
+    offset = keyOffset + len(resources) * RIM_KEY_ENTRY.size
+    keys, payloads = b"", b""
+    for index, (resref, resourceType, payload) in enumerate(resources):
+        keys += RIM_KEY_ENTRY.pack(resref.encode("latin-1"), resourceType, index, offset + len(payloads), len(payload))
+        payloads += payload
+    return RIM_HEADER.pack(b"RIM V1.0", len(resources), keyOffset) + keys + payloads
+
+
+def writeGame(gamePath):
+    twoda, utc, tpc = RESOURCE_TYPES["2da"], RESOURCE_TYPES["utc"], RESOURCE_TYPES["tpc"]
+    writeFile(os.path.join(gamePath, "chitin.key"), keyFile(["data\\2da.bif", "data\\Templates.bif"], [
+        ("appearance", twoda, 0, 0), ("Feat", twoda, 0, 1), ("p_hk47", utc, 1, 0), ("missing", tpc, 5, 0)]))
+    writeFile(os.path.join(gamePath, "data", "2da.bif"), bifFile([(twoda, b"2DA V2.b"), (twoda, b"2DA V2.b feat")]))
+    # the BIF file name differs in case from chitin.key
+    writeFile(os.path.join(gamePath, "data", "templates.bif"), bifFile([(utc, b"UTC V3.2")]))
+
+
+def test_split_resource_name():
+    assert splitResourceName("override/Appearance.2DA") == ("appearance", RESOURCE_TYPES["2da"])
+    assert splitResourceName("readme.docx") is None
+    assert splitResourceName("a_resref_longer_than_16.tga") is None
+    assert splitResourceName(".tga") is None
+
+
+def test_find_path(tmp_path):
+    writeFile(str(tmp_path / "Data" / "Templates.bif"), b"")
+    assert findPath(str(tmp_path), "data\\templates.BIF") == str(tmp_path / "Data" / "Templates.bif")
+    assert findPath(str(tmp_path), "data/other.bif") is None
+
+
+def test_key_and_bif_tables(tmp_path):
+    writeGame(str(tmp_path))
+    bifs, keys = readKeyFile(str(tmp_path / "chitin.key"))
+    assert bifs == ["data\\2da.bif", "data\\Templates.bif"]
+    assert keys[1] == ("feat", RESOURCE_TYPES["2da"], 1)
+    assert readBifTable(str(tmp_path / "data" / "2da.bif")) == {0: (52, 8), 1: (60, 13)}
+    writeFile(str(tmp_path / "not.bif"), b"BIFFV2  ")
+    assert readBifTable(str(tmp_path / "not.bif")) == {}
+
+
+def test_resource_index(tmp_path):
+    gamePath, cachePath = str(tmp_path / "game"), str(tmp_path / "resources.cache")
+    writeGame(gamePath)
+    index = ResourceIndex(gamePath, cachePath)
+    assert len(index) == 3
+    assert index.lookup("FEAT", RESOURCE_TYPES["2da"]) == ("data/2da.bif", 60, 13)
+    assert index.lookup("p_hk47", RESOURCE_TYPES["utc"]) == ("data/Templates.bif", 36, 8)
+    assert index.lookup("missing", RESOURCE_TYPES["tpc"]) is None
+    assert index.classify("appearance.2da") == REPLACES_VANILLA
+    assert index.classify("appearance.tga") == NEW
+    assert index.classify("notes.docx") is None
+    assert os.path.exists(cachePath)
+    # loaded from the cache, without the BIF files
+    os.remove(os.path.join(gamePath, "data", "2da.bif"))
+    assert ResourceIndex(gamePath, cachePath).lookup("feat", RESOURCE_TYPES["2da"]) == ("data/2da.bif", 60, 13)
+    # rebuilt when chitin.key changes
+    writeFile(os.path.join(gamePath, "chitin.key"), keyFile(["data\\2da.bif"], [("feat", RESOURCE_TYPES["2da"], 0, 1)]))
+    index = ResourceIndex(gamePath, cachePath)
+    assert len(index) == 1 and index.lookup("feat", RESOURCE_TYPES["2da"]) == ("data/2da.bif", None, None)
+
+
+def test_resource_index_without_key(tmp_path):
+    index = ResourceIndex(str(tmp_path))
+    assert len(index) == 0 and index.classify("appearance.2da") == NEW
+
+
+def test_container_tables(tmp_path):
+    are, git = RESOURCE_TYPES["are"], RESOURCE_TYPES["git"]
+    writeFile(str(tmp_path / "a.mod"), erfFile([("Module", are, b"ARE V3.2"), ("module", git, b"GIT V3.2 git")]))
+    assert readContainerTable(str(tmp_path / "a.mod")) == [("module", are, 96, 8), ("module", git, 104, 12)]
+    writeFile(str(tmp_path / "a.rim"), rimFile([("module", are, b"ARE V3.2")]))
+    assert readContainerTable(str(tmp_path / "a.rim")) == [("module", are, 52, 8)]
+    writeFile(str(tmp_path / "a.txt"), b"not a container")
+    with pytest.raises(ValueError):
+        readContainerTable(str(tmp_path / "a.txt"))
+    tables = ContainerTables()
+    assert tables.keys(str(tmp_path / "a.rim")) == {("module", are)}
+    assert tables.keys(str(tmp_path / "a.txt")) == frozenset()
+    assert tables.keys(str(tmp_path / "missing.mod")) == frozenset()
+    writeFile(str(tmp_path / "a.rim"), rimFile([("module", git, b"GIT V3.2 changed")]))
+    assert tables.keys(str(tmp_path / "a.rim")) == {("module", git)}
+
+
+def test_save_modules(tmp_path):
+    sav = RESOURCE_TYPES["sav"]
+    writeFile(str(tmp_path / "SAVEGAME.sav"), erfFile([("001ebo", sav, b"SAV"), ("003ebo", sav, b"SAV"),
+                                                         ("pc", RESOURCE_TYPES["utc"], b"UTC")], b"SAV V1.0"))
+    assert saveModules(str(tmp_path / "SAVEGAME.sav")) == {"001ebo", "003ebo"}
+
+
+def test_resource_index_modules(tmp_path):
+    gamePath = str(tmp_path / "game")
+    writeGame(gamePath)
+    twoda, are = RESOURCE_TYPES["2da"], RESOURCE_TYPES["are"]
+    writeFile(os.path.join(gamePath, "Modules", "001EBO.rim"), rimFile([("001ebo", are, b"ARE"), ("feat", twoda, b"2DA")]))
+    writeFile(os.path.join(gamePath, "Modules", "broken.mod"), b"broken")
+    index = ResourceIndex(gamePath)
+    assert index.containers() == ["data/2da.bif", "data/Templates.bif", "modules/001EBO.rim"]
+    assert index.lookup("001ebo", are) == ("modules/001EBO.rim", 84, 3)
+    # the BIF files come first
+    assert index.lookup("feat", twoda) == ("data/2da.bif", 60, 13)
+
+
+def test_module_conflicts(tmp_path):
+    are, git, utc = RESOURCE_TYPES["are"], RESOURCE_TYPES["git"], RESOURCE_TYPES["utc"]
+    mods = tmp_path / "mods"
+    writeFile(str(mods / "a" / "modules" / "001ebo.mod"), erfFile([("001ebo", are, b"ARE"), ("n_guard", utc, b"UTC")]))
+    writeFile(str(mods / "b" / "Modules" / "001EBO.mod"), erfFile([("001ebo", git, b"GIT")]))
+    writeFile(str(mods / "c" / "override" / "textures" / "N_Guard.utc"), b"UTC")
+    writeFile(str(mods / "c" / "override" / "readme.docx"), b"")
+    folders = [(name, str(mods / name)) for name in ("a", "b", "c")]
+    tables = ContainerTables()
+    conflicts = moduleConflicts("a", folders, tables)
+    assert [(conflict.otherMod, conflict.kind) for conflict in conflicts] == [("b", SAME_MODULE), ("c", SHADOWED_BY_OVERRIDE)]
+    assert conflicts[0].module == "001ebo.mod" and conflicts[0].resources == sorted([("001ebo", are), ("001ebo", git), ("n_guard", utc)])
+    assert conflicts[1].resources == [("n_guard", utc)]
+    assert moduleConflicts("c", folders, tables) == []
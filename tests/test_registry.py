@@ -0,0 +1,217 @@
+import os
+import struct
+
+import pytest
+
+from gamesupport import registry
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+STEAM = "Software\\Valve\\Steam"
+
+
+@pytest.fixture(autouse=True)
+def hives():
+    """
+    @brief start every test without loaded hives, so that the default Wine prefix of the machine is never read.
+    """
+    def reset():
+        for hive in registry._hives.values():
+            hive.close()
+        registry._hives.clear()
+        registry._prefix = None
+        registry._searchedAppIds.clear()
+        registry.clearQueryCache()
+    reset()
+    yield
+    reset()
+
+
+class HiveBuilder(object):
+    """
+    Writes a minimal binary "regf" hive: a base block, a single hbin and nk, lf, vk and value list cells.
+    """
+    def __init__(self):
+        self.cells = bytearray(b"hbin" + bytes(0x1C))
+
+    def cell(self, data):
+        offset = len(self.cells)
+        size = (len(data) + 4 + 7) & ~7
+        self.cells += struct.pack("<i", -size) + data + bytes(size - 4 - len(data))
+        return offset
+
+    def value(self, name, dataType, data):
+        encodedName = name.encode("latin-1")
+        if len(data) <= 4:
+            size, dataOffset = len(data) | 0x80000000, int.from_bytes(data.ljust(4, b"\0"), "little")
+        else:
+            size, dataOffset = len(data), self.cell(data)
+        return self.cell(b"vk" + struct.pack("<HIIIHH", len(encodedName), size, dataOffset, dataType, 1, 0) + encodedName)
+
+    def key(self, name, values=(), subkeys=()):
+        """
+        @param values list of (name, type, raw data), subkeys list of nk cell offsets.
+        """
+        valueOffsets = [self.value(*value) for value in values]
+        valueList = self.cell(b"".join(struct.pack("<I", offset) for offset in valueOffsets)) if values else 0xFFFFFFFF
+        subkeyList = self.cell(b"lf" + struct.pack("<H", len(subkeys)) + b"".join(
+            struct.pack("<I4s", offset, b"\0\0\0\0") for offset in subkeys)) if subkeys else 0xFFFFFFFF
+        encodedName = name.encode("latin-1")
+        node = bytearray(0x4C)
+        node[0:2] = b"nk"
+        struct.pack_into("<H", node, 0x02, 0x0020)
+        struct.pack_into("<II", node, 0x14, len(subkeys), 0)
+        struct.pack_into("<I", node, 0x1C, subkeyList)
+        struct.pack_into("<II", node, 0x24, len(values), valueList)
+        struct.pack_into("<H", node, 0x48, len(encodedName))
+        return self.cell(bytes(node) + encodedName)
+
+    def write(self, path, root):
+        header = bytearray(0x1000)
+        header[0:4] = b"regf"
+        struct.pack_into("<I", header, 0x24, root)
+        with open(path, "wb") as hiveFile:
+            hiveFile.write(bytes(header) + bytes(self.cells))
+
+
+def utf16(text):
+    return (text + "\0").encode("utf-16-le")
+
+
+@pytest.fixture
+def binaryHive(tmp_path):
+    builder = HiveBuilder()
+    steam = builder.key("Steam", [
+        ("SteamPath", registry.REG_SZ, utf16("c:/program files (x86)/steam")),
+        ("Count", registry.REG_DWORD, struct.pack("<I", 42)),
+        ("Big", registry.REG_QWORD, struct.pack("<Q", 1 << 40)),
+        ("Libraries", registry.REG_MULTI_SZ, utf16("C:\\Games") + utf16("D:\\Steam") + b"\0\0"),
+        ])
+    valve = builder.key("Valve", subkeys=[steam])
+    software = builder.key("Software", subkeys=[builder.key("Classes"), valve])
+    path = str(tmp_path / "NTUSER.DAT")
+    builder.write(path, builder.key("ROOT", subkeys=[software]))
+    return path
+
+
+def test_text_hive_values():
+    registry.loadHive(registry.HKEY_LOCAL_MACHINE, os.path.join(FIXTURES, "system.reg"))
+    with registry.OpenKey(registry.HKEY_LOCAL_MACHINE, STEAM) as key:
+        assert registry.QueryValueEx(key, "installpath") == ("C:\\Program Files (x86)\\Steam", registry.REG_SZ)
+        assert registry.QueryValueEx(key, "") == ("default value", registry.REG_SZ)
+        assert registry.QueryValueEx(key, "Count") == (42, registry.REG_DWORD)
+        assert registry.QueryValueEx(key, "Libraries") == (["C:\\Games", "D:\\Steam"], registry.REG_MULTI_SZ)
+        assert registry.QueryValueEx(key, "Expanded") == ("%SystemRoot%\\system32", registry.REG_EXPAND_SZ)
+        assert registry.QueryValueEx(key, "Binary") == (b"\xde\xad\xbe\xef", registry.REG_BINARY)
+        assert registry.QueryValueEx(key, 'Quoted "name"') == ("tab\there", registry.REG_SZ)
+        with pytest.raises(FileNotFoundError):
+            registry.QueryValueEx(key, "Missing")
+
+
+def test_text_hive_keys():
+    registry.loadHive(registry.HKEY_LOCAL_MACHINE, os.path.join(FIXTURES, "system.reg"))
+    software = registry.OpenKey(registry.HKEY_LOCAL_MACHINE, "Software")
+    assert registry.EnumKey(software, 0) == "Microsoft"
+    assert registry.EnumKey(registry.OpenKey(software, "Valve"), 0) == "Steam"
+    apps = registry.OpenKey(registry.HKEY_LOCAL_MACHINE, STEAM + "\\Apps")
+    assert registry.QueryValueEx(registry.OpenKey(apps, "413150"), "Installed")[0] == 1
+    with pytest.raises(OSError):
+        registry.EnumKey(apps, 1)
+    with pytest.raises(FileNotFoundError):
+        registry.OpenKey(registry.HKEY_LOCAL_MACHINE, "Software\\Missing")
+    with pytest.raises(FileNotFoundError):
+        registry.OpenKey(registry.HKEY_CURRENT_USER, STEAM)
+
+
+def test_binary_hive(binaryHive):
+    registry.loadHive(registry.HKEY_CURRENT_USER, binaryHive)
+    with registry.OpenKey(registry.HKEY_CURRENT_USER, "software\\VALVE\\steam") as key:
+        assert registry.QueryValueEx(key, "SteamPath") == ("c:/program files (x86)/steam", registry.REG_SZ)
+        assert registry.QueryValueEx(key, "Count") == (42, registry.REG_DWORD)
+        assert registry.QueryValueEx(key, "Big") == (1 << 40, registry.REG_QWORD)
+        assert registry.QueryValueEx(key, "Libraries")[0] == ["C:\\Games", "D:\\Steam"]
+    software = registry.OpenKey(registry.HKEY_CURRENT_USER, "Software")
+    assert [registry.EnumKey(software, index) for index in range(2)] == ["Classes", "Valve"]
+    with pytest.raises(FileNotFoundError):
+        registry.OpenKey(registry.HKEY_CURRENT_USER, "Software\\Valve\\Missing")
+
+
+def test_binary_hive_signature(tmp_path):
+    path = str(tmp_path / "broken.dat")
+    with open(path, "wb") as hiveFile:
+        hiveFile.write(b"nope" + bytes(0x1000))
+    with pytest.raises(OSError):
+        registry.BinaryHive(path)
+
+
+def test_query_values_of_a_prefix(tmp_path, binaryHive):
+    prefix = tmp_path / "prefix"
+    os.makedirs(str(prefix / "drive_c" / "Program Files (x86)" / "Steam"))
+    os.makedirs(str(prefix / "dosdevices"))
+    os.symlink(os.path.join("..", "drive_c"), str(prefix / "dosdevices" / "c:"))
+    with open(os.path.join(FIXTURES, "system.reg"), "rb") as source, open(str(prefix / "system.reg"), "wb") as target:
+        target.write(source.read())
+    registry.setPrefix(str(prefix))
+    registry.loadHive(registry.HKEY_CURRENT_USER, binaryHive)
+    values = registry.queryValues([
+        (registry.HKEY_LOCAL_MACHINE, STEAM, "InstallPath"),
+        (registry.HKEY_LOCAL_MACHINE, STEAM, "Missing"),
+        (registry.HKEY_CURRENT_USER, "Software\\Valve\\Steam", "Count"),
+        (registry.HKEY_CURRENT_USER, "Software\\Missing", "Count"),
+        ])
+    assert list(values.values()) == ["C:\\Program Files (x86)\\Steam", None, 42, None]
+    assert registry.nativePath(values[(registry.HKEY_LOCAL_MACHINE, STEAM, "InstallPath")]) == \
+        os.path.join(os.path.realpath(str(prefix / "drive_c")), "Program Files (x86)", "Steam")
+    assert registry.queryValue(registry.HKEY_LOCAL_MACHINE, STEAM, "Missing", "default") == "default"
+
+
+def test_wow64_view():
+    registry.loadHive(registry.HKEY_LOCAL_MACHINE, os.path.join(FIXTURES, "system.reg"))
+    access = registry.KEY_READ | registry.KEY_WOW64_32KEY
+    with registry.OpenKey(registry.HKEY_LOCAL_MACHINE, STEAM, 0, access) as key:
+        assert registry.QueryValueEx(key, "InstallPath")[0] == "C:\\Steam32"
+    with registry.OpenKey(registry.HKEY_LOCAL_MACHINE, STEAM) as key:
+        assert registry.QueryValueEx(key, "InstallPath")[0] == "C:\\Program Files (x86)\\Steam"
+    # keys missing from Wow6432Node are shared by both views
+    uninstall = "Software\\Microsoft\\Windows\\CurrentVersion\\Uninstall\\Steam App 262060"
+    with registry.OpenKey(registry.HKEY_LOCAL_MACHINE, uninstall, 0, access) as key:
+        assert registry.QueryValueEx(key, "DisplayName")[0] == "Darkest Dungeon"
+    assert registry.wow64Path("SOFTWARE\\Valve") == "SOFTWARE\\Wow6432Node\\Valve"
+    assert registry.wow64Path("Software") == "Software\\Wow6432Node"
+    assert registry.wow64Path("Software\\WOW6432Node\\Valve") == "Software\\WOW6432Node\\Valve"
+    assert registry.wow64Path("Software\\Classes\\.txt") == "Software\\Classes\\.txt"
+    assert registry.wow64Path("System\\CurrentControlSet") == "System\\CurrentControlSet"
+
+
+def writePrefix(prefix):
+    os.makedirs(str(prefix / "drive_c" / "Games" / "DarkestDungeon"))
+    with open(os.path.join(FIXTURES, "system.reg"), "rb") as source, open(str(prefix / "system.reg"), "wb") as target:
+        target.write(source.read())
+
+
+def test_default_prefix(tmp_path, monkeypatch):
+    uninstall = "Software\\Microsoft\\Windows\\CurrentVersion\\Uninstall\\Steam App 262060"
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    monkeypatch.delenv("WINEPREFIX", raising=False)
+    assert registry.queryValue(registry.HKEY_LOCAL_MACHINE, uninstall, "DisplayName") is None
+    registry.clearQueryCache()
+    registry._searchedAppIds.clear()
+    writePrefix(tmp_path / "home" / ".wine")
+    assert registry.defaultPrefix() == str(tmp_path / "home" / ".wine")
+    assert registry.queryValue(registry.HKEY_LOCAL_MACHINE, uninstall, "DisplayName") == "Darkest Dungeon"
+    assert registry.nativePath("C:\\Games\\DarkestDungeon") == \
+        os.path.join(os.path.realpath(str(tmp_path / "home" / ".wine" / "drive_c")), "Games", "DarkestDungeon")
+    writePrefix(tmp_path / "wineprefix")
+    monkeypatch.setenv("WINEPREFIX", str(tmp_path / "wineprefix"))
+    assert registry.defaultPrefix() == str(tmp_path / "wineprefix")
+
+
+def test_proton_prefix(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.delenv("WINEPREFIX", raising=False)
+    os.makedirs(str(tmp_path / ".steam" / "steam" / "steamapps"))
+    assert registry.defaultPrefix("262060") is None
+    proton = tmp_path / ".steam" / "steam" / "steamapps" / "compatdata" / "262060" / "pfx"
+    writePrefix(proton)
+    assert registry.defaultPrefix() is None
+    assert registry.defaultPrefix("262060") == str(proton)
+    assert registry.queryValue(registry.HKEY_LOCAL_MACHINE, STEAM, "Count", appId="262060") == 42
@@ -0,0 +1,135 @@
+import json
+import os
+
+import pytest
+
+from gamesupport.stardew import (ContentPatcherIndex, JsonFileCache, ModManifest, SmapiLogAnalyzer, CONTENT_PATCHER, ERROR,
+    HARD, LOAD, SOFT, WARN, findModFolders, normalizeAsset, parseJson, readManifests)
+
+
+def writeJson(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as jsonFile:
+        jsonFile.write(content if isinstance(content, str) else json.dumps(content))
+
+
+def writePack(folder, uniqueId, changes, includes=None):
+    writeJson(os.path.join(folder, "manifest.json"), {"UniqueID": uniqueId, "Name": uniqueId.split(".")[-1],
+                                                      "ContentPackFor": {"UniqueID": "Pathoschild.ContentPatcher"}})
+    writeJson(os.path.join(folder, "content.json"), {"Format": "2.0.0", "Changes": changes})
+    for path, includedChanges in (includes or {}).items():
+        writeJson(os.path.join(folder, *path.split("/")), {"Changes": includedChanges})
+
+
+def test_parse_json():
+    assert parseJson(b'\xef\xbb\xbf{"a": [1, 2,], // comment\n "b": "http://x,}" /* block */,}') == {"a": [1, 2], "b": "http://x,}"}
+    assert parseJson('{"escaped": "quote \\" // not a comment"}') == {"escaped": 'quote " // not a comment'}
+    with pytest.raises(ValueError):
+        parseJson("{not json}")
+
+
+def test_json_file_cache(tmp_path):
+    path, cachePath = str(tmp_path / "manifest.json"), str(tmp_path / "json.cache")
+    writeJson(path, {"UniqueID": "a"})
+    files = JsonFileCache(cachePath)
+    assert files.get(path) == {"UniqueID": "a"}
+    assert files.get(str(tmp_path / "missing.json")) is None
+    files.save()
+    writeJson(str(tmp_path / "broken.json"), "{")
+    assert JsonFileCache(cachePath).get(str(tmp_path / "broken.json")) is None
+    writeJson(path, {"UniqueID": "changed"})
+    assert JsonFileCache(cachePath).get(path) == {"UniqueID": "changed"}
+
+
+def test_read_manifests(tmp_path):
+    mods = tmp_path / "mods"
+    writeJson(str(mods / "Framework" / "SpaceCore" / "manifest.json"), {"UniqueID": "spacechase0.SpaceCore", "Name": "SpaceCore"})
+    writePack(str(mods / "Pack" / "Bundle" / "[CP] Pack"), "author.pack", [])
+    # SMAPI does not look inside mod folders, nor in hidden folders
+    writeJson(str(mods / "Pack" / "Bundle" / "[CP] Pack" / "nested" / "manifest.json"), {"UniqueID": "nested"})
+    writeJson(str(mods / "Pack" / ".hidden" / "manifest.json"), {"UniqueID": "hidden"})
+    writeJson(str(mods / "Broken" / "Broken" / "manifest.json"), "[]")
+    assert findModFolders(str(mods / "Pack")) == [str(mods / "Pack" / "Bundle" / "[CP] Pack")]
+    manifests = readManifests([(name, str(mods / name)) for name in ("Framework", "Pack", "Broken")], JsonFileCache())
+    assert [(manifest.mod, manifest.uniqueId, manifest.name, manifest.contentPackFor) for manifest in manifests] == [
+        ("Framework", "spacechase0.SpaceCore", "SpaceCore", ""),
+        ("Pack", "author.pack", "pack", CONTENT_PATCHER)]
+
+
+def test_content_patcher_index(tmp_path):
+    mods = tmp_path / "mods"
+    writePack(str(mods / "A" / "A"), "a.pack", [
+        {"Action": "Load", "Target": "Portraits/Abigail, Characters\\Abigail.xnb", "FromFile": "assets/abigail.png"},
+        {"Action": "Include", "FromFile": "data/edits.json"}],
+        {"data/edits.json": [{"Action": "EditData", "Target": "Data/Events/Town"},
+                             {"Action": "Include", "FromFile": "data/edits.json"}]})
+    writePack(str(mods / "B" / "B"), "b.pack", [
+        {"Action": "Load", "Target": "Portraits/Abigail"},
+        {"Action": "EditImage", "Target": ["Characters/Abigail"]},
+        {"Action": "EditData", "Target": "Data/Events/Town"}])
+    writeJson(str(mods / "C" / "C" / "manifest.json"), {"UniqueID": "c.code"})
+    files = JsonFileCache()
+    manifests = readManifests([(name, str(mods / name)) for name in ("A", "B", "C")], files)
+    index = ContentPatcherIndex(files)
+    assets = index.index(manifests)
+    assert sorted(assets) == ["characters/abigail", "data/events/town", "portraits/abigail"]
+    assert [(action.mod, action.action, action.file) for action in assets["data/events/town"]] == [
+        ("A", "editdata", os.path.join("data", "edits.json")), ("B", "editdata", "content.json")]
+    conflicts = index.conflicts()
+    # a single load edited by another mod is not a conflict
+    assert [(conflict.asset, conflict.kind) for conflict in conflicts] == [("data/events/town", SOFT), ("portraits/abigail", HARD)]
+    assert [action.action for action in conflicts[1].actions] == [LOAD, LOAD]
+
+
+def test_normalize_asset():
+    assert normalizeAsset(" \\Maps\\Town.xnb ") == "maps/town"
+
+
+LOG_START = (
+    "[10:00:00 INFO  SMAPI] SMAPI 4.0.8 with Stardew Valley 1.6.8 on Microsoft Windows 10\n"
+    "[10:00:01 TRACE SMAPI] Loading mods...\n")
+
+
+def appendLog(path, text):
+    with open(path, "ab") as logFile:
+        logFile.write(text.encode("utf-8"))
+
+
+def test_smapi_log_analyzer(tmp_path):
+    logPath, statePath = str(tmp_path / "SMAPI-latest.txt"), str(tmp_path / "smapi.state")
+    appendLog(logPath, LOG_START +
+        "[10:00:02 ERROR Content Patcher] Can't apply patch: file not found.\n"
+        "System.IO.FileNotFoundException: [ERROR x] in a stack trace\n"
+        "   at ContentPatcher.ModEntry.Entry()\n"
+        "[10:00:03 WARN  SpaceCore] Deprecated API\n"
+        "[10:00:04 WARN  SpaceCore] Partial")
+    analyzer = SmapiLogAnalyzer(statePath)
+    summaries = analyzer.update(logPath)
+    assert sorted(summaries) == ["Content Patcher", "SpaceCore"]
+    assert (summaries["Content Patcher"].errors, summaries["Content Patcher"].warnings) == (1, 0)
+    # the incomplete last line is read by the next update
+    assert summaries["SpaceCore"].messages == [(WARN, "Deprecated API")]
+    appendLog(logPath, " line\n[10:00:05 ERROR SpaceCore] Failed\n")
+    summaries = SmapiLogAnalyzer(statePath).update(logPath)
+    assert summaries["SpaceCore"].messages == [(WARN, "Deprecated API"), (WARN, "Partial line"), (ERROR, "Failed")]
+    assert summaries["Content Patcher"].errors == 1
+    # a new session rewrites the log from the start
+    with open(logPath, "wb") as logFile:
+        logFile.write((LOG_START.replace("10:00", "11:00") + "[11:00:02 WARN  Farm Type Manager] Missing\n").encode("utf-8"))
+    assert sorted(analyzer.update(logPath)) == ["Farm Type Manager"]
+    assert sorted(SmapiLogAnalyzer(statePath).update(str(tmp_path / "missing.txt"))) == ["Farm Type Manager"]
+
+
+def test_summaries_by_mod(tmp_path):
+    logPath = str(tmp_path / "SMAPI-latest.txt")
+    appendLog(logPath, LOG_START +
+        "[10:00:02 ERROR spacechase0.SpaceCore] Failed\n"
+        "[10:00:03 WARN  Content Patcher] Deprecated\n"
+        "[10:00:04 ERROR SMAPI] Unknown mod\n")
+    analyzer = SmapiLogAnalyzer()
+    analyzer.update(logPath)
+    manifests = [ModManifest("SpaceCore", "", "spacechase0.SpaceCore", "SpaceCore", ""),
+                 ModManifest("Content Patcher", "", "Pathoschild.ContentPatcher", "Content Patcher", "")]
+    byMod = analyzer.summariesByMod(manifests)
+    assert set(byMod) == {None, "Content Patcher", "SpaceCore"}
+    assert list(byMod["SpaceCore"]) == ["spacechase0.SpaceCore"] and list(byMod[None]) == ["SMAPI"]
@@ -0,0 +1,144 @@
+import os
+import struct
+import threading
+
+import pytest
+
+from gamesupport.thumbnails import (ThumbnailCache, Thumbnail, TPC_GREY, TPC_HEADER, TPC_RGB, TPC_RGBA, decodeTpc,
+    downsample, thumbnailSize)
+
+
+def writeFile(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as dataFile:
+        dataFile.write(data)
+
+
+def tpc(width, height, encoding, levels, compressed=False, mipCount=None):
+    """
+    @param levels list of the payloads of the mipmaps, largest first.
+    """
+    dataSize = len(levels[0]) if compressed else 0
+    header = TPC_HEADER.pack(dataSize, 0.0, width, height, encoding, mipCount or len(levels))
+    return header + b"".join(levels)
+
+
+def solid(width, height, pixel):
+    return Thumbnail(width, height, bytes(pixel) * (width * height))
+
+
+def test_thumbnail_size():
+    assert [thumbnailSize(size) for size in (1, 64, 65, 300, 4096)] == [64, 64, 128, 512, 1024]
+
+
+def test_downsample():
+    pixels = b"".join(struct.pack("<I", index) for index in range(16))
+    assert downsample(Thumbnail(4, 4, pixels), 4) == Thumbnail(4, 4, pixels)
+    assert downsample(Thumbnail(4, 4, pixels), 2) == Thumbnail(2, 2, b"".join(struct.pack("<I", index) for index in (0, 2, 8, 10)))
+    assert downsample(Thumbnail(5, 1, bytes(20)), 2).width == 2
+
+
+def test_decode_uncompressed_tpc(tmp_path):
+    path = str(tmp_path / "grey.tpc")
+    writeFile(path, tpc(2, 2, TPC_GREY, [b"\x00\x40\x80\xff", b"\x10"]))
+    assert decodeTpc(path, 2) == Thumbnail(2, 2, b"\x00\x00\x00\xff\x40\x40\x40\xff\x80\x80\x80\xff\xff\xff\xff\xff")
+    # the smallest mipmap large enough is decoded
+    assert decodeTpc(path, 1) == Thumbnail(1, 1, b"\x10\x10\x10\xff")
+    writeFile(path, tpc(1, 1, TPC_RGB, [b"\x01\x02\x03"]))
+    assert decodeTpc(path, 64) == Thumbnail(1, 1, b"\x01\x02\x03\xff")
+    writeFile(path, tpc(1, 1, TPC_RGBA, [b"\x01\x02\x03\x04"]))
+    assert decodeTpc(path, 64) == Thumbnail(1, 1, b"\x01\x02\x03\x04")
+    # cube maps are decoded from their first face
+    writeFile(path, tpc(1, 6, TPC_GREY, [b"\x07\x01\x02\x03\x04\x05"]))
+    assert decodeTpc(path, 64) == Thumbnail(1, 1, b"\x07\x07\x07\xff")
+
+
+def test_decode_dxt_tpc(tmp_path):
+    path = str(tmp_path / "dxt.tpc")
+    # DXT1 block, color0 pure red, color1 pure blue, index 0 for the first row and 1 for the others
+    dxt1 = struct.pack("<HHI", 0xF800, 0x001F, 0x55555500)
+    writeFile(path, tpc(4, 4, TPC_RGB, [dxt1], compressed=True))
+    thumbnail = decodeTpc(path, 64)
+    assert (thumbnail.width, thumbnail.height) == (4, 4)
+    assert thumbnail.pixels[:4] == b"\xff\x00\x00\xff" and thumbnail.pixels[16:20] == b"\x00\x00\xff\xff"
+    # DXT5 block with alpha index 1 everywhere, of a 2x2 texture cropped from the 4x4 block
+    dxt5 = bytes([0xFF, 0x20]) + (0x249249249249).to_bytes(6, "little") + struct.pack("<HHI", 0xF800, 0x001F, 0)
+    writeFile(path, tpc(2, 2, TPC_RGBA, [dxt5], compressed=True))
+    assert decodeTpc(path, 64) == Thumbnail(2, 2, b"\xff\x00\x00\x20" * 4)
+
+
+def test_decode_invalid_tpc(tmp_path):
+    path = str(tmp_path / "invalid.tpc")
+    for data in (b"short", tpc(0, 4, TPC_GREY, [b""]), tpc(1, 1, 3, [b"\x00"]), tpc(4, 4, TPC_GREY, [b"\x00" * 8])):
+        writeFile(path, data)
+        with pytest.raises(ValueError):
+            decodeTpc(path, 64)
+
+
+class CountingDecoder(object):
+    def __init__(self, size=8):
+        self.calls = []
+        self.size = size
+        self.lock = threading.Lock()
+
+    def __call__(self, path, maxSize):
+        with self.lock:
+            self.calls.append(os.path.basename(path))
+        with open(path, "rb") as imageFile:
+            pixel = imageFile.read(4).ljust(4, b"\0")
+        return solid(self.size, self.size, pixel)
+
+
+def test_thumbnail_cache(tmp_path):
+    images = tmp_path / "images"
+    writeFile(str(images / "a.png"), b"\x01\x02\x03\x04")
+    writeFile(str(images / "copy.PNG"), b"\x01\x02\x03\x04")
+    writeFile(str(images / "b.png"), b"\x05\x06\x07\x08")
+    writeFile(str(images / "c.dds"), b"")
+    decoder = CountingDecoder(256)
+    cache = ThumbnailCache({".png": decoder}, str(tmp_path / "thumbnails"), str(tmp_path / "hashes"))
+    try:
+        assert cache.supportedExtensions() == {"png"}
+        thumbnail = cache.get(str(images / "a.png"), 100)
+        assert (thumbnail.width, thumbnail.height, thumbnail.pixels[:4]) == (128, 128, b"\x01\x02\x03\x04")
+        # the same content is decoded once, whatever its path
+        assert cache.get(str(images / "copy.PNG"), 128) == thumbnail
+        assert cache.request(str(images / "a.png"), 128).done()
+        cache.prefetch([str(images / name) for name in ("b.png", "c.dds")], 128)
+        assert cache.get(str(images / "b.png"), 128).pixels[:4] == b"\x05\x06\x07\x08"
+        assert decoder.calls == ["a.png", "b.png"]
+        assert cache.memoryUsage() == (2, 2 * 128 * 128 * 4)
+        with pytest.raises(ValueError):
+            cache.get(str(images / "c.dds"), 128)
+        with pytest.raises(OSError):
+            cache.get(str(images / "missing.png"), 128)
+    finally:
+        cache.shutdown()
+    # thumbnails and hashes are reused from disk by a new cache
+    decoder = CountingDecoder()
+    cache = ThumbnailCache({".png": decoder}, str(tmp_path / "thumbnails"), str(tmp_path / "hashes"))
+    try:
+        assert cache.get(str(images / "a.png"), 128) == thumbnail
+        assert decoder.calls == []
+        writeFile(str(images / "a.png"), b"\x09\x09\x09\x09")
+        assert cache.get(str(images / "a.png"), 128).pixels[:4] == b"\x09\x09\x09\x09"
+        assert decoder.calls == ["a.png"]
+    finally:
+        cache.shutdown()
+
+
+def test_thumbnail_cache_budget(tmp_path):
+    for index in range(3):
+        writeFile(str(tmp_path / "{}.png".format(index)), bytes([index]) * 4)
+    decoder = CountingDecoder(8)
+    cache = ThumbnailCache({".png": decoder}, memoryBudget=2 * 8 * 8 * 4, workers=1)
+    try:
+        for index in (0, 1, 0, 2):
+            cache.get(str(tmp_path / "{}.png".format(index)), 64)
+        # 1 was the least recently used thumbnail
+        assert cache.memoryUsage() == (2, 2 * 8 * 8 * 4)
+        assert cache.request(str(tmp_path / "0.png"), 64).done()
+        cache.get(str(tmp_path / "1.png"), 64)
+        assert decoder.calls == ["0.png", "1.png", "2.png", "1.png"]
+    finally:
+        cache.shutdown()
@@ -0,0 +1,108 @@
+import os
+import struct
+
+import pytest
+
+from gamesupport.xnb import (XnbFingerprintIndex, HEADER, INCOMPATIBLE_COMPRESSION, LZ4, LZX, NOT_XNB, OUTDATED,
+    WRONG_PLATFORM, assetName, parseXnbHeader, readXnbHeader)
+
+TEXTURE = "Microsoft.Xna.Framework.Content.Texture2DReader, Microsoft.Xna.Framework.Graphics, Version=4.0.0.0, Culture=neutral, PublicKeyToken=842cf8be1de50553"
+DICTIONARY = "Microsoft.Xna.Framework.Content.DictionaryReader`2[[System.String, mscorlib, Version=4.0.0.0]]"
+
+
+def encode7BitInt(value):
+    data = b""
+    while value >= 0x80:
+        data += bytes([value & 0x7F | 0x80])
+        value >>= 7
+    return data + bytes([value])
+
+
+def xnb(platform="w", version=5, flags=0, typeReaders=(TEXTURE,)):
+    body = b"\0" * 16
+    if not flags & (LZ4 | LZX):
+        readers = encode7BitInt(len(typeReaders))
+        for name in typeReaders:
+            encoded = name.encode("utf-8")
+            readers += encode7BitInt(len(encoded)) + encoded + struct.pack("<i", 0)
+        body = readers + body
+    return HEADER.pack(b"XNB", platform.encode("latin-1"), bytes([version]), flags, HEADER.size + len(body)) + body
+
+
+def writeXnb(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as xnbFile:
+        xnbFile.write(data)
+
+
+def test_parse_header():
+    header = parseXnbHeader(xnb(typeReaders=(TEXTURE, DICTIONARY)))
+    assert (header.platform, header.version, header.flags) == ("w", 5, 0)
+    assert header.typeReaders == (("Microsoft.Xna.Framework.Content.Texture2DReader, Microsoft.Xna.Framework.Graphics", 0),
+                                  ("Microsoft.Xna.Framework.Content.DictionaryReader`2[[System.String, mscorlib]]", 0))
+    assert parseXnbHeader(xnb(flags=LZX)).typeReaders is None
+    # a long name needs a two byte length
+    assert parseXnbHeader(xnb(typeReaders=("x" * 200,))).typeReaders == (("x" * 200, 0),)
+
+
+def test_parse_invalid_header(tmp_path):
+    with pytest.raises(ValueError, match=NOT_XNB):
+        parseXnbHeader(b"PNG\0\0\0\0\0\0\0")
+    with pytest.raises(ValueError, match=NOT_XNB):
+        parseXnbHeader(b"XNB")
+    with pytest.raises(ValueError):
+        parseXnbHeader(xnb()[:HEADER.size + 10])
+    with pytest.raises(ValueError):
+        parseXnbHeader(HEADER.pack(b"XNB", b"w", b"\x05", 0, 0) + encode7BitInt(1000))
+    writeXnb(str(tmp_path / "empty.xnb"), b"")
+    with pytest.raises(ValueError, match=NOT_XNB):
+        readXnbHeader(str(tmp_path / "empty.xnb"))
+
+
+def test_asset_name():
+    assert assetName("Portraits\\Abigail.xnb") == "portraits/abigail"
+
+
+def test_fingerprint_index(tmp_path):
+    content, cachePath = str(tmp_path / "Content"), str(tmp_path / "xnb.cache")
+    writeXnb(os.path.join(content, "Portraits", "Abigail.xnb"), xnb(flags=LZX))
+    writeXnb(os.path.join(content, "Data", "Events", "Town.xnb"), xnb(typeReaders=(DICTIONARY,)))
+    writeXnb(os.path.join(content, "Data", "broken.xnb"), b"broken")
+    writeXnb(os.path.join(content, "readme.txt"), b"")
+    index = XnbFingerprintIndex(content, cachePath)
+    assert index.scan() == 2
+    assert index.header("portraits/abigail").flags == LZX
+    assert index.platforms() == {"w"} and index.compressions() == {0, LZX}
+    assert XnbFingerprintIndex(content, cachePath).scan() == 0
+    writeXnb(os.path.join(content, "Portraits", "Abigail.xnb"), xnb(flags=LZX) + b"changed")
+    index = XnbFingerprintIndex(content, cachePath)
+    assert index.scan() == 1 and index.header("data/events/town") is not None
+
+
+def test_check_replacements(tmp_path):
+    content, mod = str(tmp_path / "Content"), str(tmp_path / "mod")
+    writeXnb(os.path.join(content, "Portraits", "Abigail.xnb"), xnb(flags=LZX))
+    writeXnb(os.path.join(content, "Maps", "Town.xnb"), xnb(flags=LZX))
+    writeXnb(os.path.join(content, "Data", "Events", "Town.xnb"), xnb(typeReaders=(DICTIONARY,)))
+    index = XnbFingerprintIndex(content)
+    index.scan()
+    replacements = {
+        # an uncompressed replacement of a compressed game file is loaded fine
+        "portraits/abigail": xnb(),
+        "maps/town": xnb(version=4, flags=LZX),
+        "data/events/town": xnb(typeReaders=(TEXTURE,)),
+        "portraits/haley": xnb(platform="x", flags=LZ4 | LZX),
+        "portraits/sam": b"not xnb"}
+    paths = {}
+    for asset, data in replacements.items():
+        paths[asset] = os.path.join(mod, asset + ".xnb")
+        writeXnb(paths[asset], data)
+    issues = index.check(paths)
+    assert [(issue.asset, issue.issue) for issue in issues] == [
+        ("data/events/town", OUTDATED), ("maps/town", OUTDATED),
+        ("portraits/haley", WRONG_PLATFORM), ("portraits/haley", INCOMPATIBLE_COMPRESSION), ("portraits/haley", OUTDATED),
+        ("portraits/sam", NOT_XNB)]
+    assert issues[1].details == "format version 4 instead of 5"
+    # without an index of the game files, only the files that can never load are reported
+    assert [(issue.asset, issue.issue) for issue in XnbFingerprintIndex(str(tmp_path / "missing")).check(paths)] == [
+        ("portraits/haley", INCOMPATIBLE_COMPRESSION), ("portraits/sam", NOT_XNB)]